@@ -0,0 +1,103 @@
+"""Benchmark extracting bike counts from a GBFS station_status document.
+
+Compares parsing the whole document with json.loads against streaming it
+through the station_status parser, which decodes one station at a time and
+stops once the wanted station has been read.
+
+Usage: uv run python scripts/bench_gbfs_parse.py [full|streaming]
+"""
+
+import json
+import random
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable
+
+from app.lib.citibike import CitibikeStationData, _StationStatusParser
+
+NUM_STATIONS = 2200
+CHUNK_SIZE = 16 * 1024
+REPEAT = 20
+
+
+def make_station_status() -> bytes:
+    rng = random.Random(0)  # noqa: S311
+    now = int(time.time())
+    stations = [
+        {
+            "station_id": f"66db{i:04d}-0aca-11e7-82f6-3863bb44ef7c",
+            "num_bikes_available": rng.randrange(30),
+            "num_ebikes_available": rng.randrange(5),
+            "num_bikes_disabled": rng.randrange(3),
+            "num_docks_available": rng.randrange(30),
+            "num_docks_disabled": 0,
+            "is_installed": 1,
+            "is_renting": 1,
+            "is_returning": 1,
+            "last_reported": now - rng.randrange(600),
+            "eightd_has_available_keys": False,
+            "legacy_id": str(i),
+        }
+        for i in range(NUM_STATIONS)
+    ]
+    # Citi Bike puts last_updated after the stations
+    document = {"data": {"stations": stations}, "last_updated": now, "ttl": 5}
+    return json.dumps(document).encode()
+
+
+def full(content: bytes, station_id: str) -> CitibikeStationData | None:
+    stations = {
+        station["station_id"]: CitibikeStationData(
+            regular=station["num_bikes_available"]
+            - station.get("num_ebikes_available", 0),
+            ebikes=station.get("num_ebikes_available", 0),
+        )
+        for station in json.loads(content)["data"]["stations"]
+    }
+    return stations.get(station_id)
+
+
+def streaming(content: bytes, station_id: str) -> CitibikeStationData | None:
+    parser = _StationStatusParser({station_id})
+    for start in range(0, len(content), CHUNK_SIZE):
+        if parser.feed(content[start : start + CHUNK_SIZE]):
+            break
+    return parser.stations.get(station_id)
+
+
+def bench(
+    name: str,
+    func: Callable[[bytes, str], CitibikeStationData | None],
+    content: bytes,
+    station_id: str,
+) -> None:
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        func(content, station_id)
+    elapsed = (time.perf_counter() - start) / REPEAT
+
+    tracemalloc.start()
+    func(content, station_id)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>10}: {elapsed * 1000:7.2f} ms, peak {peak / 1024:8.1f} KiB")
+
+
+BENCHMARKS = {"full": full, "streaming": streaming}
+
+
+def main() -> None:
+    names = sys.argv[1:] or list(BENCHMARKS)
+    content = make_station_status()
+    print(f"document size: {len(content) / 1024:.1f} KiB, {NUM_STATIONS} stations")
+    for position in (0.1, 0.5, 1.0):
+        index = min(int(NUM_STATIONS * position), NUM_STATIONS - 1)
+        station_id = f"66db{index:04d}-0aca-11e7-82f6-3863bb44ef7c"
+        print(f"station at {position:.0%} of the document:")
+        for name in names:
+            bench(name, BENCHMARKS[name], content, station_id)
+
+
+if __name__ == "__main__":
+    main()
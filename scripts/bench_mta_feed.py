@@ -0,0 +1,110 @@
+"""Benchmark parsing an MTA feed and looking up station departures.
+
+Compares the columnar ParsedFeed against keeping the parsed FeedMessage and
+building a TrainDeparture for every matching stop time update.
+
+Usage: uv run python scripts/bench_mta_feed.py [dataclass|columnar]
+"""
+
+import gc
+import random
+import resource
+import sys
+import time
+from collections.abc import Callable
+
+from google.transit import gtfs_realtime_pb2
+
+from app.lib.mta import ParsedFeed, TrainDeparture
+
+ROUTES = ["N", "Q", "R", "W"]
+STOPS = [f"R{i:02d}{direction}" for i in range(60) for direction in "NS"]
+STATIONS = [("R20N", {"N", "Q", "R", "W"}), ("R31S", {"N", "R"})] * 5
+REPEAT = 20
+# Number of refreshes whose results are kept alive to measure resident memory
+RETAINED = 50
+
+
+def make_feed(num_trips: int = 400) -> bytes:
+    rng = random.Random(0)  # noqa: S311
+    now = int(time.time())
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = now
+    for i in range(num_trips):
+        entity = feed.entity.add(id=str(i))
+        entity.trip_update.trip.route_id = rng.choice(ROUTES)
+        start = rng.randrange(len(STOPS) // 2)
+        for j, stop_id in enumerate(STOPS[start : start + 40]):
+            stop_time_update = entity.trip_update.stop_time_update.add(stop_id=stop_id)
+            stop_time_update.departure.time = now + 90 * j + rng.randrange(600)
+    return feed.SerializeToString()
+
+
+def dataclass_lists(content: bytes) -> object:
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(content)
+    for station_id, routes in STATIONS:
+        departures = [
+            TrainDeparture(
+                route=entity.trip_update.trip.route_id,
+                time=stop_time_update.departure.time,
+            )
+            for entity in message.entity
+            if entity.HasField("trip_update")
+            and entity.trip_update.trip.route_id in routes
+            for stop_time_update in entity.trip_update.stop_time_update
+            if stop_time_update.stop_id == station_id
+        ]
+        departures.sort(key=lambda departure: departure.time)
+    return message
+
+
+def columnar(content: bytes) -> object:
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(content)
+    feed = ParsedFeed.from_message(message)
+    for station_id, routes in STATIONS:
+        feed.next_departures(station_id, routes)
+    return feed
+
+
+def bench(name: str, func: Callable[[bytes], object], content: bytes) -> None:
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        func(content)
+    elapsed = (time.perf_counter() - start) / REPEAT
+
+    # Protobuf messages live in C memory that tracemalloc can't see, so
+    # measure growth of the max resident set size instead. Run each
+    # benchmark in its own process for accurate numbers.
+    gc.collect()
+    before = max_rss_kib()
+    retained = [func(content) for _ in range(RETAINED)]
+    retained_kib = (max_rss_kib() - before) / RETAINED
+    del retained
+    print(
+        f"{name:>16}: {elapsed * 1000:7.2f} ms/refresh, "
+        f"~{retained_kib:7.1f} KiB resident per retained feed"
+    )
+
+
+def max_rss_kib() -> float:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB on Linux
+    return max_rss / 1024 if sys.platform == "darwin" else max_rss
+
+
+BENCHMARKS = {"dataclass": dataclass_lists, "columnar": columnar}
+
+
+def main() -> None:
+    names = sys.argv[1:] or list(BENCHMARKS)
+    content = make_feed()
+    print(f"feed size: {len(content) / 1024:.1f} KiB, {len(STATIONS)} station lookups")
+    for name in names:
+        bench(name, BENCHMARKS[name], content)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Benchmark rendering the Tidbyt applet.
+
+Compares running `pixlet render` for every frame, rendering with a long-lived
+`pixlet serve` process (RenderWorker), and drawing the frames in-process with
+the native renderer. Every frame renders the same mock data, passed to the
+applet as config like the periodic task does.
+
+Usage: uv run python scripts/bench_render.py [render|worker|native]
+"""
+
+import asyncio
+import os
+import sys
+import time
+from collections.abc import Mapping
+
+import msgspec
+
+from app.api.mocks import TransitDataMocks, WeatherResponseMocks
+from app.lib.native_render import NativeRenderer
+from app.lib.tidbyt import RenderWorker, render_applet
+from app.tasks import TIDBYT_APP_PATH
+
+PIXLET_BINARY = os.environ.get("PIXLET_PATH", "pixlet")
+REPEAT = 20
+
+
+async def render(path: str, config: Mapping[str, str]) -> float:
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        await render_applet(path, pixlet_binary=PIXLET_BINARY, config=config)
+    return time.perf_counter() - start
+
+
+async def worker(path: str, config: Mapping[str, str]) -> float:
+    render_worker = RenderWorker(path, pixlet_binary=PIXLET_BINARY)
+    async with render_worker.run():
+        # Don't count startup, which only happens once
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            await render_worker.render(config=config)
+        return time.perf_counter() - start
+
+
+async def native(path: str, config: Mapping[str, str]) -> float:
+    renderer = NativeRenderer(path)
+    # Don't count loading the applet's images, which only happens once
+    await renderer.render(config=config)
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        await renderer.render(config=config)
+    return time.perf_counter() - start
+
+
+BENCHMARKS = {"render": render, "worker": worker, "native": native}
+
+
+async def main() -> None:
+    names = sys.argv[1:] or list(BENCHMARKS)
+    config = {
+        "transit_data": msgspec.json.encode(TransitDataMocks["basic"]).decode(),
+        "weather_data": msgspec.json.encode(WeatherResponseMocks["sunny"]).decode(),
+    }
+    for name in names:
+        elapsed = await BENCHMARKS[name](str(TIDBYT_APP_PATH), config) / REPEAT
+        print(f"{name:>8}: {elapsed * 1000:7.1f} ms per frame")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,15 +2,28 @@
 
 from __future__ import annotations
 
-from contextlib import asynccontextmanager
-from typing import TYPE_CHECKING, cast
+import asyncio
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import asdict
+from functools import partial
+from typing import TYPE_CHECKING, Any, cast
 
 import httpx
 import structlog
 from litestar import Litestar, Request, get
-from litestar.stores.memory import MemoryStore
+from litestar.config.response_cache import (
+    ResponseCacheConfig,
+    default_cache_key_builder,
+    default_do_cache_predicate,
+)
+from litestar.datastructures import Headers
 
 from app import sentry, settings, tasks
+from app.lib import citibike, mta
+from app.lib.http import clients
+from app.lib.weather import hourly_forecast_flight
+from app.tasks.ingestion import ingestor
 
 from .log import structlog_plugin
 from .mocks import (
@@ -20,10 +33,7 @@ from .mocks import (
     WeatherResponseMocks,
 )
 from .models import (
-    BikeStationData,
-    TrainStationData,
     TransitData,
-    WeatherData,
     WeatherMeta,
     WeatherResponse,
 )
@@ -31,9 +41,38 @@ from .models import (
 if TYPE_CHECKING:
     from collections.abc import AsyncGenerator
 
+    from litestar.stores.base import Store
+    from litestar.types import HTTPScope
+
 logger = structlog.get_logger()
 
-WEATHER_CACHE_KEY = "last_weather_data"
+# Set in a request's state to keep its response out of the response cache
+SKIP_RESPONSE_CACHE = "skip_response_cache"
+
+
+def bypasses_response_cache(headers: Headers) -> bool:
+    """Whether a request asks for a fresh response with Cache-Control:
+    no-cache, as the Tidbyt applet does for data that changes every minute.
+    """
+    return "no-cache" in headers.get("Cache-Control", "").lower()
+
+
+def response_cache_key(request: Request) -> str:
+    key = default_cache_key_builder(request)
+    if bypasses_response_cache(request.headers):
+        # Never stored (see should_cache_response), so never served from the
+        # cache
+        return f"{key}:no-cache"
+    return key
+
+
+def should_cache_response(scope: HTTPScope, status_code: int) -> bool:
+    return (
+        default_do_cache_predicate(scope, status_code)
+        and not scope.get("state", {}).get(SKIP_RESPONSE_CACHE)
+        and not bypasses_response_cache(Headers.from_scope(scope))
+    )
+
 
 ### Route handlers ###
 
@@ -43,22 +82,73 @@ async def health() -> dict[str, str]:
     return {"status": "ok"}
 
 
+@get("/metrics")
+async def metrics() -> dict[str, Any]:
+    snapshot = ingestor.snapshot
+    return {
+        "snapshot": {
+            "age": snapshot.age,
+            "sources": {
+                source: {**asdict(freshness), "age": freshness.age}
+                for source, freshness in snapshot.sources.items()
+            },
+        },
+        "http": asdict(clients.stats),
+        "mta_feed_cache": asdict(mta.feed_cache.stats),
+        "citibike_station_status": asdict(citibike.station_status_cache.stats),
+        "citibike_station_information": asdict(
+            citibike.station_information_cache.stats
+        ),
+        "single_flight": {
+            "mta": asdict(mta.stations_flight.stats),
+            "citibike": asdict(citibike.station_status_flight.stats),
+            "citibike_nearby": asdict(citibike.nearest_stations_flight.stats),
+            "weather": asdict(hourly_forecast_flight.stats),
+        },
+        "render_worker": asdict(tasks.render_worker.stats),
+        "push_queue": {
+            **asdict(tasks.push_queue.stats),
+            "depth": tasks.push_queue.depth,
+        },
+        "render_trigger": asdict(tasks.render_trigger.stats),
+        "render_pipeline": asdict(tasks.render_pipeline.stats),
+        "leader_election": (
+            {
+                **asdict(tasks.leader_election.stats),
+                "is_leader": tasks.leader_election.is_leader,
+            }
+            if tasks.leader_election
+            else None
+        ),
+        "render_cache": {
+            **asdict(tasks.render_cache.stats),
+            "hit_ratio": tasks.render_cache.stats.hit_ratio,
+        },
+    }
+
+
 @get("/transit", cache=5)
-async def transit(*, mock: TransitDataMockName | None = None) -> TransitData:
+async def transit(
+    *, mock: TransitDataMockName | None = None, stations: str | None = None
+) -> TransitData:
     mock_name = mock or settings.TRANSIT_MOCK
     if mock_name:
         logger.debug("returning mock data")
         return TransitDataMocks[cast("TransitDataMockName", mock_name)]
-    return TransitData(
-        trains=[
-            await TrainStationData.from_station_id(
-                settings.MTA_STATION_ID1, routes=settings.MTA_STATION_ROUTES1
-            ),
-            await TrainStationData.from_station_id(
-                settings.MTA_STATION_ID2, routes=settings.MTA_STATION_ROUTES2
-            ),
-        ],
-        citibike=await BikeStationData.from_station_id(settings.CITIBIKE_STATION_ID),
+    if not settings.INGEST_ENABLE or not ingestor.snapshot.has_transit:
+        # Ingestion is disabled or hasn't completed yet, so fetch now
+        await asyncio.gather(
+            ingestor.refresh_trains(),
+            ingestor.refresh_citibike(),
+            ingestor.refresh_citibike_nearby(),
+        )
+    # Devices can show a subset of stations, given as comma-separated IDs
+    station_ids = set(stations.split(",")) if stations else None
+    # Wait times are computed against a single clock read here rather than
+    # when the data was fetched, so they're correct however old the data is
+    return cast(
+        "TransitData",
+        ingestor.snapshot.transit(now=time.time(), station_ids=station_ids),
     )
 
 
@@ -77,24 +167,18 @@ async def weather(
     if mock_name:
         logger.debug("returning mock weather data")
         return WeatherResponseMocks[cast("WeatherResponseMockName", mock_name)]
-    if settings.WEATHER_COORDINATES:
-        latitude, longitude = settings.WEATHER_COORDINATES
-        store = request.app.stores.get("weather")
-        # OpenMeteo has intermittent errors (connection, timeout, rate limit)
-        # that resolve quickly. Handle those gracefully and return last cached data.
-        try:
-            data = await WeatherData.from_coordinates(
-                latitude=latitude,
-                longitude=longitude,
-            )
-            # XXX: MemoryStore stores values as-is in memory despite the
-            # str | bytes type annotation on the Store base class
-            await store.set(WEATHER_CACHE_KEY, data)  # type: ignore[arg-type]
-        except httpx.HTTPError:
-            logger.warning("error fetching from OpenMeteo, using cached data")
-            data = await store.get(WEATHER_CACHE_KEY)  # type: ignore[assignment]
-    else:
-        data = None
+    # Serve the weather estimated from the last forecast, stale or not,
+    # while a fresh forecast is fetched in the background
+    refresh = ingestor.revalidate_weather()
+    data = ingestor.snapshot.weather(now=time.time())
+    if data is None and refresh is not None:
+        # There's no forecast yet (e.g. at startup), so wait for it. Shielded
+        # so that a disconnecting client doesn't cancel the shared refresh.
+        await asyncio.shield(refresh)
+        data = ingestor.snapshot.weather(now=time.time())
+    if data is None:
+        # Don't keep serving no weather after a forecast is ingested
+        request.state[SKIP_RESPONSE_CACHE] = True
     return WeatherResponse(
         data=data,
         meta=WeatherMeta(requested_temperature_unit=settings.TEMPERATURE_UNIT),
@@ -106,16 +190,74 @@ async def list_weather_mocks() -> list[str]:
     return list(WeatherResponseMocks)
 
 
+### Upstream connections ###
+
+
+@asynccontextmanager
+async def open_http_client(app: Litestar) -> AsyncGenerator[None]:
+    limits = httpx.Limits(
+        max_connections=settings.UPSTREAM_MAX_CONCURRENCY,
+        max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+    async with clients.open(limits=limits, http2=settings.UPSTREAM_HTTP2):
+        yield
+
+
 ### Periodic tasks ###
 
 
 @asynccontextmanager
-async def schedule_periodic_tasks(app: Litestar) -> AsyncGenerator[None]:
-    async with tasks.scheduler() as scheduler:
+async def run_background_tasks(app: Litestar) -> AsyncGenerator[None]:
+    """Poll upstreams and push to Tidbyt. If workers share Redis, only the
+    elected leader does; the others serve the data the leader polled.
+    """
+    if tasks.leader_election is None or tasks.shared_store is None:
+        async with lead(None):
+            yield
+        return
+    election = asyncio.create_task(
+        tasks.leader_election.run(
+            lead=partial(lead, tasks.shared_store),
+            follow=partial(follow, tasks.shared_store),
+        )
+    )
+    try:
+        yield
+    finally:
+        election.cancel()
+        await asyncio.gather(election, return_exceptions=True)
+
+
+@asynccontextmanager
+async def lead(shared_store: Store | None) -> AsyncGenerator[None]:
+    async with AsyncExitStack() as stack:
+        if settings.INGEST_ENABLE:
+            await stack.enter_async_context(ingestor.run_in_background())
+        if shared_store is not None:
+            await stack.enter_async_context(
+                ingestor.share(shared_store, interval=tasks.SHARED_SNAPSHOT_INTERVAL)
+            )
+        scheduler = await stack.enter_async_context(tasks.scheduler())
         await scheduler.start_in_background()
         yield
 
 
+@asynccontextmanager
+async def follow(shared_store: Store) -> AsyncGenerator[None]:
+    async with ingestor.follow(shared_store, interval=tasks.SHARED_SNAPSHOT_INTERVAL):
+        yield
+
+
+@asynccontextmanager
+async def close_redis(app: Litestar) -> AsyncGenerator[None]:
+    try:
+        yield
+    finally:
+        if tasks.redis is not None:
+            await tasks.redis.aclose()
+
+
 ### Sentry ###
 
 sentry.init_sentry()
@@ -123,8 +265,24 @@ sentry.init_sentry()
 ### The ASGI App ###
 
 app = Litestar(
-    route_handlers=[health, transit, list_transit_mocks, weather, list_weather_mocks],
-    lifespan=[schedule_periodic_tasks],
+    route_handlers=[
+        health,
+        metrics,
+        transit,
+        list_transit_mocks,
+        weather,
+        list_weather_mocks,
+    ],
+    lifespan=[open_http_client, close_redis, run_background_tasks],
+    response_cache_config=ResponseCacheConfig(
+        key_builder=response_cache_key,
+        cache_response_filter=should_cache_response,
+    ),
+    # Share cached responses between workers
+    stores=(
+        {"response_cache": tasks.response_cache_store}
+        if tasks.response_cache_store
+        else None
+    ),
     plugins=[structlog_plugin],
-    stores={"weather": MemoryStore()},
 )
@@ -10,7 +10,7 @@ from polyfactory.factories import DataclassFactory
 from .models import (
     BikeStationData,
     ServiceAlert,
-    TrainDeparture,
+    TrainDepartureData,
     TrainStationData,
     TransitData,
     WeatherCondition,
@@ -36,7 +36,7 @@ class ServiceAlertFactory(DataclassFactory[ServiceAlert]):
     effect = "UNKNOWN_EFFECT"
 
 
-class TrainDepartureFactory(DataclassFactory[TrainDeparture]):
+class TrainDepartureFactory(DataclassFactory[TrainDepartureData]):
     __set_as_default_factory_for_type__ = True
     route = Use(DataclassFactory.__random__.choice, ["B", "Q", "2", "3"])
 
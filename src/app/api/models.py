@@ -2,11 +2,30 @@ from __future__ import annotations
 
 from dataclasses import dataclass, field
 from enum import StrEnum, auto
-from typing import Literal
+from typing import TYPE_CHECKING, Literal
 
-from app.lib.citibike import get_bike_counts
-from app.lib.mta import ServiceAlert, TrainDeparture, get_station_data
-from app.lib.weather import get_current_weather
+# Litestar resolves field types at runtime
+from app.lib.mta import ServiceAlert  # noqa: TC001
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from app.lib import mta
+    from app.lib.citibike import (
+        CitibikeStationData,
+        NearbyStation,
+        StationStatusSnapshot,
+    )
+    from app.lib.weather import CurrentWeatherData, HourlyForecast
+
+
+@dataclass
+class TrainDepartureData:
+    route: str
+    time: int
+    wait_time_minutes: int
+    # Whether there are service alerts for delays for this train
+    has_delays: bool = False
 
 
 @dataclass
@@ -14,27 +33,33 @@ class TrainStationData:
     station_id: str
     routes: list[str]
     alerts: list[ServiceAlert] = field(default_factory=list)
-    departures: list[TrainDeparture] = field(default_factory=list)
+    departures: list[TrainDepartureData] = field(default_factory=list)
 
     @classmethod
-    async def from_station_id(
-        cls, station_id: str, *, routes: set[str]
+    def from_station_data(
+        cls, station_data: mta.TrainStationData, *, now: float
     ) -> TrainStationData:
-        """Initialize TrainStationData with departures for specified routes.
-        Fetches data from the MTA GTFS feed.
+        """Initialize TrainStationData from MTA data, computing wait times
+        as of ``now`` (a Unix time).
         """
-        station_data = await get_station_data(station_id, routes=routes)
-        if station_data is None:
-            return cls(station_id=station_id, routes=sorted(routes))
+        departures = [
+            TrainDepartureData(
+                route=departure.route,
+                time=departure.time,
+                wait_time_minutes=departure.wait_time_minutes(now),
+                has_delays=departure.has_delays,
+            )
+            for departure in station_data.departures
+        ]
         return cls(
-            station_id=station_id,
-            routes=sorted(routes),
+            station_id=station_data.station_id,
+            routes=station_data.routes,
             alerts=station_data.alerts,
             departures=[
                 # Only return departures for trains we can actually catch
                 departure
-                for departure in station_data.departures
-                if departure.wait_time_minutes and departure.wait_time_minutes >= 2
+                for departure in departures
+                if departure.wait_time_minutes >= 2
             ],
         )
 
@@ -43,22 +68,68 @@ class TrainStationData:
 class BikeStationData:
     regular: int
     ebike: int
+    station_id: str | None = None
 
     @classmethod
-    async def from_station_id(cls, station_id: str) -> BikeStationData:
-        station_data = await get_bike_counts(station_id)
+    def from_station_data(
+        cls, station_data: CitibikeStationData | None, *, station_id: str | None = None
+    ) -> BikeStationData:
         if station_data is None:
-            return BikeStationData(regular=0, ebike=0)
+            return BikeStationData(regular=0, ebike=0, station_id=station_id)
         return cls(
             regular=station_data.regular,
             ebike=station_data.ebikes,
+            station_id=station_id,
+        )
+
+    @classmethod
+    def from_snapshot(
+        cls, snapshot: StationStatusSnapshot | None, station_ids: Iterable[str]
+    ) -> list[BikeStationData]:
+        """Initialize BikeStationData for each of ``station_ids``, in order,
+        from a single station_status snapshot.
+        """
+        return [
+            cls.from_station_data(
+                snapshot.get(station_id) if snapshot is not None else None,
+                station_id=station_id,
+            )
+            for station_id in station_ids
+        ]
+
+    @property
+    def has_bikes(self) -> bool:
+        return self.regular > 0 or self.ebike > 0
+
+
+@dataclass
+class NearbyBikeStationData:
+    station_id: str
+    name: str
+    distance_meters: int
+    regular: int
+    ebike: int
+
+    @classmethod
+    def from_nearby_station(cls, station: NearbyStation) -> NearbyBikeStationData:
+        return cls(
+            station_id=station.location.station_id,
+            name=station.location.name,
+            distance_meters=round(station.distance_meters),
+            regular=station.bikes.regular,
+            ebike=station.bikes.ebikes,
         )
 
 
 @dataclass
 class TransitData:
     trains: list[TrainStationData]
+    # The station to display
     citibike: BikeStationData
+    # Every configured station, including fallbacks
+    citibike_stations: list[BikeStationData] = field(default_factory=list)
+    # Nearest stations with bikes available, if a coordinate is configured
+    citibike_nearby: list[NearbyBikeStationData] = field(default_factory=list)
 
 
 class WeatherCondition(StrEnum):
@@ -123,12 +194,21 @@ class WeatherData:
         self.temperature_fahrenheit = self.temperature_celsius * 9 / 5 + 32
 
     @classmethod
-    async def from_coordinates(cls, latitude: float, longitude: float) -> WeatherData:
-        """Get current weather data for a given location."""
-        current_weather = await get_current_weather(latitude, longitude)
-        temperature_celsius = current_weather["temperature_2m"]
+    def from_forecast(
+        cls, forecast: HourlyForecast, *, now: float
+    ) -> WeatherData | None:
+        """Weather at ``now`` (a Unix time) estimated from an hourly forecast,
+        or None if the forecast doesn't cover ``now``.
+        """
+        current_weather = forecast.at(now)
+        if current_weather is None:
+            return None
+        return cls.from_current_weather(current_weather)
+
+    @classmethod
+    def from_current_weather(cls, current_weather: CurrentWeatherData) -> WeatherData:
         return cls(
-            temperature_celsius=temperature_celsius,
+            temperature_celsius=current_weather["temperature_2m"],
             condition=WeatherCondition.from_weather_code(
                 current_weather["weather_code"], is_day=current_weather["is_day"]
             ),
@@ -1,12 +1,37 @@
-from dataclasses import dataclass
+from __future__ import annotations
+
+import codecs
+import json
+import math
+import re
+import time
+from dataclasses import dataclass, field, replace
+from typing import TYPE_CHECKING
 
 import httpx
 import structlog
 
-from .http import make_client
+from .geo import GridIndex
+from .http import ConditionalRequests, clients
+from .singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from collections.abc import Collection
 
 logger = structlog.get_logger()
 
+# https://gbfs.org/documentation/reference/#station_statusjson
+STATION_STATUS_URL = "https://gbfs.citibikenyc.com/gbfs/en/station_status.json"
+# https://gbfs.org/documentation/reference/#station_informationjson
+STATION_INFORMATION_URL = (
+    "https://gbfs.citibikenyc.com/gbfs/en/station_information.json"
+)
+
+_STATIONS_PATTERN = re.compile(r'"stations"\s*:\s*\[')
+_LAST_UPDATED_PATTERN = re.compile(r'"last_updated"\s*:\s*(\d+)(?=\D)')
+_TTL_PATTERN = re.compile(r'"ttl"\s*:\s*(\d+)(?=\D)')
+_STREAM_CHUNK_SIZE = 16 * 1024
+
 
 @dataclass
 class CitibikeStationData:
@@ -14,36 +39,463 @@ class CitibikeStationData:
     ebikes: int
 
 
-async def get_bike_counts(station_id: str) -> CitibikeStationData | None:
-    """Fetch bike counts for a given station."""
-    async with make_client() as client:
-        try:
-            response = await client.get(
-                "https://gbfs.citibikenyc.com/gbfs/en/station_status.json"
+@dataclass(frozen=True)
+class StationLocation:
+    station_id: str
+    name: str
+    latitude: float
+    longitude: float
+
+
+@dataclass
+class NearbyStation:
+    location: StationLocation
+    distance_meters: float
+    bikes: CitibikeStationData
+
+
+@dataclass
+class StationStatusStats:
+    # Lookups served from a snapshot within its ttl, without a request
+    fresh_hits: int = 0
+    # Upstream responded 304 Not Modified to a conditional request
+    not_modified: int = 0
+    # Response bytes not downloaded thanks to 304 responses
+    bytes_saved: int = 0
+    # Fetched documents that weren't parsed because the feed hadn't advanced
+    parses_skipped: int = 0
+    # Downloads stopped before the end of the document because the rest
+    # wasn't needed
+    stopped_early: int = 0
+
+
+@dataclass
+class StationStatusSnapshot:
+    """Bike counts for a set of stations, read from one GBFS station_status
+    document.
+    """
+
+    # Stations that were searched for in the document
+    station_ids: frozenset[str]
+    stations: dict[str, CitibikeStationData] = field(default_factory=dict)
+    last_updated: int | None = None
+    # Number of seconds until the upstream updates the document
+    ttl: int = 0
+    fetched_at: float = field(default_factory=time.time)
+    size: int = 0
+
+    @property
+    def expires_at(self) -> float:
+        """Unix time after which the upstream may have newer data."""
+        updated_at = self.fetched_at if self.last_updated is None else self.last_updated
+        return updated_at + self.ttl
+
+    def is_fresh(self, now: float | None = None) -> bool:
+        return (time.time() if now is None else now) < self.expires_at
+
+    def get(self, station_id: str) -> CitibikeStationData | None:
+        """Return bike counts for ``station_id``, or None if the station
+        isn't in the document.
+        """
+        return self.stations.get(station_id)
+
+
+class _StationStatusParser:
+    """Incrementally extract stations from a GBFS station_status document.
+
+    Station objects are decoded one at a time as chunks arrive, and only the
+    wanted stations are kept. :meth:`feed` returns True once every wanted
+    station has been found (or, if ``last_updated`` comes before the stations
+    and equals ``previous_last_updated``, once that's known), so that the
+    rest of the document needn't be read. Pass ``stop_early=False`` to read
+    the whole document, e.g. to get a ``ttl`` that follows the stations.
+    """
+
+    def __init__(
+        self,
+        station_ids: Collection[str],
+        *,
+        previous_last_updated: int | None = None,
+        stop_early: bool = True,
+    ) -> None:
+        self.station_ids = frozenset(station_ids)
+        self.previous_last_updated = previous_last_updated
+        self.stop_early = stop_early
+        self.last_updated: int | None = None
+        self.ttl: int | None = None
+        self.stations: dict[str, CitibikeStationData] = {}
+        # Set if last_updated matched previous_last_updated before any
+        # stations were read
+        self.unchanged = False
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._in_stations = False
+        self._stations_done = False
+
+    def feed(self, chunk: bytes) -> bool:
+        self._buffer += self._text_decoder.decode(chunk)
+        if not self._in_stations and not self._stations_done:
+            match = _STATIONS_PATTERN.search(self._buffer)
+            if match is None:
+                self._read_header(self._buffer)
+                return self.unchanged
+            self._read_header(self._buffer[: match.start()])
+            if self.unchanged:
+                return True
+            self._buffer = self._buffer[match.end() :]
+            self._in_stations = True
+        if self._in_stations:
+            self._read_stations()
+        if self._stations_done:
+            # last_updated and ttl may follow the stations
+            self._read_header(self._buffer)
+        return self._found_all()
+
+    def close(self) -> None:
+        """Check that the whole stations array was read."""
+        if not self._stations_done:
+            raise ValueError("truncated GBFS station_status document")
+
+    def _found_all(self) -> bool:
+        return self.stop_early and self.station_ids <= self.stations.keys()
+
+    def _read_header(self, text: str) -> None:
+        if self.ttl is None and (match := _TTL_PATTERN.search(text)):
+            self.ttl = int(match.group(1))
+        if self.last_updated is None and (match := _LAST_UPDATED_PATTERN.search(text)):
+            self.last_updated = int(match.group(1))
+            self.unchanged = (
+                not self._stations_done
+                and self.last_updated == self.previous_last_updated
             )
-        except httpx.HTTPError as exc:
-            logger.warning(
-                "failed to fetch citibike data for station %s: %s", station_id, exc
+
+    def _read_stations(self) -> None:
+        buffer = self._buffer
+        raw_decode = self._json_decoder.raw_decode
+        pos = 0
+        end = len(buffer)
+        while pos < end:
+            char = buffer[pos]
+            if char != "{":
+                if char == "]":
+                    self._in_stations = False
+                    self._stations_done = True
+                    pos += 1
+                    break
+                # Skip commas and whitespace between stations
+                pos += 1
+                continue
+            try:
+                station, next_pos = raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Incomplete object; wait for the next chunk
+                break
+            pos = next_pos
+            if station["station_id"] in self.station_ids:
+                num_ebikes = station.get("num_ebikes_available", 0)
+                self.stations[station["station_id"]] = CitibikeStationData(
+                    regular=station["num_bikes_available"] - num_ebikes,
+                    ebikes=num_ebikes,
+                )
+                if self._found_all():
+                    break
+        self._buffer = buffer[pos:]
+
+
+class StationStatusCache:
+    """Snapshots of the GBFS station_status document.
+
+    The document is streamed and only the stations that have been asked for
+    are extracted; the download stops once they've all been read. A snapshot
+    is reused without a request until its ``ttl`` runs out. After that the
+    document is re-requested conditionally, and if the upstream responds 304
+    Not Modified or the document's ``last_updated`` hasn't advanced, the
+    previous snapshot is reused.
+    """
+
+    def __init__(self) -> None:
+        self.stats = StationStatusStats()
+        self._latest: StationStatusSnapshot | None = None
+        self._requests = ConditionalRequests()
+        # Stations to extract from each document
+        self._station_ids: set[str] = set()
+        # ttl of the last document that was read to the end. Citi Bike puts
+        # ttl after the stations, so it isn't read when stopping early.
+        self._ttl: int | None = None
+
+    async def snapshot(
+        self, client: httpx.AsyncClient, station_ids: Collection[str]
+    ) -> StationStatusSnapshot | None:
+        """Return a snapshot that includes ``station_ids``.
+
+        Returns None if the upstream responds with an error status.
+        """
+        wanted = frozenset(station_ids)
+        latest = self._latest
+        if latest is not None and latest.station_ids >= wanted:
+            if latest.is_fresh():
+                self.stats.fresh_hits += 1
+                return latest
+        elif not self._station_ids >= wanted:
+            self._station_ids.update(wanted)
+            # The latest document wasn't searched for these stations
+            self._requests.forget(STATION_STATUS_URL)
+        return await self._fetch(client)
+
+    async def get(
+        self, client: httpx.AsyncClient, station_id: str
+    ) -> CitibikeStationData | None:
+        """Return bike counts for ``station_id``.
+
+        Returns None if the upstream responds with an error status or the
+        station isn't in the feed.
+        """
+        snapshot = await self.snapshot(client, {station_id})
+        return None if snapshot is None else snapshot.get(station_id)
+
+    def clear(self) -> None:
+        self._latest = None
+        self._requests.clear()
+        self._station_ids.clear()
+        self._ttl = None
+
+    async def _fetch(self, client: httpx.AsyncClient) -> StationStatusSnapshot | None:
+        latest = self._latest
+        async with self._requests.stream(client, STATION_STATUS_URL) as response:
+            if response.status_code == httpx.codes.NOT_MODIFIED:
+                if latest is None:
+                    # Nothing to reuse; make the next request unconditional
+                    self._requests.forget(STATION_STATUS_URL)
+                    return None
+                self.stats.not_modified += 1
+                self.stats.bytes_saved += latest.size
+                self.stats.parses_skipped += 1
+                self._latest = replace(latest, fetched_at=time.time())
+                return self._latest
+            if not response.is_success:
+                logger.debug(
+                    "failed to fetch citibike station status (status_code=%s)",
+                    response.status_code,
+                )
+                return None
+            parser = _StationStatusParser(
+                self._station_ids,
+                previous_last_updated=latest.last_updated
+                if latest is not None and latest.station_ids >= self._station_ids
+                else None,
+                stop_early=self._ttl is not None,
             )
-            return None
+            size = 0
+            async for chunk in response.aiter_bytes(_STREAM_CHUNK_SIZE):
+                size += len(chunk)
+                if parser.feed(chunk):
+                    # Closing the response early discards the rest of the body
+                    self.stats.stopped_early += 1
+                    break
+            else:
+                parser.close()
+                self._ttl = parser.ttl or 0
+        if parser.unchanged and latest is not None:
+            self.stats.parses_skipped += 1
+            self._latest = replace(latest, fetched_at=time.time())
+            return self._latest
+        self._latest = StationStatusSnapshot(
+            station_ids=parser.station_ids,
+            stations=parser.stations,
+            last_updated=parser.last_updated,
+            ttl=parser.ttl if parser.ttl is not None else self._ttl or 0,
+            size=int(response.headers.get("content-length", size)),
+        )
+        return self._latest
+
+
+@dataclass
+class StationInformationStats:
+    builds: int = 0
+    # Documents whose stations were the same as the indexed ones
+    rebuilds_skipped: int = 0
+    not_modified: int = 0
+
+
+class StationInformationCache:
+    """Spatial index of the stations in the GBFS station_information document.
+
+    The document is re-requested conditionally at most every ``max_age``
+    seconds, and the index is only rebuilt when the stations' IDs, names or
+    locations change.
+    """
+
+    def __init__(self, *, max_age: float = 3600) -> None:
+        self.max_age = max_age
+        self.stats = StationInformationStats()
+        self._index: GridIndex[StationLocation] | None = None
+        self._locations: frozenset[StationLocation] = frozenset()
+        # Monotonic time of the last successful request
+        self._checked_at = -math.inf
+        self._requests = ConditionalRequests()
+
+    async def get(self, client: httpx.AsyncClient) -> GridIndex[StationLocation] | None:
+        """Return the index, or None if the document has never been fetched."""
+        if self._index is not None and (
+            time.monotonic() - self._checked_at < self.max_age
+        ):
+            return self._index
+        response = await self._requests.get(client, STATION_INFORMATION_URL)
+        if response.status_code == httpx.codes.NOT_MODIFIED and self._index is not None:
+            self.stats.not_modified += 1
+            self._checked_at = time.monotonic()
+            return self._index
         if not response.is_success:
             logger.debug(
-                "failed to fetch citibike data for station %s (status_code=%s)",
-                station_id,
+                "failed to fetch citibike station information (status_code=%s)",
                 response.status_code,
             )
+            # Make the next request unconditional
+            self._requests.forget(STATION_INFORMATION_URL)
+            return self._index
+        self._checked_at = time.monotonic()
+        locations = frozenset(
+            StationLocation(
+                station_id=station["station_id"],
+                name=station.get("name", ""),
+                latitude=station["lat"],
+                longitude=station["lon"],
+            )
+            for station in response.json()["data"]["stations"]
+        )
+        if self._index is not None and locations == self._locations:
+            self.stats.rebuilds_skipped += 1
+            return self._index
+        self._index = GridIndex(
+            (location.latitude, location.longitude, location) for location in locations
+        )
+        self._locations = locations
+        self.stats.builds += 1
+        return self._index
+
+    def clear(self) -> None:
+        self._index = None
+        self._locations = frozenset()
+        self._checked_at = -math.inf
+        self._requests.clear()
+
+
+station_status_cache = StationStatusCache()
+station_information_cache = StationInformationCache()
+station_status_flight: SingleFlight[frozenset[str], StationStatusSnapshot | None] = (
+    SingleFlight()
+)
+
+
+async def get_station_status(
+    station_ids: Collection[str], *, client: httpx.AsyncClient | None = None
+) -> StationStatusSnapshot | None:
+    """Fetch a snapshot of bike counts for any number of stations.
+
+    Pass ``client`` to issue the request through an existing client.
+    Concurrent calls for the same stations share one in-flight fetch.
+
+    Returns None if the station_status document couldn't be fetched.
+    """
+    key = frozenset(station_ids)
+    return await station_status_flight.do(
+        key, lambda: _fetch_station_status(key, client=client)
+    )
+
+
+async def _fetch_station_status(
+    station_ids: frozenset[str], *, client: httpx.AsyncClient | None
+) -> StationStatusSnapshot | None:
+    if client is None:
+        async with clients.client() as own_client:
+            return await _fetch_station_status(station_ids, client=own_client)
+    try:
+        return await station_status_cache.snapshot(client, station_ids)
+    except httpx.HTTPError as exc:
+        logger.warning(
+            "failed to fetch citibike data for stations %s: %s",
+            ", ".join(sorted(station_ids)),
+            exc,
+        )
+        return None
+
+
+async def get_bike_counts(
+    station_id: str, *, client: httpx.AsyncClient | None = None
+) -> CitibikeStationData | None:
+    """Fetch bike counts for a given station.
+
+    Pass ``client`` to issue the request through an existing client.
+    """
+    snapshot = await get_station_status({station_id}, client=client)
+    return None if snapshot is None else snapshot.get(station_id)
+
+
+# Number of nearest stations whose bike counts are checked per station
+# returned by get_nearest_stations, since some of them may be empty
+_NEAREST_CANDIDATES_PER_RESULT = 4
+
+nearest_stations_flight: SingleFlight[
+    tuple[float, float, int], list[NearbyStation] | None
+] = SingleFlight()
+
+
+async def get_nearest_stations(
+    latitude: float,
+    longitude: float,
+    *,
+    limit: int,
+    client: httpx.AsyncClient | None = None,
+) -> list[NearbyStation] | None:
+    """Fetch up to ``limit`` of the stations nearest to a coordinate that
+    have bikes or e-bikes available, closest first.
+
+    Returns None if the station information or status couldn't be fetched.
+    """
+    key = (latitude, longitude, limit)
+    return await nearest_stations_flight.do(
+        key,
+        lambda: _fetch_nearest_stations(
+            latitude, longitude, limit=limit, client=client
+        ),
+    )
+
+
+async def _fetch_nearest_stations(
+    latitude: float,
+    longitude: float,
+    *,
+    limit: int,
+    client: httpx.AsyncClient | None,
+) -> list[NearbyStation] | None:
+    if client is None:
+        async with clients.client() as own_client:
+            return await _fetch_nearest_stations(
+                latitude, longitude, limit=limit, client=own_client
+            )
+    try:
+        index = await station_information_cache.get(client)
+        if index is None:
             return None
-        status_data = response.json()
-
-        return next(
-            (
-                CitibikeStationData(
-                    regular=station["num_bikes_available"]
-                    - station.get("num_ebikes_available", 0),
-                    ebikes=station.get("num_ebikes_available", 0),
-                )
-                for station in status_data["data"]["stations"]
-                if station["station_id"] == station_id
-            ),
-            None,
+        candidates = index.nearest(
+            latitude, longitude, limit=limit * _NEAREST_CANDIDATES_PER_RESULT
         )
+        snapshot = await station_status_cache.snapshot(
+            client, {location.station_id for _, location in candidates}
+        )
+    except httpx.HTTPError as exc:
+        logger.warning("failed to fetch nearest citibike stations: %s", exc)
+        return None
+    if snapshot is None:
+        return None
+    nearby: list[NearbyStation] = []
+    for distance, location in candidates:
+        bikes = snapshot.get(location.station_id)
+        if bikes is not None and (bikes.regular > 0 or bikes.ebikes > 0):
+            nearby.append(
+                NearbyStation(location=location, distance_meters=distance, bikes=bikes)
+            )
+            if len(nearby) == limit:
+                break
+    return nearby
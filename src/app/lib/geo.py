@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import math
+from collections import defaultdict
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+# Mean Earth radius
+EARTH_RADIUS_METERS = 6_371_000
+METERS_PER_DEGREE = math.radians(1) * EARTH_RADIUS_METERS
+
+type Cell = tuple[int, int]
+
+
+class GridIndex[T]:
+    """Index of points in a grid of roughly square cells, for nearest-point
+    queries that only look at the cells around the query point.
+
+    Distances use an equirectangular projection around the mean latitude of
+    the points, which is accurate to well under 1% over a city.
+    """
+
+    def __init__(
+        self,
+        points: Iterable[tuple[float, float, T]],
+        *,
+        cell_size_meters: float = 500,
+    ) -> None:
+        """Index ``points``, given as (latitude, longitude, value) tuples."""
+        points = list(points)
+        mean_latitude = (
+            sum(latitude for latitude, _, _ in points) / len(points) if points else 0
+        )
+        # Meters per degree of longitude shrinks towards the poles
+        self._longitude_scale = math.cos(math.radians(mean_latitude))
+        self._cell_size = cell_size_meters
+        self._cells: defaultdict[Cell, list[tuple[float, float, T]]] = defaultdict(list)
+        for latitude, longitude, value in points:
+            x, y = self._project(latitude, longitude)
+            self._cells[self._cell(x, y)].append((x, y, value))
+        rows = [row for row, _ in self._cells] or [0]
+        columns = [column for _, column in self._cells] or [0]
+        self._bounds = (min(rows), max(rows), min(columns), max(columns))
+        self._size = len(points)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def nearest(
+        self, latitude: float, longitude: float, *, limit: int
+    ) -> list[tuple[float, T]]:
+        """Return up to ``limit`` (distance in meters, value) tuples for the
+        points nearest to the given coordinate, closest first.
+        """
+        if limit <= 0:
+            return []
+        x, y = self._project(latitude, longitude)
+        row, column = self._cell(x, y)
+        min_row, max_row, min_column, max_column = self._bounds
+        found: list[tuple[float, T]] = []
+        if not (min_row <= row <= max_row and min_column <= column <= max_column):
+            # Outside of the indexed area, scanning every point is cheaper
+            # than searching rings of mostly empty cells
+            found = [
+                (math.hypot(point_x - x, point_y - y), value)
+                for points in self._cells.values()
+                for point_x, point_y, value in points
+            ]
+            found.sort(key=lambda item: item[0])
+            return found[:limit]
+        # Beyond this many rings around the query cell there are no points
+        max_ring = max(
+            max_row - row, row - min_row, max_column - column, column - min_column
+        )
+        for ring in range(max_ring + 1):
+            for cell in _ring_cells(row, column, ring):
+                found.extend(
+                    (math.hypot(point_x - x, point_y - y), value)
+                    for point_x, point_y, value in self._cells.get(cell, ())
+                )
+            if len(found) >= limit:
+                found.sort(key=lambda item: item[0])
+                # Points outside of the rings searched so far are at least
+                # this far away, so none of them can be closer
+                if found[limit - 1][0] <= ring * self._cell_size:
+                    break
+        found.sort(key=lambda item: item[0])
+        return found[:limit]
+
+    def _project(self, latitude: float, longitude: float) -> tuple[float, float]:
+        return (
+            longitude * self._longitude_scale * METERS_PER_DEGREE,
+            latitude * METERS_PER_DEGREE,
+        )
+
+    def _cell(self, x: float, y: float) -> Cell:
+        return (math.floor(y / self._cell_size), math.floor(x / self._cell_size))
+
+
+def _ring_cells(row: int, column: int, ring: int) -> Iterable[Cell]:
+    """Cells on the square ring ``ring`` cells away from (row, column)."""
+    if ring == 0:
+        yield (row, column)
+        return
+    for offset in range(-ring, ring + 1):
+        yield (row - ring, column + offset)
+        yield (row + ring, column + offset)
+    for offset in range(-ring + 1, ring):
+        yield (row + offset, column - ring)
+        yield (row + offset, column + ring)
@@ -1,12 +1,229 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any
+
 import httpx
+import structlog
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncGenerator, AsyncIterator, Awaitable
+
+logger = structlog.get_logger()
 
 DEFAULT_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
 DEFAULT_RETRIES = 2
+DEFAULT_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
 
 
 def make_client(**kwargs) -> httpx.AsyncClient:
-    """Create an httpx.AsyncClient with retries and timeouts."""
+    """Create an httpx.AsyncClient with retries and timeouts.
+
+    Pass ``limits`` to bound the number of concurrent connections made
+    through the client, and ``http2=True`` to negotiate HTTP/2 with
+    upstreams that support it. ``limits.max_connections`` also bounds the
+    number of requests in flight, which HTTP/2 would otherwise multiplex
+    over a single connection without limit.
+    """
     kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
-    transport = httpx.AsyncHTTPTransport(retries=DEFAULT_RETRIES)
-    kwargs.setdefault("transport", transport)
+    limits = kwargs.pop("limits", DEFAULT_LIMITS)
+    http2 = kwargs.pop("http2", False)
+    if "transport" not in kwargs:
+        transport: httpx.AsyncBaseTransport = httpx.AsyncHTTPTransport(
+            retries=DEFAULT_RETRIES, limits=limits, http2=http2
+        )
+        if limits.max_connections is not None:
+            transport = _LimitedTransport(
+                transport, max_requests=limits.max_connections
+            )
+        kwargs["transport"] = transport
     return httpx.AsyncClient(**kwargs)
+
+
+class _LimitedTransport(httpx.AsyncBaseTransport):
+    """Limit the number of requests in flight through a transport. A request
+    is in flight until its response is closed.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, *, max_requests: int):
+        self._transport = transport
+        self._semaphore = asyncio.Semaphore(max_requests)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await self._semaphore.acquire()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        if response.is_closed:
+            # Responses built with their content already read are never
+            # closed again
+            self._semaphore.release()
+        else:
+            response.stream = _ReleasingStream(response.stream, self._semaphore)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """Response stream that releases a semaphore once when it's closed."""
+
+    def __init__(self, stream: Any, semaphore: asyncio.Semaphore) -> None:
+        self._stream = stream
+        self._semaphore: asyncio.Semaphore | None = semaphore
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+                self._semaphore = None
+
+
+@dataclass
+class ConnectionStats:
+    requests: int = 0
+    # Requests sent over a connection opened by an earlier request
+    reused: int = 0
+    http2_requests: int = 0
+    tcp_handshakes: int = 0
+    tls_handshakes: int = 0
+
+
+class _ConnectionTracer:
+    """httpcore trace callback that records how a single request was sent."""
+
+    def __init__(self, stats: ConnectionStats) -> None:
+        self.stats = stats
+        self.connected = False
+
+    async def __call__(self, event_name: str, info: dict[str, Any]) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            self.stats.tcp_handshakes += 1
+            self.connected = True
+        elif event_name == "connection.start_tls.complete":
+            self.stats.tls_handshakes += 1
+        elif event_name.endswith(".send_request_headers.started"):
+            self.stats.requests += 1
+            if event_name.startswith("http2."):
+                self.stats.http2_requests += 1
+            if not self.connected:
+                self.stats.reused += 1
+
+
+class ClientRegistry:
+    """Share one pooled client between every upstream request.
+
+    The app lifespan opens the shared client with :meth:`open`, so
+    connections (and their TCP and TLS handshakes) are reused across
+    refreshes. Outside of the lifespan, e.g. in scripts and tests,
+    :meth:`client` falls back to a short-lived client.
+    """
+
+    def __init__(self, **kwargs) -> None:
+        # Default arguments to make_client
+        self._kwargs = kwargs
+        self._client: httpx.AsyncClient | None = None
+        self.stats = ConnectionStats()
+
+    @asynccontextmanager
+    async def open(self, **kwargs) -> AsyncGenerator[httpx.AsyncClient]:
+        """Open the shared client until the context exits."""
+        async with self._make_client(**kwargs) as client:
+            self._client = client
+            try:
+                yield client
+            finally:
+                self._client = None
+
+    @asynccontextmanager
+    async def client(self) -> AsyncGenerator[httpx.AsyncClient]:
+        """Yield the shared client if it's open, otherwise a short-lived one."""
+        if self._client is not None:
+            yield self._client
+            return
+        async with self._make_client() as client:
+            yield client
+
+    def _make_client(self, **kwargs) -> httpx.AsyncClient:
+        kwargs = {**self._kwargs, **kwargs}
+        # Trace requests as well as running any hooks the caller passed
+        event_hooks = kwargs.pop("event_hooks", None) or {}
+        event_hooks = {
+            **event_hooks,
+            "request": [*event_hooks.get("request", ()), self._trace],
+        }
+        return make_client(**kwargs, event_hooks=event_hooks)
+
+    async def _trace(self, request: httpx.Request) -> None:
+        request.extensions["trace"] = _ConnectionTracer(self.stats)
+
+
+clients = ClientRegistry()
+
+
+class ConditionalRequests:
+    """Send conditional GET requests using the validators of previous responses.
+
+    ETag and Last-Modified headers from successful responses are remembered
+    per URL and sent back as If-None-Match and If-Modified-Since, so that
+    unchanged resources come back as empty 304 responses.
+    """
+
+    def __init__(self) -> None:
+        self._validators: dict[str, dict[str, str]] = {}
+
+    async def get(self, client: httpx.AsyncClient, url: str) -> httpx.Response:
+        response = await client.get(url, headers=self._validators.get(url))
+        self._remember(url, response)
+        return response
+
+    @asynccontextmanager
+    async def stream(
+        self, client: httpx.AsyncClient, url: str
+    ) -> AsyncGenerator[httpx.Response]:
+        """Like :meth:`get`, but yield the response before its body is read."""
+        async with client.stream(
+            "GET", url, headers=self._validators.get(url)
+        ) as response:
+            self._remember(url, response)
+            yield response
+
+    def forget(self, url: str) -> None:
+        self._validators.pop(url, None)
+
+    def clear(self) -> None:
+        self._validators.clear()
+
+    def _remember(self, url: str, response: httpx.Response) -> None:
+        if response.is_success:
+            validators = {}
+            if etag := response.headers.get("etag"):
+                validators["If-None-Match"] = etag
+            if last_modified := response.headers.get("last-modified"):
+                validators["If-Modified-Since"] = last_modified
+            self._validators[url] = validators
+
+
+async def run_until[T](awaitable: Awaitable[T], *, deadline: float) -> T | None:
+    """Await ``awaitable``, giving up once the event loop clock reaches ``deadline``.
+
+    Returns None on timeout so that callers can degrade the same way they
+    do for upstream errors.
+    """
+    try:
+        async with asyncio.timeout_at(deadline):
+            return await awaitable
+    except TimeoutError:
+        logger.warning("upstream request exceeded deadline")
+        return None
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import asyncio
+import secrets
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+import structlog
+from redis.exceptions import RedisError
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from contextlib import AbstractAsyncContextManager
+
+    from redis.asyncio import Redis
+
+logger = structlog.get_logger()
+
+# Only touch the key if this process still holds it
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+@dataclass
+class LeaderElectionStats:
+    # Times this process became the leader
+    elected: int = 0
+    # Times this process stopped being the leader without being asked to,
+    # e.g. because it couldn't renew its lease in time
+    lost: int = 0
+    # Redis commands that failed
+    errors: int = 0
+
+
+class LeaderElection:
+    """Elect one of the processes sharing a Redis server as the leader.
+
+    The leader holds a lease (a key that expires after ``ttl`` seconds) and
+    renews it every third of the TTL. If the leader dies without releasing
+    the lease, another process takes over once it expires.
+    """
+
+    def __init__(self, redis: Redis, key: str, *, ttl: float = 15) -> None:
+        self.stats = LeaderElectionStats()
+        self.is_leader = False
+        self._redis = redis
+        self._key = key
+        self._ttl = ttl
+        # Identifies this process's lease
+        self._token = secrets.token_hex(16)
+        self._renew_script = redis.register_script(RENEW_SCRIPT)
+        self._release_script = redis.register_script(RELEASE_SCRIPT)
+
+    async def run(
+        self,
+        *,
+        lead: Callable[[], AbstractAsyncContextManager[object]],
+        follow: Callable[[], AbstractAsyncContextManager[object]],
+    ) -> None:
+        """Campaign for leadership until cancelled. The context managers
+        returned by ``lead`` and ``follow`` are entered while this process is
+        the leader and while it isn't, respectively.
+        """
+        interval = self._ttl / 3
+        log = logger.bind(key=self._key)
+        while True:
+            async with follow():
+                await self._campaign(interval)
+            self.is_leader = True
+            self.stats.elected += 1
+            log.info("elected leader")
+            try:
+                async with lead():
+                    await self._hold(interval)
+                self.stats.lost += 1
+                log.warning("lost leadership")
+            finally:
+                self.is_leader = False
+                await self._release()
+
+    async def _campaign(self, interval: float) -> None:
+        """Try to take the lease every ``interval`` seconds until it's taken."""
+        while True:
+            if await self._acquire():
+                return
+            await asyncio.sleep(interval)
+
+    async def _acquire(self) -> bool:
+        try:
+            return bool(
+                await self._redis.set(
+                    self._key, self._token, nx=True, px=int(self._ttl * 1000)
+                )
+            )
+        except RedisError:
+            self.stats.errors += 1
+            logger.warning("failed to campaign for leadership", exc_info=True)
+            return False
+
+    async def _hold(self, interval: float) -> None:
+        """Renew the lease until it's lost."""
+        loop = asyncio.get_running_loop()
+        renewed_at = loop.time()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                renewed = await self._renew_script(
+                    keys=[self._key], args=[self._token, int(self._ttl * 1000)]
+                )
+            except RedisError:
+                self.stats.errors += 1
+                logger.warning("failed to renew leadership", exc_info=True)
+                # Step down before the lease could expire and another
+                # process take over
+                if loop.time() + interval >= renewed_at + self._ttl:
+                    return
+                continue
+            if not renewed:
+                return
+            renewed_at = loop.time()
+
+    async def _release(self) -> None:
+        try:
+            await self._release_script(keys=[self._key], args=[self._token])
+        except RedisError:
+            self.stats.errors += 1
+            logger.warning("failed to release leadership", exc_info=True)
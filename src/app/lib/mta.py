@@ -1,14 +1,26 @@
 from __future__ import annotations
 
-import datetime as dt
+import asyncio
+import heapq
+import time
+from array import array
+from collections import defaultdict
 from dataclasses import dataclass, field
 from enum import IntEnum
+from functools import partial
+from itertools import islice, repeat
+from typing import TYPE_CHECKING
 
 import httpx
 import structlog
+from google.protobuf.message import DecodeError
 from google.transit import gtfs_realtime_pb2
 
-from .http import make_client
+from .http import ConditionalRequests, clients
+from .singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Sequence
 
 logger = structlog.get_logger()
 
@@ -60,6 +72,8 @@ FEED_TO_ROUTES_MAP = {
 ROUTE_TO_FEED_MAP = {
     route: suffix for suffix, routes in FEED_TO_ROUTES_MAP.items() for route in routes
 }
+# Number of seconds a parsed feed is shared between station lookups
+FEED_CACHE_TTL = 5.0
 
 
 def get_feed_url(route: str) -> str:
@@ -81,6 +95,32 @@ def _get_departure_time(
     return stop_time_update.arrival.time
 
 
+def _read_header_timestamp(content: bytes) -> int | None:
+    """Read ``header.timestamp`` from a serialized FeedMessage without
+    parsing the rest of the feed.
+
+    The header is field 1 of FeedMessage, which serializers write first.
+    Returns None if the header can't be found.
+    """
+    # Tag for field 1 with the length-delimited wire type
+    if not content or content[0] != 0x0A:
+        return None
+    length, shift, pos = 0, 0, 1
+    while pos < len(content):
+        byte = content[pos]
+        pos += 1
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    header = gtfs_realtime_pb2.FeedHeader()
+    try:
+        header.ParseFromString(content[pos : pos + length])
+    except DecodeError:
+        return None
+    return header.timestamp or None
+
+
 # Copied from https://gtfs.org/documentation/realtime/proto/
 class AlertCause(IntEnum):
     UNKNOWN_CAUSE = 1
@@ -133,89 +173,377 @@ class TrainDeparture:
     # Whether there are service alerts for delays for this train
     # This is for convenience so we don't have to check the alerts list
     has_delays: bool = False
-    wait_time_minutes: float | None = None
 
-    def __post_init__(self):
-        if self.wait_time_minutes is None:
-            now = dt.datetime.now(tz=dt.UTC).timestamp()
-            self.wait_time_minutes = max(0, (self.time - now) / 60)
+    def wait_time_minutes(self, now: float) -> int:
+        """Number of whole minutes until departure, as of ``now`` (a Unix time)."""
+        return max(0, int((self.time - now) // 60))
 
 
 @dataclass
 class TrainStationData:
     station_id: str
+    routes: list[str] = field(default_factory=list)
     alerts: list[ServiceAlert] = field(default_factory=list)
     departures: list[TrainDeparture] = field(default_factory=list)
 
 
-async def get_station_data(
-    station_id: str, routes: set[str]
-) -> TrainStationData | None:
-    """Fetch train arrival timestamps and service alerts for specified routes at a station.
+# Bit layout of the sort keys used to build ParsedFeed's departure times:
+# stop code | 16-bit route code | 40-bit departure time
+_TIME_BITS = 40
+_TIME_MASK = (1 << _TIME_BITS) - 1
+_STOP_SHIFT = _TIME_BITS + 16
+
+
+def _route_code(key: int) -> int:
+    return (key >> _TIME_BITS) & 0xFFFF
 
-    Returns None if the upstream feeds cannot be fetched.
+
+@dataclass
+class ParsedFeed:
+    """A parsed GTFS-realtime feed in a compact form.
+
+    Trip updates are flattened into one array of departure times, sorted by
+    (stop, route, time), so that each stop and route pair is a contiguous run
+    of the array. Route and stop IDs are interned into codes that index the
+    runs. The protobuf object graph isn't kept once the array is built.
     """
-    feed_urls = {get_feed_url(route) for route in routes}
-    station_data = TrainStationData(station_id=station_id)
 
-    try:
-        async with make_client() as client:
-            # Fetch service alerts
-            alerts_response = await client.get(MTA_SUBWAY_ALERTS_URL)
-            if alerts_response.is_success:
-                alerts_feed = gtfs_realtime_pb2.FeedMessage()
-                alerts_feed.ParseFromString(alerts_response.content)
-
-                for entity in alerts_feed.entity:
-                    if entity.HasField("alert"):
-                        for informed_entity in entity.alert.informed_entity:
-                            if informed_entity.route_id in routes:
-                                alert = ServiceAlert(
-                                    route=informed_entity.route_id,
-                                    # Get alert text in English
-                                    alert_text=entity.alert.header_text.translation[
-                                        0
-                                    ].text,
-                                    # Return cause and effect as strings rather than ints
-                                    cause=AlertCause(entity.alert.cause).name,
-                                    effect=AlertEffect(entity.alert.effect).name,
-                                )
-                                station_data.alerts.append(alert)
-            routes_with_delays = {
-                alert.route for alert in station_data.alerts if alert.is_delay
-            }
-            # Fetch train times
-            for feed_url in feed_urls:
-                response = await client.get(feed_url)
-                if not response.is_success:
-                    logger.warning(
-                        "failed to fetch feed %s (status_code=%s). skipping...",
-                        feed_url,
-                        response.status_code,
+    # header.timestamp of the feed
+    timestamp: int = 0
+    # Interned route and stop IDs
+    route_ids: list[str] = field(default_factory=list)
+    stop_ids: list[str] = field(default_factory=list)
+    # Departure times, one per stop time update
+    times: array[int] = field(default_factory=lambda: array("q"))
+    # route_id -> service alerts affecting the route
+    alerts: dict[str, list[ServiceAlert]] = field(default_factory=dict)
+    # (stop code, route code) -> (start, end) of its run in ``times``
+    _runs: dict[tuple[int, int], tuple[int, int]] = field(
+        default_factory=dict, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        self._route_index = {route_id: i for i, route_id in enumerate(self.route_ids)}
+        self._stop_index = {stop_id: i for i, stop_id in enumerate(self.stop_ids)}
+
+    @classmethod
+    def from_message(cls, message: gtfs_realtime_pb2.FeedMessage) -> ParsedFeed:
+        route_index: dict[str, int] = {}
+        stop_index: dict[str, int] = {}
+        # Each stop time update is packed into a single int that sorts by
+        # (stop, route, time), which is much cheaper to sort than tuples
+        keys: list[int] = []
+        alerts: defaultdict[str, list[ServiceAlert]] = defaultdict(list)
+        for entity in message.entity:
+            if entity.HasField("trip_update"):
+                route_id = entity.trip_update.trip.route_id
+                route_code = route_index.setdefault(route_id, len(route_index))
+                route_bits = route_code << _TIME_BITS
+                for stop_time_update in entity.trip_update.stop_time_update:
+                    stop_code = stop_index.get(stop_time_update.stop_id)
+                    if stop_code is None:
+                        stop_code = stop_index[stop_time_update.stop_id] = len(
+                            stop_index
+                        )
+                    keys.append(
+                        stop_code << _STOP_SHIFT
+                        | route_bits
+                        | _get_departure_time(stop_time_update)
                     )
-                    continue
-
-                feed = gtfs_realtime_pb2.FeedMessage()
-                feed.ParseFromString(response.content)
-
-                station_data.departures.extend(
-                    [
-                        TrainDeparture(
-                            route=entity.trip_update.trip.route_id,
-                            time=_get_departure_time(stop_time_update),
-                            has_delays=entity.trip_update.trip.route_id
-                            in routes_with_delays,
+            # Alerts without header text have nothing to show
+            if entity.HasField("alert") and entity.alert.header_text.translation:
+                for informed_entity in entity.alert.informed_entity:
+                    alerts[informed_entity.route_id].append(
+                        ServiceAlert(
+                            route=informed_entity.route_id,
+                            # Get alert text in English
+                            alert_text=entity.alert.header_text.translation[0].text,
+                            # Return cause and effect as strings rather than ints
+                            cause=AlertCause(entity.alert.cause).name,
+                            effect=AlertEffect(entity.alert.effect).name,
                         )
-                        for entity in feed.entity
-                        if entity.HasField("trip_update")
-                        and entity.trip_update.trip.route_id in routes
-                        for stop_time_update in entity.trip_update.stop_time_update
-                        if stop_time_update.stop_id == station_id
-                    ]
-                )
-    except httpx.HTTPError as exc:
-        logger.warning("failed to fetch station data for %s: %s", station_id, exc)
+                    )
+        keys.sort()
+
+        # Each stop and route pair is now a contiguous run of sorted times
+        runs: dict[tuple[int, int], tuple[int, int]] = {}
+        start = 0
+        for i in range(1, len(keys) + 1):
+            if i == len(keys) or keys[i] >> _TIME_BITS != keys[start] >> _TIME_BITS:
+                runs[keys[start] >> _STOP_SHIFT, _route_code(keys[start])] = (start, i)
+                start = i
+
+        return cls(
+            timestamp=message.header.timestamp,
+            route_ids=list(route_index),
+            stop_ids=list(stop_index),
+            times=array("q", [key & _TIME_MASK for key in keys]),
+            alerts=dict(alerts),
+            _runs=runs,
+        )
+
+    def departure_times(self, stop_id: str, route_id: str) -> array[int]:
+        """Return sorted departure times from ``stop_id`` on ``route_id``."""
+        stop_code = self._stop_index.get(stop_id)
+        route_code = self._route_index.get(route_id)
+        if stop_code is None or route_code is None:
+            return array("q")
+        run = self._runs.get((stop_code, route_code))
+        if run is None:
+            return array("q")
+        return self.times[run[0] : run[1]]
+
+    def next_departures(
+        self, stop_id: str, routes: Iterable[str], *, limit: int | None = None
+    ) -> list[tuple[int, str]]:
+        """Return (time, route_id) for the next ``limit`` departures from
+        ``stop_id`` on any of ``routes``, sorted by time.
+        """
+        merged = heapq.merge(
+            *(
+                zip(self.departure_times(stop_id, route), repeat(route), strict=False)
+                for route in routes
+            )
+        )
+        return list(islice(merged, limit))
+
+
+@dataclass
+class FeedCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Upstream responded 304 Not Modified to a conditional request
+    not_modified: int = 0
+    # Response bytes not downloaded thanks to 304 responses
+    bytes_saved: int = 0
+    # Fetched feeds that weren't parsed because the feed hadn't advanced
+    parses_skipped: int = 0
+
+
+class FeedCache:
+    """Parsed GTFS-realtime feeds keyed by URL.
+
+    Each feed is fetched and parsed at most once per ``ttl`` seconds, so
+    lookups for multiple stations within the same refresh window share
+    a single parsed and indexed feed. Concurrent lookups of a feed that is
+    still being fetched wait on the same in-flight request.
+
+    Once the window has passed, feeds are re-requested conditionally. If the
+    upstream responds 304 Not Modified or the feed's header timestamp hasn't
+    advanced, the previously parsed feed is reused without parsing.
+    """
+
+    def __init__(self, ttl: float = FEED_CACHE_TTL) -> None:
+        self.ttl = ttl
+        self.stats = FeedCacheStats()
+        self._feeds: dict[str, tuple[float, asyncio.Future[ParsedFeed | None]]] = {}
+        # Most recent successfully parsed feed (and its size in bytes) for each URL
+        self._latest: dict[str, tuple[ParsedFeed, int]] = {}
+        self._requests = ConditionalRequests()
+
+    async def get(self, client: httpx.AsyncClient, url: str) -> ParsedFeed | None:
+        """Return the parsed feed at ``url``, fetching it if it isn't cached.
+
+        Returns None if the upstream responds with an error status.
+        """
+        now = time.monotonic()
+        cached = self._feeds.get(url)
+        if cached is not None and now - cached[0] < self.ttl:
+            self.stats.hits += 1
+            future = cached[1]
+        else:
+            self.stats.misses += 1
+            future = asyncio.ensure_future(self._fetch(client, url))
+            self._feeds[url] = (now, future)
+            future.add_done_callback(partial(self._evict_failed, url))
+        # Shield the shared fetch so that a caller hitting its deadline
+        # doesn't cancel the request for everyone else
+        return await asyncio.shield(future)
+
+    def clear(self) -> None:
+        self._feeds.clear()
+        self._latest.clear()
+        self._requests.clear()
+
+    async def _fetch(self, client: httpx.AsyncClient, url: str) -> ParsedFeed | None:
+        response = await self._requests.get(client, url)
+        latest = self._latest.get(url)
+        if response.status_code == httpx.codes.NOT_MODIFIED:
+            if latest is None:
+                # Nothing to reuse; make the next request unconditional
+                self._requests.forget(url)
+                return None
+            self.stats.not_modified += 1
+            self.stats.bytes_saved += latest[1]
+            self.stats.parses_skipped += 1
+            return latest[0]
+        if not response.is_success:
+            logger.warning(
+                "failed to fetch feed %s (status_code=%s). skipping...",
+                url,
+                response.status_code,
+            )
+            return None
+        content = response.content
+        if latest is not None:
+            timestamp = _read_header_timestamp(content)
+            if timestamp and timestamp <= latest[0].timestamp:
+                self.stats.parses_skipped += 1
+                return latest[0]
+        message = gtfs_realtime_pb2.FeedMessage()
+        message.ParseFromString(content)
+        feed = ParsedFeed.from_message(message)
+        self._latest[url] = (feed, len(content))
+        return feed
+
+    def _evict_failed(
+        self, url: str, future: asyncio.Future[ParsedFeed | None]
+    ) -> None:
+        # Don't hold on to failures; the next lookup should retry
+        if future.cancelled() or future.exception() or future.result() is None:
+            cached = self._feeds.get(url)
+            if cached is not None and cached[1] is future:
+                del self._feeds[url]
+
+
+feed_cache = FeedCache()
+
+
+@dataclass(frozen=True)
+class StationConfig:
+    station_id: str
+    routes: frozenset[str]
+
+    @property
+    def feed_urls(self) -> set[str]:
+        return {get_feed_url(route) for route in self.routes}
+
+
+def _get_station_data(
+    station: StationConfig,
+    alerts_feed: ParsedFeed | None,
+    feeds: dict[str, ParsedFeed],
+) -> TrainStationData | None:
+    station_feeds = [feeds[url] for url in sorted(station.feed_urls) if url in feeds]
+    if not station_feeds:
+        logger.warning("failed to fetch station data for %s", station.station_id)
         return None
 
+    station_data = TrainStationData(
+        station_id=station.station_id, routes=sorted(station.routes)
+    )
+    if alerts_feed is not None:
+        station_data.alerts = [
+            alert
+            for route in sorted(station.routes)
+            for alert in alerts_feed.alerts.get(route, [])
+        ]
+    routes_with_delays = {
+        alert.route for alert in station_data.alerts if alert.is_delay
+    }
+    station_data.departures = [
+        TrainDeparture(
+            route=route,
+            time=departure_time,
+            has_delays=route in routes_with_delays,
+        )
+        for feed in station_feeds
+        for departure_time, route in feed.next_departures(
+            station.station_id, station.routes
+        )
+    ]
     station_data.departures.sort(key=lambda lt: lt.time)
     return station_data
+
+
+stations_flight: SingleFlight[
+    tuple[StationConfig, ...], list[TrainStationData | None]
+] = SingleFlight()
+
+
+async def get_stations_data(
+    stations: Sequence[StationConfig],
+    *,
+    client: httpx.AsyncClient | None = None,
+    deadline: float | None = None,
+) -> list[TrainStationData | None]:
+    """Fetch train arrival timestamps and service alerts for multiple stations.
+
+    The alerts feed and the union of the stations' route feeds are fetched
+    concurrently, each one once, and shared with other lookups through
+    ``feed_cache``. Pass ``client`` to issue the requests through an existing
+    client (and its connection limits).
+
+    Each feed is given up on once the event loop clock reaches ``deadline``,
+    so a slow feed only fails the stations that use it (or only drops the
+    alerts).
+
+    Concurrent calls for the same stations share one in-flight fetch.
+
+    Returns data in the same order as ``stations``, with None for stations
+    whose route feeds couldn't be fetched.
+    """
+    key = tuple(stations)
+    return await stations_flight.do(
+        key, lambda: _fetch_stations_data(key, client=client, deadline=deadline)
+    )
+
+
+async def _fetch_stations_data(
+    stations: Sequence[StationConfig],
+    *,
+    client: httpx.AsyncClient | None,
+    deadline: float | None,
+) -> list[TrainStationData | None]:
+    if client is None:
+        async with clients.client() as own_client:
+            return await _fetch_stations_data(
+                stations, client=own_client, deadline=deadline
+            )
+
+    async def get_feed(url: str) -> ParsedFeed | None:
+        async with asyncio.timeout_at(deadline):
+            return await feed_cache.get(client, url)
+
+    feed_urls = sorted(set().union(*(station.feed_urls for station in stations)))
+    alerts_result, *feed_results = await asyncio.gather(
+        get_feed(MTA_SUBWAY_ALERTS_URL),
+        *(get_feed(feed_url) for feed_url in feed_urls),
+        return_exceptions=True,
+    )
+    for url, result in zip(
+        [MTA_SUBWAY_ALERTS_URL, *feed_urls], [alerts_result, *feed_results], strict=True
+    ):
+        # A feed that can't be fetched or parsed in time only fails the
+        # stations that use it
+        if isinstance(result, TimeoutError):
+            logger.warning("feed %s exceeded deadline", url)
+        elif isinstance(result, Exception):
+            logger.warning("failed to fetch feed %s: %r", url, result)
+        elif isinstance(result, BaseException):
+            raise result
+
+    feeds = {
+        url: feed
+        for url, feed in zip(feed_urls, feed_results, strict=True)
+        if isinstance(feed, ParsedFeed)
+    }
+    alerts_feed = alerts_result if isinstance(alerts_result, ParsedFeed) else None
+    return [_get_station_data(station, alerts_feed, feeds) for station in stations]
+
+
+async def get_station_data(
+    station_id: str,
+    routes: set[str],
+    *,
+    client: httpx.AsyncClient | None = None,
+) -> TrainStationData | None:
+    """Fetch train arrival timestamps and service alerts for specified routes at a station.
+
+    Returns None if none of the route feeds can be fetched.
+    """
+    [station_data] = await get_stations_data(
+        [StationConfig(station_id=station_id, routes=frozenset(routes))],
+        client=client,
+    )
+    return station_data
@@ -0,0 +1,543 @@
+"""Render the trains_and_bikes.star layout in-process, without pixlet.
+
+Draws the frames that pixlet draws for the applet into 64x32 NumPy frame
+buffers and encodes them as an animated WebP with Pillow. The drawing follows
+pixlet's: text uses the tb-8 bitmap font, route badges use the coverage that
+pixlet's rasterizer gives a 10px circle, weather icons are scaled with the
+same nearest-neighbour resampling, and the bike moves along the same curve.
+
+The font's glyphs were taken from pixlet's renders, so only the characters
+that the applet has been seen to draw are known. Data that needs any other
+glyph, or that overflows the layout, raises :class:`UnsupportedDataError`, so
+that it can be rendered with pixlet instead.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import functools
+import io
+import json
+import math
+import re
+from typing import TYPE_CHECKING, Any, Literal, overload
+
+import numpy as np
+from PIL import Image
+
+from .tidbyt import RenderError
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Mapping
+
+    from numpy.typing import NDArray
+
+WIDTH = 64
+HEIGHT = 32
+# Pixlet renders the applet's 80-frame animation at 50ms per frame
+NUM_FRAMES = 80
+FRAME_DURATION_MS = 50
+
+Color = tuple[int, int, int]
+
+
+def _hex_color(value: str) -> Color:
+    value = value.lstrip("#")
+    if len(value) == 3:
+        value = "".join(c * 2 for c in value)
+    return (int(value[0:2], 16), int(value[2:4], 16), int(value[4:6], 16))
+
+
+WHITE = _hex_color("#FFF")
+DARK_GRAY = _hex_color("#1C1C1C")
+GRAY = _hex_color("#AFAFAF")
+ORANGE = _hex_color("#FFA500")
+COLOR_COLD = _hex_color("#b9ecff")
+COLOR_HOT = _hex_color("#ff5252")
+
+COLORS_FOR_ROUTES = {
+    "#0039a6": ("A", "C", "E"),
+    "#ff6319": ("B", "D", "F", "M"),
+    "#6cbe45": ("G",),
+    "#8fa5a1": ("J", "Z"),
+    "#fccc0a": ("N", "Q", "R", "W"),
+    "#a7a9ac": ("L",),
+    "#ee352e": ("1", "2", "3"),
+    "#00933c": ("4", "5", "6"),
+    "#b933ad": ("7",),
+    "#808183": ("S", "SR", "SF"),
+    "#0078c6": ("SIR",),
+}
+ROUTE_COLORS = {
+    route: _hex_color(color)
+    for color, routes in COLORS_FOR_ROUTES.items()
+    for route in routes
+}
+
+CONDITION_ICONS = {
+    "clear": "sunny.png",
+    "clear_night": "moony.png",
+    "cloudy": "cloudy.png",
+    "cloudy_night": "moony.png",
+    "fog": "foggy.png",
+    "mostly_sunny": "sunnyish.png",
+    "rainy": "rainy.png",
+    "snowy": "snowy.png",
+    "sunny": "sunny.png",
+    "thunderstorm": "thundery.png",
+}
+
+# tb-8 glyphs, one string per row of the 8px line, "#" for a set pixel. Each
+# glyph is as wide as its advance.
+FONT_HEIGHT = 8
+GLYPHS = {
+    " ": "... ... ... ... ... ... ... ...",
+    "-": ".... .... .... .... ###. .... .... ....",
+    "°": ".#.. #.#. .#.. .... .... .... .... ....",
+    "0": "..... ..#.. .#.#. .#.#. .#.#. .#.#. ..#.. .....",
+    "1": "..... ..#.. .##.. ..#.. ..#.. ..#.. .###. .....",
+    "2": "..... .##.. #..#. ...#. .##.. #.... ####. .....",
+    "3": "..... ####. ..#.. .##.. ...#. #..#. .##.. .....",
+    "4": "..... ..#.. .##.. #.#.. ####. ..#.. ..#.. .....",
+    "5": "..... ####. #.... ###.. ...#. #..#. .##.. .....",
+    "6": "..... .##.. #.... ###.. #..#. #..#. .##.. .....",
+    "8": "..... .##.. #..#. .##.. #..#. #..#. .##.. .....",
+    "9": "..... .##.. #..#. #..#. .###. ...#. .##.. .....",
+    "B": "..... ###.. #..#. ###.. #..#. #..#. ###.. .....",
+    "N": "..... #..#. ##.#. ####. #.##. #.##. #..#. .....",
+    "Q": "..... .##.. #..#. #..#. ##.#. #.##. .##.. ...#.",
+    "a": "..... ..... ..... .###. #..#. #..#. .###. .....",
+    "c": ".... .... .... .##. #... #... .##. ....",
+    "d": "..... ...#. ...#. .###. #..#. #..#. .###. .....",
+    "e": "..... ..... ..... .##.. #.##. ##... .##.. .....",
+    "h": "..... #.... #.... ###.. #..#. #..#. #..#. .....",
+    "i": ".... .#.. .... ##.. .#.. .#.. ###. ....",
+    "l": ".... ##.. .#.. .#.. .#.. .#.. ###. ....",
+    "m": "...... ...... ...... ##.#.. #.#.#. #.#.#. #.#.#. ......",
+    "n": "..... ..... ..... ###.. #..#. #..#. #..#. .....",
+    "o": "..... ..... ..... .##.. #..#. #..#. .##.. .....",
+    "r": "..... ..... ..... #.#.. ##.#. #.... #.... .....",
+    "s": ".... .... .... .##. ##.. ..#. ##.. ....",
+    "t": "..... .#... .#... ###.. .#... .#.#. ..#.. .....",
+    "u": "..... ..... ..... #..#. #..#. #..#. .###. .....",
+}
+_GLYPH_MASKS = {
+    char: np.array([[c == "#" for c in row] for row in rows.split()])
+    for char, rows in GLYPHS.items()
+}
+
+# 12-bit coverage of each pixel of a 10px circle, as pixlet's rasterizer
+# fills it
+BADGE_DIAMETER = 10
+BADGE_COVERAGE = np.array(
+    [
+        [0, 0, 1235, 3073, 3901, 3898, 3073, 1211, 0, 0],
+        [0, 2142, 4095, 4095, 4095, 4095, 4095, 4093, 2108, 0],
+        [1240, 4095, 4095, 4095, 4095, 4095, 4095, 4095, 4094, 1210],
+        [3073, 4095, 4095, 4095, 4095, 4095, 4095, 4095, 4095, 3041],
+        [3901, 4095, 4095, 4095, 4095, 4095, 4095, 4095, 4095, 3900],
+        [3898, 4095, 4095, 4095, 4095, 4095, 4095, 4095, 4095, 3897],
+        [3073, 4095, 4095, 4095, 4095, 4095, 4095, 4095, 4095, 3041],
+        [1211, 4093, 4095, 4095, 4095, 4095, 4095, 4095, 4090, 1182],
+        [0, 2108, 4094, 4095, 4095, 4095, 4095, 4091, 2074, 0],
+        [0, 0, 1210, 3041, 3900, 3897, 3041, 1187, 0, 0],
+    ],
+    dtype=np.int64,
+)
+
+# Space for the bike animation, and where it starts and stops
+BIKE_BOX_WIDTH = 18
+BIKE_START_X = -12
+BIKE_END_X = 5
+# Fraction of the animation over which the bike moves
+BIKE_MOVE_END = 0.3
+WEATHER_ICON_SIZE = 8
+
+_IMAGE_RE = re.compile(r'(\w+) = base64\.decode\("([^"]+)"\)')
+_WEATHER_ICON_RE = re.compile(r'"(\w+\.png)": base64\.decode\("""\s*(\S+)\s*"""\)')
+
+
+class UnsupportedDataError(RenderError):
+    """Raised when the native renderer can't draw data the way pixlet does."""
+
+
+def _ease_out(t: float) -> float:
+    """Pixlet's ease_out curve, a cubic Bézier with control points (0, 0)
+    and (0, 1).
+    """
+
+    def bezier(p1: float, p2: float, s: float) -> float:
+        return 3 * (1 - s) ** 2 * s * p1 + 3 * (1 - s) * s * s * p2 + s**3
+
+    lo, hi = 0.0, 1.0
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        if bezier(0, 0, mid) < t:
+            lo = mid
+        else:
+            hi = mid
+    return bezier(0, 1, (lo + hi) / 2)
+
+
+def _round_half_away(value: float) -> int:
+    return int(math.copysign(math.floor(abs(value) + 0.5), value))
+
+
+# x of the bike in each frame
+BIKE_POSITIONS = [
+    _round_half_away(
+        BIKE_START_X
+        + (BIKE_END_X - BIKE_START_X)
+        * _ease_out(min(i / (NUM_FRAMES - 1) / BIKE_MOVE_END, 1))
+    )
+    for i in range(NUM_FRAMES)
+]
+
+
+def _decode_png(data: str) -> NDArray[np.uint8]:
+    with Image.open(io.BytesIO(base64.b64decode(data))) as image:
+        return np.asarray(image.convert("RGBA"))
+
+
+def _resize_nearest(image: NDArray[np.uint8], size: int) -> NDArray[np.uint8]:
+    """Scale a square image like pixlet does, which averages the source pixels
+    nearest to each target pixel, one axis at a time.
+    """
+
+    def resize_axis(pixels: NDArray[np.uint8]) -> NDArray[np.uint8]:
+        # Resizes the rows of ``pixels``, returning them transposed
+        src_size = pixels.shape[1]
+        scale = src_size / size
+        filter_length = 2 * max(math.ceil(scale), 1)
+        factor = min(1 / scale, 1)
+        out = np.empty((size, pixels.shape[0], 4), dtype=np.uint8)
+        for y in range(size):
+            center = scale * (y + 0.5) - 0.5
+            start = int(center) - filter_length // 2 + 1
+            indices = [
+                min(max(start + i, 0), src_size - 1)
+                for i in range(filter_length)
+                if -0.5 <= (center - start - i) * factor < 0.5
+            ]
+            total = pixels[:, indices].astype(np.float32).sum(axis=1)
+            mean = total / np.float32(len(indices))
+            out[y] = np.where(mean > 254, 255, mean).astype(np.uint8)
+        return out
+
+    return resize_axis(resize_axis(image))
+
+
+class _Canvas:
+    def __init__(self) -> None:
+        self.pixels = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+
+    def paste(self, image: NDArray[np.uint8], x: int, y: int) -> None:
+        """Draw ``image`` with its top-left corner at (x, y), clipped to the
+        canvas. Only opaque pixels are drawn, as the applet's images have no
+        partly transparent ones.
+        """
+        height, width = image.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + width, WIDTH), min(y + height, HEIGHT)
+        if x0 >= x1 or y0 >= y1:
+            return
+        part = image[y0 - y : y1 - y, x0 - x : x1 - x]
+        region = self.pixels[y0:y1, x0:x1]
+        if part.shape[2] == 4:
+            mask = part[..., 3] > 0
+            region[mask] = part[..., :3][mask]
+        else:
+            region[:] = part
+
+    def text(self, content: str, x: int, y: int, color: Color) -> None:
+        for char in content:
+            mask = _GLYPH_MASKS[char]
+            glyph = np.zeros((*mask.shape, 4), dtype=np.uint8)
+            glyph[mask] = (*color, 255)
+            self.paste(glyph, x, y)
+            x += mask.shape[1]
+
+
+def _text_width(content: str) -> int:
+    """Return the width of ``content`` in tb-8, raising UnsupportedDataError
+    if it has a character whose glyph isn't known.
+    """
+    unknown = set(content) - _GLYPH_MASKS.keys()
+    if unknown:
+        msg = f"no glyph for {''.join(sorted(unknown))!r}"
+        raise UnsupportedDataError(msg)
+    return sum(_GLYPH_MASKS[char].shape[1] for char in content)
+
+
+def _wrap_text(content: str, width: int) -> list[str]:
+    """Split ``content`` into lines no wider than ``width``, like pixlet's
+    WrappedText does.
+    """
+    lines = []
+    line = ""
+    for word in content.split(" "):
+        if line and _text_width(line + word) > width:
+            lines.append(line.strip())
+            line = ""
+        line += word + " "
+    lines.append(line.strip())
+    if any(_text_width(line) > width for line in lines):
+        msg = f"{content!r} doesn't fit in {width}px"
+        raise UnsupportedDataError(msg)
+    return lines
+
+
+def _space_around(widths: Iterable[int], available: int) -> list[int]:
+    """Return the x of each child of a space_around row."""
+    widths = list(widths)
+    remaining = available - sum(widths)
+    if remaining < 0:
+        msg = f"row of {widths} doesn't fit in {available}px"
+        raise UnsupportedDataError(msg)
+    spacing = remaining / len(widths)
+    offset = spacing / 2
+    positions = []
+    for width in widths:
+        positions.append(math.ceil(offset))
+        offset += width + spacing
+    return positions
+
+
+class NativeRenderer:
+    """Render the trains_and_bikes.star applet at ``path`` in-process.
+
+    Takes the same config as the applet, but needs the transit data (and
+    weather data, if any) to be passed in it rather than fetched. The
+    applet's images are read from its source when first needed.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+
+    @functools.cached_property
+    def _images(self) -> dict[str, NDArray[np.uint8]]:
+        with open(self._path, encoding="utf-8") as f:
+            source = f.read()
+        images = {name: _decode_png(data) for name, data in _IMAGE_RE.findall(source)}
+        for name, data in _WEATHER_ICON_RE.findall(source):
+            images[name] = _resize_nearest(_decode_png(data), WEATHER_ICON_SIZE)
+        return images
+
+    @functools.cached_property
+    def _badges(self) -> dict[str, NDArray[np.uint8]]:
+        """The badge for each route whose name can be drawn."""
+        # Circle color over black, weighted by the 16-bit coverage
+        coverage = (BADGE_COVERAGE << 4 | BADGE_COVERAGE >> 8)[..., np.newaxis]
+        badges = {}
+        for route, color in ROUTE_COLORS.items():
+            try:
+                width = _text_width(route)
+            except UnsupportedDataError:
+                continue
+            canvas = _Canvas()
+            canvas.pixels[:BADGE_DIAMETER, :BADGE_DIAMETER] = (
+                np.array(color, dtype=np.int64) * 0x101 * coverage // 0xFFFF >> 8
+            )
+            text_color = DARK_GRAY if route in {"N", "Q", "R", "W"} else WHITE
+            canvas.text(
+                route,
+                math.ceil((BADGE_DIAMETER - width) / 2),
+                (BADGE_DIAMETER - FONT_HEIGHT) // 2,
+                text_color,
+            )
+            badges[route] = canvas.pixels[:BADGE_DIAMETER, :BADGE_DIAMETER].copy()
+        return badges
+
+    @overload
+    async def render(
+        self,
+        *,
+        config: Mapping[str, str] | None = None,
+        as_bytes: Literal[False] = False,
+    ) -> str: ...
+
+    @overload
+    async def render(
+        self, *, config: Mapping[str, str] | None = None, as_bytes: Literal[True]
+    ) -> bytes: ...
+
+    async def render(
+        self, *, config: Mapping[str, str] | None = None, as_bytes: bool = False
+    ) -> bytes | str:
+        """Render the applet to a webp image, like ``render_applet``."""
+        config = config or {}
+        if not config.get("transit_data"):
+            msg = "the native renderer needs transit_data in the config"
+            raise UnsupportedDataError(msg)
+        transit_data = json.loads(config["transit_data"])
+        weather_data = json.loads(config.get("weather_data") or "null")
+        output_bytes = await asyncio.to_thread(
+            self.render_data, transit_data, weather_data
+        )
+        if as_bytes:
+            return output_bytes
+        return base64.b64encode(output_bytes).decode("utf-8")
+
+    def render_data(
+        self, transit_data: dict[str, Any], weather_data: dict[str, Any] | None
+    ) -> bytes:
+        """Render the applet with decoded transit and weather API responses."""
+        canvas = _Canvas()
+        trains_height = self._draw_trains(canvas, transit_data["trains"])
+        # The bikes and weather take the rest of the height
+        top = 1 + trains_height
+        # The bike counts are 1px below the top
+        if top + 1 + FONT_HEIGHT > HEIGHT:
+            msg = f"trains are {trains_height}px high, leaving no room for bikes"
+            raise UnsupportedDataError(msg)
+        bikes_width = self._draw_bike_counts(canvas, transit_data["citibike"], top)
+        if weather_data and weather_data["data"]:
+            self._draw_weather(canvas, weather_data, top, bikes_width)
+        frames = []
+        for x in BIKE_POSITIONS:
+            frame = _Canvas()
+            frame.pixels[:] = canvas.pixels
+            frame.paste(self._images["IMAGE_BIKE"], x, top)
+            frames.append(frame.pixels)
+        return _encode_webp(frames)
+
+    def _draw_trains(self, canvas: _Canvas, trains: list[dict[str, Any]]) -> int:
+        """Draw the departures, returning the height they take."""
+        left, top, available = 2, 1, WIDTH - 4
+        if not any(station["departures"] for station in trains):
+            lines = _wrap_text("No trains scheduled", available)
+            width = max(_text_width(line) for line in lines)
+            height = 22
+            x = left + (available - width) // 2
+            y = top + (height - FONT_HEIGHT * len(lines)) // 2
+            for i, line in enumerate(lines):
+                canvas.text(line, x, y + i * FONT_HEIGHT, ORANGE)
+            return height
+
+        column_width = (WIDTH - 8) // len(trains)
+        columns = [self._station_column(station, column_width) for station in trains]
+        positions = _space_around((width for width, _, _ in columns), available)
+        for x, (_, _, draw) in zip(positions, columns, strict=True):
+            draw(canvas, left + x, top)
+        return max(height for _, height, _ in columns)
+
+    def _station_column(
+        self, station: dict[str, Any], column_width: int
+    ) -> tuple[int, int, Callable[[_Canvas, int, int], None]]:
+        """Return the width and height of a station's column, and a function
+        that draws it at (x, y).
+        """
+        departures = station["departures"]
+        if not departures:
+            content = "No {} trains".format("-".join(station["routes"]))
+            lines = _wrap_text(content, column_width)
+
+            def draw_no_trains(canvas: _Canvas, x: int, y: int) -> None:
+                for i, line in enumerate(lines):
+                    canvas.text(line, x, y + i * FONT_HEIGHT, ORANGE)
+
+            return column_width, FONT_HEIGHT * len(lines), draw_no_trains
+
+        rows = []
+        for departure in departures[:2]:
+            route = departure["route"]
+            if route not in self._badges:
+                msg = f"no badge for route {route!r}"
+                raise UnsupportedDataError(msg)
+            wait_time = f"{int(departure['wait_time_minutes'])}m"
+            color = ORANGE if departure["has_delays"] else WHITE
+            rows.append((self._badges[route], wait_time, color))
+        width = max(BADGE_DIAMETER + 2 + _text_width(text) for _, text, _ in rows)
+        # The second departure is padded by 1px
+        height = len(rows) * (BADGE_DIAMETER + 1) - 1
+
+        def draw_departures(canvas: _Canvas, x: int, y: int) -> None:
+            for i, (badge, text, color) in enumerate(rows):
+                row_y = y + i * (BADGE_DIAMETER + 1)
+                canvas.paste(badge, x, row_y)
+                canvas.text(text, x + BADGE_DIAMETER + 2, row_y + 1, color)
+
+        return width, height, draw_departures
+
+    def _draw_bike_counts(
+        self, canvas: _Canvas, bike_data: dict[str, Any], top: int
+    ) -> int:
+        """Draw the bike counts, returning the width of the bikes, including
+        the space for the animation.
+        """
+        x = BIKE_BOX_WIDTH
+        lightning = self._images["IMAGE_LIGHTNING"]
+        regular, ebike = int(bike_data["regular"]), int(bike_data["ebike"])
+        regular_text, ebike_text = str(regular), str(ebike)
+        regular_width, ebike_width = _text_width(regular_text), _text_width(ebike_text)
+        canvas.text(regular_text, x, top + 1, WHITE if regular > 0 else GRAY)
+        x += regular_width
+        # The lightning is padded by 2px above and 1px to the right
+        canvas.paste(lightning, x, top + 1 + 2)
+        x += lightning.shape[1] + 1
+        canvas.text(ebike_text, x, top + 1, WHITE if ebike > 0 else GRAY)
+        return x + ebike_width
+
+    def _draw_weather(
+        self,
+        canvas: _Canvas,
+        weather_data: dict[str, Any],
+        top: int,
+        bikes_width: int,
+    ) -> None:
+        current_weather = weather_data["data"]
+        if weather_data["meta"]["requested_temperature_unit"] == "F":
+            temperature = current_weather["temperature_fahrenheit"]
+        else:
+            temperature = current_weather["temperature_celsius"]
+        text = f"{_round_half_away(temperature)}°"
+        temperature_celsius = current_weather["temperature_celsius"]
+        if temperature_celsius < 0:
+            color = COLOR_COLD
+        elif temperature_celsius >= 30:
+            color = COLOR_HOT
+        else:
+            color = WHITE
+        width = _text_width(text)
+        # The icon is padded by 1px on each side
+        weather_width = 1 + WEATHER_ICON_SIZE + 1 + width
+        if bikes_width + weather_width > WIDTH:
+            msg = "weather doesn't fit next to the bikes"
+            raise UnsupportedDataError(msg)
+        # Right-aligned, and centered in the height below the trains
+        x = WIDTH - weather_width
+        y = top + (HEIGHT - top - WEATHER_ICON_SIZE) // 2
+        icon = CONDITION_ICONS.get(current_weather["condition"])
+        if icon is not None:
+            canvas.paste(self._images[icon], x + 1, y)
+        canvas.text(text, x + weather_width - width, y, color)
+
+
+def _encode_webp(frames: list[NDArray[np.uint8]]) -> bytes:
+    """Encode frames as a lossless, looping animated WebP, showing each run of
+    identical frames as one.
+    """
+    images: list[Image.Image] = []
+    durations: list[int] = []
+    previous = None
+    for frame in frames:
+        if previous is not None and np.array_equal(frame, previous):
+            durations[-1] += FRAME_DURATION_MS
+            continue
+        images.append(Image.fromarray(frame).convert("RGBA"))
+        durations.append(FRAME_DURATION_MS)
+        previous = frame
+    output = io.BytesIO()
+    images[0].save(
+        output,
+        format="WEBP",
+        save_all=True,
+        append_images=images[1:],
+        duration=durations,
+        loop=0,
+        lossless=True,
+        # pixlet's encoder leaves the background white
+        background=(255, 255, 255, 255),
+    )
+    return output.getvalue()
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+
+import structlog
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Sequence
+
+logger = structlog.get_logger()
+
+
+@dataclass(frozen=True)
+class Stage:
+    name: str
+    # Called with the previous stage's result, or None for the first stage
+    func: Callable[[Any], Awaitable[Any]]
+    # Number of seconds after which the stage is cancelled
+    deadline: float
+
+
+@dataclass
+class PipelineStats:
+    # Ticks that made it through every stage
+    completed: int = 0
+    # Ticks that arrived while the previous tick was still in the first stage,
+    # and were folded into one more tick once it left
+    coalesced: int = 0
+    # Ticks abandoned because a stage failed or overran its deadline
+    failed: int = 0
+    # Stage name => number of times the stage overran its deadline
+    overruns: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    # Stage name => total number of seconds spent in the stage
+    stage_seconds: dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    # Stage name => total number of seconds ticks spent waiting for the
+    # previous tick to leave the stage
+    wait_seconds: dict[str, float] = field(default_factory=lambda: defaultdict(float))
+
+
+class Pipeline:
+    """Run ticks through a sequence of stages.
+
+    Each stage handles one tick at a time, and a tick holds on to a stage
+    until the next one is free, so a tick's early stages overlap the previous
+    tick's later stages (e.g. fetching data for the next frame while the
+    current one renders) without ticks piling up behind a slow stage. Ticks
+    that arrive while the previous one is still in the first stage are
+    coalesced into one more tick, started once the first stage is free, so
+    that what triggered them isn't lost.
+    """
+
+    def __init__(self, stages: Sequence[Stage]) -> None:
+        self.stats = PipelineStats()
+        self._stages = stages
+        self._locks = [asyncio.Lock() for _ in stages]
+        self._tasks: set[asyncio.Task[bool]] = set()
+        # Whether a tick arrived while the first stage was busy
+        self._rerun = False
+
+    async def tick(self) -> bool:
+        """Run a tick through every stage. Returns whether it completed.
+
+        If the previous tick is still in the first stage, another tick is
+        started once it leaves, and this returns False right away.
+        """
+        if self._locks[0].locked():
+            self.stats.coalesced += 1
+            self._rerun = True
+            return False
+        held: int | None = None
+        value = None
+        try:
+            for index, (stage, lock) in enumerate(
+                zip(self._stages, self._locks, strict=True)
+            ):
+                start = time.perf_counter()
+                await lock.acquire()
+                self.stats.wait_seconds[stage.name] += time.perf_counter() - start
+                if held is not None:
+                    self._release(held)
+                held = index
+                log = logger.bind(stage=stage.name)
+                start = time.perf_counter()
+                try:
+                    async with asyncio.timeout(stage.deadline) as timeout:
+                        value = await stage.func(value)
+                except Exception:
+                    self.stats.failed += 1
+                    if timeout.expired():
+                        self.stats.overruns[stage.name] += 1
+                        log.warning("pipeline stage overran", deadline=stage.deadline)
+                    else:
+                        log.exception("pipeline stage failed")
+                    return False
+                finally:
+                    self.stats.stage_seconds[stage.name] += time.perf_counter() - start
+        finally:
+            if held is not None:
+                self._release(held)
+        self.stats.completed += 1
+        return True
+
+    def submit(self) -> None:
+        """Start a tick without waiting for it to complete."""
+        task = asyncio.create_task(self.tick())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def aclose(self) -> None:
+        """Cancel ticks started with ``submit``."""
+        self._rerun = False
+        # Cancelled ticks may start another one as they leave the first stage
+        while tasks := [task for task in self._tasks if not task.done()]:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _release(self, index: int) -> None:
+        self._locks[index].release()
+        if index == 0 and self._rerun:
+            self._rerun = False
+            self.submit()
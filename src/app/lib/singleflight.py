@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Hashable
+
+
+@dataclass
+class SingleFlightStats:
+    calls: int = 0
+    # Calls that joined a fetch already in flight instead of starting one
+    coalesced: int = 0
+
+
+class SingleFlight[K: Hashable, T]:
+    """Coalesce concurrent calls for the same key into one in-flight call.
+
+    While a call for a key is running, later callers for that key await its
+    result (or exception) instead of starting their own. Nothing is cached
+    once the call completes.
+    """
+
+    def __init__(self) -> None:
+        self.stats = SingleFlightStats()
+        self._calls: dict[K, asyncio.Future[T]] = {}
+
+    async def do(self, key: K, func: Callable[[], Awaitable[T]]) -> T:
+        self.stats.calls += 1
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.stats.coalesced += 1
+        # A cancelled caller mustn't cancel the call for the others
+        return await asyncio.shield(future)
+
+    def _forget(self, key: K, future: asyncio.Future[T]) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved in case every caller was cancelled
+            future.exception()
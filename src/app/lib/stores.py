@@ -0,0 +1,26 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from litestar.stores.file import FileStore
+from litestar.stores.memory import MemoryStore
+from litestar.stores.redis import RedisStore
+
+if TYPE_CHECKING:
+    from litestar.stores.base import Store
+
+REDIS_SCHEMES = ("redis://", "rediss://", "unix://")
+
+
+def store_from_url(url: str, *, namespace: str) -> Store:
+    """Create a key/value store from ``url``, which is "memory", a Redis URL,
+    or the path of a directory to keep files in.
+    Enter the store as an async context manager to create the directory or
+    to close the Redis connection pool when done.
+    """
+    if url == "memory":
+        return MemoryStore()
+    if url.startswith(REDIS_SCHEMES):
+        return RedisStore.with_client(url=url, namespace=namespace)
+    return FileStore(Path(url) / namespace, create_directories=True)
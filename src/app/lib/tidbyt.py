@@ -2,13 +2,29 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import hashlib
 import re
+import secrets
+import socket
 import tempfile
-from typing import Literal, overload
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Literal, overload
 
 import anyio
+import httpx
+import structlog
 
-from .http import make_client
+from .http import clients
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncGenerator, Awaitable, Callable, Mapping
+
+logger = structlog.get_logger()
 
 
 class TidbytError(Exception):
@@ -19,6 +35,15 @@ class RenderError(TidbytError):
     pass
 
 
+@dataclass(frozen=True)
+class TidbytDevice:
+    device_id: str
+    api_key: str
+    # Config passed to the applet when rendering for this device, as
+    # (key, value) pairs
+    config: tuple[tuple[str, str], ...] = ()
+
+
 async def push_to_tidbyt(
     *,
     image_data: str,
@@ -40,7 +65,7 @@ async def push_to_tidbyt(
         "Content-Type": "application/json",
     }
 
-    async with make_client() as client:
+    async with clients.client() as client:
         response = await client.post(
             f"https://api.tidbyt.com/v0/devices/{device_id}/push",
             headers=headers,
@@ -55,6 +80,7 @@ async def render_applet(
     path: str,
     *,
     pixlet_binary: str | None = None,
+    config: Mapping[str, str] | None = None,
     as_bytes: Literal[False] = False,
 ) -> str: ...
 
@@ -64,6 +90,7 @@ async def render_applet(
     path: str,
     *,
     pixlet_binary: str | None = None,
+    config: Mapping[str, str] | None = None,
     as_bytes: Literal[True],
 ) -> bytes: ...
 
@@ -73,29 +100,41 @@ async def render_applet(
     path: str,
     *,
     pixlet_binary: str | None = None,
+    config: Mapping[str, str] | None = None,
     as_bytes: bool,
 ) -> str | bytes: ...
 
 
 async def render_applet(
-    path: str, *, pixlet_binary: str | None = None, as_bytes: bool = False
+    path: str,
+    *,
+    pixlet_binary: str | None = None,
+    config: Mapping[str, str] | None = None,
+    as_bytes: bool = False,
 ) -> bytes | str:
     """Render a Pixlet starlark app to a webp image.
     By default returns the data as base64-encoded string.
     If as_bytes is True, returns the raw bytes instead.
+    ``config`` is passed to the applet's main function.
     """
     pixlet_binary = pixlet_binary or "pixlet"
     process = await asyncio.create_subprocess_exec(
         pixlet_binary,
         "render",
         path,
+        *(f"{key}={value}" for key, value in (config or {}).items()),
         "--silent",
         "--output",
         "-",  # Output bytes to stdout
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
     )
-    output_bytes, stderr = await process.communicate()
+    try:
+        output_bytes, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        # Don't leave pixlet running when the render is given up on
+        process.kill()
+        raise
     return_code = process.returncode
     if return_code != 0:
         raise RenderError(
@@ -137,18 +176,527 @@ async def render_applet_with_replacements(
     e.g., replacing server URLs within applets because applets can't read
     environment variables.
     """
-    # Replace given variables in the file
-    content = await anyio.Path(path).read_text()
-    modified_content = content
-    for key, value in replacements.items():
-        pattern = rf'{key}\s*=\s*["\'].*?["\']'
-        replacement = f'{key} = "{value}"'
-        modified_content = re.sub(pattern, replacement, modified_content)
-
-    # Create temporary file with modified content
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".star") as tmp_file:
-        tmp_file.write(modified_content)
-        tmp_file.flush()
-        return await render_applet(
-            tmp_file.name, pixlet_binary=pixlet_binary, as_bytes=as_bytes
+    prepared_path = await prepared_applets.prepare(path, replacements)
+    return await render_applet(
+        prepared_path, pixlet_binary=pixlet_binary, as_bytes=as_bytes
+    )
+
+
+class PreparedApplets:
+    """Applets with replaced constants.
+
+    Each distinct modified source is written once to a file named after its
+    digest, and reused until the original applet's mtime changes. Only the
+    ``max_size`` most recently used applets are kept; older files are
+    deleted, as are all of them on :meth:`clear`.
+    """
+
+    def __init__(self, directory: str | None = None, *, max_size: int = 8) -> None:
+        self._directory = anyio.Path(
+            directory or Path(tempfile.gettempdir()) / "tidbyt-applets"
+        )
+        self._max_size = max_size
+        # (path, replacements) => (mtime of the applet, path of prepared applet)
+        self._prepared: OrderedDict[
+            tuple[str, frozenset[tuple[str, str]]], tuple[int, str]
+        ] = OrderedDict()
+
+    async def prepare(self, path: str, replacements: Mapping[str, str]) -> str:
+        """Return the path of ``path`` with the given constants replaced."""
+        key = (path, frozenset(replacements.items()))
+        mtime = (await anyio.Path(path).stat()).st_mtime_ns
+        prepared = self._prepared.get(key)
+        if prepared is not None and prepared[0] == mtime:
+            self._prepared.move_to_end(key)
+            return prepared[1]
+
+        # Replace given variables in the file
+        content = await anyio.Path(path).read_text()
+        for name, value in replacements.items():
+            pattern = rf'{name}\s*=\s*["\'].*?["\']'
+            replacement = f'{name} = "{value}"'
+            content = re.sub(pattern, replacement, content)
+
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        prepared_path = self._directory / f"{digest}.star"
+        if not await prepared_path.exists():
+            await self._directory.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first so that concurrent renders
+            # never see a partially written applet. Each write gets its own
+            # file so that concurrent writes don't rename each other's.
+            tmp_path = self._directory / f"{digest}.{secrets.token_hex(8)}.tmp"
+            await tmp_path.write_text(content)
+            await tmp_path.replace(prepared_path)
+        self._prepared[key] = (mtime, str(prepared_path))
+        self._prepared.move_to_end(key)
+
+        stale = [prepared[1]] if prepared is not None else []
+        while len(self._prepared) > self._max_size:
+            _, (_, evicted_path) = self._prepared.popitem(last=False)
+            stale.append(evicted_path)
+        in_use = {prepared_path for _, prepared_path in self._prepared.values()}
+        for stale_path in set(stale) - in_use:
+            await anyio.Path(stale_path).unlink(missing_ok=True)
+        return str(prepared_path)
+
+    async def clear(self) -> None:
+        """Forget and delete every prepared applet."""
+        paths = {prepared_path for _, prepared_path in self._prepared.values()}
+        self._prepared.clear()
+        for prepared_path in paths:
+            await anyio.Path(prepared_path).unlink(missing_ok=True)
+
+
+prepared_applets = PreparedApplets()
+
+
+@dataclass
+class RenderWorkerStats:
+    renders: int = 0
+    failures: int = 0
+    # Number of times the pixlet process was restarted after exiting or
+    # failing a health check
+    restarts: int = 0
+    # Total number of seconds spent in successful renders
+    render_seconds: float = 0
+
+
+class RenderWorker:
+    """Render a Pixlet applet with a long-lived ``pixlet serve`` process.
+
+    ``pixlet render`` starts a new process and loads the applet and its fonts
+    on every render. ``pixlet serve`` does that once, then renders the applet
+    on each request. The process is health-checked in the background and
+    restarted if it exits or stops responding.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        pixlet_binary: str | None = None,
+        startup_timeout: float = 10,
+        health_check_interval: float = 30,
+    ) -> None:
+        self.stats = RenderWorkerStats()
+        self._path = path
+        self._pixlet_binary = pixlet_binary or "pixlet"
+        self._startup_timeout = startup_timeout
+        self._health_check_interval = health_check_interval
+        self._process: asyncio.subprocess.Process | None = None
+        self._client: httpx.AsyncClient | None = None
+        self._url = ""
+        self._restart_lock = asyncio.Lock()
+
+    @property
+    def is_running(self) -> bool:
+        return self._process is not None and self._process.returncode is None
+
+    @asynccontextmanager
+    async def run(self) -> AsyncGenerator[None]:
+        """Start the pixlet process and supervise it until the context exits.
+
+        If pixlet fails to start, renders raise RenderError until a later
+        health check manages to start it.
+        """
+        async with httpx.AsyncClient(timeout=self._startup_timeout) as client:
+            self._client = client
+            try:
+                await self._start()
+            except RenderError as exc:
+                logger.warning("failed to start render worker: %s", exc)
+            supervisor = asyncio.create_task(self._supervise())
+            try:
+                yield
+            finally:
+                supervisor.cancel()
+                await asyncio.gather(supervisor, return_exceptions=True)
+                await self._stop()
+                self._client = None
+
+    @overload
+    async def render(
+        self,
+        *,
+        config: Mapping[str, str] | None = None,
+        as_bytes: Literal[False] = False,
+    ) -> str: ...
+
+    @overload
+    async def render(
+        self, *, config: Mapping[str, str] | None = None, as_bytes: Literal[True]
+    ) -> bytes: ...
+
+    async def render(
+        self, *, config: Mapping[str, str] | None = None, as_bytes: bool = False
+    ) -> bytes | str:
+        """Render the applet to a webp image, like ``render_applet``."""
+        if self._client is None:
+            msg = "render worker isn't running"
+            raise RenderError(msg)
+        if not self.is_running:
+            await self._restart()
+        start = time.perf_counter()
+        try:
+            # pixlet serve passes query parameters to the applet as config
+            response = await self._client.get(
+                f"{self._url}/api/v1/preview.webp", params=config
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as exc:
+            self.stats.failures += 1
+            msg = f"pixlet serve failed to render: {exc}"
+            raise RenderError(msg) from exc
+        self.stats.renders += 1
+        self.stats.render_seconds += time.perf_counter() - start
+        if as_bytes:
+            return response.content
+        return base64.b64encode(response.content).decode("utf-8")
+
+    async def _start(self) -> None:
+        port = _find_free_port()
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                self._pixlet_binary,
+                "serve",
+                self._path,
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(port),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        except OSError as exc:
+            msg = f"failed to run {self._pixlet_binary}: {exc}"
+            raise RenderError(msg) from exc
+        self._url = f"http://127.0.0.1:{port}"
+        deadline = asyncio.get_running_loop().time() + self._startup_timeout
+        while not await self._is_healthy():
+            if self._process.returncode is not None:
+                msg = f"pixlet serve exited with code {self._process.returncode}"
+                raise RenderError(msg)
+            if asyncio.get_running_loop().time() > deadline:
+                await self._stop()
+                msg = "pixlet serve didn't start in time"
+                raise RenderError(msg)
+            await asyncio.sleep(0.1)
+
+    async def _stop(self) -> None:
+        process, self._process = self._process, None
+        if process is None or process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            async with asyncio.timeout(5):
+                await process.wait()
+        except TimeoutError:
+            process.kill()
+            await process.wait()
+
+    async def _restart(self) -> None:
+        async with self._restart_lock:
+            # Another caller may have restarted the process while we waited
+            if self.is_running and await self._is_healthy():
+                return
+            await self._stop()
+            self.stats.restarts += 1
+            await self._start()
+
+    async def _supervise(self) -> None:
+        while True:
+            await asyncio.sleep(self._health_check_interval)
+            if self.is_running and await self._is_healthy():
+                continue
+            logger.warning("render worker is unhealthy, restarting")
+            try:
+                await self._restart()
+            except RenderError as exc:
+                logger.warning("failed to restart render worker: %s", exc)
+
+    async def _is_healthy(self) -> bool:
+        if self._client is None or not self.is_running:
+            return False
+        try:
+            response = await self._client.get(f"{self._url}/", timeout=1)
+        except httpx.HTTPError:
+            return False
+        return response.is_success
+
+
+def _find_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@dataclass
+class RenderCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Total number of seconds spent rendering on cache misses
+    render_seconds: float = 0
+    # Estimated number of seconds of rendering skipped by cache hits, based
+    # on the average render time
+    seconds_saved: float = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+
+class RenderCache:
+    """Cache of rendered images, keyed by a digest of everything the render
+    depends on, so that unchanged inputs skip rendering entirely.
+    """
+
+    def __init__(self, *, max_size: int = 16) -> None:
+        self.stats = RenderCacheStats()
+        self._max_size = max_size
+        self._images: OrderedDict[str, str] = OrderedDict()
+
+    def get(self, key: str) -> str | None:
+        image_data = self._images.get(key)
+        if image_data is None:
+            self.stats.misses += 1
+            return None
+        self._images.move_to_end(key)
+        self.stats.hits += 1
+        if self.stats.misses:
+            self.stats.seconds_saved += self.stats.render_seconds / self.stats.misses
+        return image_data
+
+    def set(self, key: str, image_data: str, *, render_seconds: float) -> None:
+        self.stats.render_seconds += render_seconds
+        self._images[key] = image_data
+        self._images.move_to_end(key)
+        while len(self._images) > self._max_size:
+            self._images.popitem(last=False)
+
+    def clear(self) -> None:
+        self._images.clear()
+
+
+@dataclass
+class PushQueueStats:
+    submitted: int = 0
+    pushed: int = 0
+    # Pending images replaced by a newer image before they were pushed
+    dropped: int = 0
+    # Pushes that failed with an error that retrying won't fix
+    failed: int = 0
+    # Pushes retried after a server or connection error
+    retried: int = 0
+    # Pushes retried after a 429 response
+    rate_limited: int = 0
+    # Total and longest number of seconds that pushed images spent queued
+    wait_seconds: float = 0
+    max_wait_seconds: float = 0
+
+
+@dataclass
+class _PendingPush:
+    device: TidbytDevice
+    image_data: str
+    submitted_at: float
+    on_pushed: Callable[[], Awaitable[None]] | None
+
+
+class _TokenBucket:
+    def __init__(self, *, rate: float, capacity: int, now: float) -> None:
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = now
+
+    def delay(self, now: float) -> float:
+        """Number of seconds until a token is available."""
+        self._refill(now)
+        return 0 if self._tokens >= 1 else (1 - self._tokens) / self._rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self._tokens -= 1
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated_at
+        self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+        self._updated_at = now
+
+
+class PushQueue:
+    """Queue of images to push to Tidbyt devices.
+
+    Only the newest image submitted for a device is pushed; an image that's
+    still pending when a newer one is submitted is dropped. Pushes to each
+    device are rate limited with a token bucket, and rate-limited (429) or
+    failed pushes are retried after the server's Retry-After or an
+    exponential backoff, unless a newer image has been submitted by then.
+    """
+
+    def __init__(
+        self,
+        push: Callable[[TidbytDevice, str], Awaitable[object]],
+        *,
+        rate: float,
+        burst: int = 1,
+        max_concurrency: int = 4,
+        max_backoff: float = 300,
+    ) -> None:
+        """Push with ``push(device, image_data)``, at most ``rate`` pushes
+        per second (after an initial ``burst``) to each device.
+        """
+        self.stats = PushQueueStats()
+        self._push = push
+        self._rate = rate
+        self._burst = burst
+        self._max_backoff = max_backoff
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._pending: dict[str, _PendingPush] = {}
+        self._workers: dict[str, asyncio.Task[None]] = {}
+        self._buckets: dict[str, _TokenBucket] = {}
+        # Device ID => loop time before which the device mustn't be pushed to
+        self._not_before: dict[str, float] = {}
+        self._failures: dict[str, int] = {}
+
+    @property
+    def depth(self) -> int:
+        """Number of devices with an image waiting to be pushed."""
+        return len(self._pending)
+
+    def submit(
+        self,
+        device: TidbytDevice,
+        image_data: str,
+        *,
+        on_pushed: Callable[[], Awaitable[None]] | None = None,
+    ) -> None:
+        """Queue an image to push to ``device``, replacing any image still
+        waiting to be pushed to it. ``on_pushed`` is awaited once the image
+        has been pushed.
+        """
+        loop = asyncio.get_running_loop()
+        self.stats.submitted += 1
+        if device.device_id in self._pending:
+            self.stats.dropped += 1
+        self._pending[device.device_id] = _PendingPush(
+            device=device,
+            image_data=image_data,
+            submitted_at=loop.time(),
+            on_pushed=on_pushed,
+        )
+        worker = self._workers.get(device.device_id)
+        if worker is None or worker.done():
+            self._workers[device.device_id] = asyncio.create_task(
+                self._run(device.device_id)
+            )
+
+    async def join(self) -> None:
+        """Wait until every pending image has been pushed or given up on."""
+        while workers := [w for w in self._workers.values() if not w.done()]:
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def aclose(self) -> None:
+        """Stop pushing, discarding pending images."""
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._workers.clear()
+        self._pending.clear()
+
+    async def _run(self, device_id: str) -> None:
+        loop = asyncio.get_running_loop()
+        bucket = self._buckets.setdefault(
+            device_id,
+            _TokenBucket(rate=self._rate, capacity=self._burst, now=loop.time()),
+        )
+        while device_id in self._pending:
+            now = loop.time()
+            delay = max(self._not_before.get(device_id, 0) - now, bucket.delay(now))
+            if delay > 0:
+                # A newer image may be submitted while waiting
+                await asyncio.sleep(delay)
+                continue
+            pending = self._pending.pop(device_id)
+            bucket.take(now)
+            async with self._slots:
+                retry_after = await self._try_push(pending)
+            if retry_after is not None:
+                self._not_before[device_id] = loop.time() + retry_after
+                # Retry unless a newer image was submitted in the meantime
+                self._pending.setdefault(device_id, pending)
+
+    async def _try_push(self, pending: _PendingPush) -> float | None:
+        """Push a pending image, returning the number of seconds to wait
+        before retrying if the push should be retried.
+        """
+        device_id = pending.device.device_id
+        log = logger.bind(device_id=device_id)
+        try:
+            await self._push(pending.device, pending.image_data)
+        except httpx.HTTPStatusError as exc:
+            if exc.response.status_code == httpx.codes.TOO_MANY_REQUESTS:
+                self.stats.rate_limited += 1
+                retry_after = _parse_retry_after(exc.response)
+                if retry_after is None:
+                    retry_after = self._backoff(device_id)
+                log.warning("push rate limited, retrying in %.0fs", retry_after)
+                return retry_after
+            if exc.response.is_server_error:
+                return self._retry(device_id, exc)
+            self.stats.failed += 1
+            log.warning("failed to push image: %s", exc)
+            return None
+        except (httpx.TransportError, TimeoutError) as exc:
+            return self._retry(device_id, exc)
+        except Exception:
+            # Keep the device's worker running for the next image
+            self.stats.failed += 1
+            log.exception("failed to push image")
+            return None
+
+        wait_seconds = asyncio.get_running_loop().time() - pending.submitted_at
+        self.stats.pushed += 1
+        self.stats.wait_seconds += wait_seconds
+        self.stats.max_wait_seconds = max(self.stats.max_wait_seconds, wait_seconds)
+        self._failures.pop(device_id, None)
+        if pending.on_pushed is not None:
+            try:
+                await pending.on_pushed()
+            except Exception:
+                log.exception("failed to handle pushed image")
+        return None
+
+    def _retry(self, device_id: str, exc: Exception) -> float:
+        self.stats.retried += 1
+        backoff = self._backoff(device_id)
+        logger.warning(
+            "failed to push image, retrying in %.0fs: %s",
+            backoff,
+            str(exc) or type(exc).__name__,
+            device_id=device_id,
         )
+        return backoff
+
+    def _backoff(self, device_id: str) -> float:
+        failures = self._failures[device_id] = self._failures.get(device_id, 0) + 1
+        return min(2.0 ** (failures - 1), self._max_backoff)
+
+
+def _parse_retry_after(response: httpx.Response) -> float | None:
+    """Number of seconds to wait according to a Retry-After header, which is
+    either a number of seconds or an HTTP date.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
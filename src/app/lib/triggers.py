@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import math
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Protocol
+
+import structlog
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Sequence
+
+logger = structlog.get_logger()
+
+
+class ChangeSource(Protocol):
+    # Incremented on every change
+    version: int
+
+    async def wait_for_change(self, version: int) -> None:
+        """Wait until ``version`` is no longer the current version."""
+        ...
+
+    def next_change_at(self, now: float) -> float | None:
+        """Unix time of the next change that's known in advance, if any."""
+        ...
+
+
+@dataclass(frozen=True)
+class CadenceProfile:
+    """Minimum interval between runs during a time of day, in local time.
+    ``end`` may be before ``start`` for profiles that span midnight.
+    """
+
+    start: dt.time
+    end: dt.time
+    min_interval: float
+
+    def contains(self, when: dt.time) -> bool:
+        if self.start <= self.end:
+            return self.start <= when < self.end
+        return when >= self.start or when < self.end
+
+
+@dataclass
+class ChangeTriggerStats:
+    # Runs triggered by a change in the source
+    changes: int = 0
+    # Runs at a time the source said it would change
+    scheduled: int = 0
+    # Runs because the maximum interval passed without a change
+    timeouts: int = 0
+    # Runs delayed to keep to the minimum interval
+    delayed: int = 0
+
+
+class ChangeTrigger:
+    """Run a function when a source changes, instead of on a fixed interval.
+
+    Runs are at least ``min_interval`` seconds apart, and at most
+    ``max_interval`` seconds apart even if nothing changes. ``profiles``
+    raise the minimum interval during given times of day.
+    """
+
+    def __init__(
+        self,
+        *,
+        min_interval: float,
+        max_interval: float,
+        profiles: Sequence[CadenceProfile] = (),
+    ) -> None:
+        self.stats = ChangeTriggerStats()
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._profiles = profiles
+
+    def intervals(self, now: float) -> tuple[float, float]:
+        """Minimum and maximum number of seconds between runs at ``now``."""
+        when = dt.datetime.fromtimestamp(now).time()  # noqa: DTZ006
+        min_interval = next(
+            (
+                profile.min_interval
+                for profile in self._profiles
+                if profile.contains(when)
+            ),
+            self._min_interval,
+        )
+        return min_interval, max(min_interval, self._max_interval)
+
+    async def run(
+        self, func: Callable[[], Awaitable[None]], source: ChangeSource
+    ) -> None:
+        """Run ``func`` whenever ``source`` changes, until cancelled."""
+        last_run = -math.inf
+        version = source.version
+        while True:
+            now = time.time()
+            min_interval, max_interval = self.intervals(now)
+            wake_at = last_run + max_interval
+            scheduled = False
+            change_at = source.next_change_at(now)
+            if change_at is not None and change_at < wake_at:
+                wake_at, scheduled = change_at, True
+            try:
+                async with asyncio.timeout(max(wake_at - now, 0)):
+                    await source.wait_for_change(version)
+            except TimeoutError:
+                if scheduled:
+                    self.stats.scheduled += 1
+                else:
+                    self.stats.timeouts += 1
+            else:
+                self.stats.changes += 1
+
+            delay = last_run + min_interval - time.time()
+            if delay > 0:
+                self.stats.delayed += 1
+                await asyncio.sleep(delay)
+            # Changes while running trigger the next run
+            version = source.version
+            last_run = time.time()
+            try:
+                await func()
+            except Exception:
+                logger.exception("triggered run failed")
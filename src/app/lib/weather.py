@@ -1,6 +1,10 @@
+from bisect import bisect_right
+from collections.abc import Sequence
+from dataclasses import dataclass
 from typing import Any, Literal, TypedDict
 
-from .http import make_client
+from .http import clients
+from .singleflight import SingleFlight
 
 WindSpeedUnit = Literal["kmh", "mph"]
 TemperatureUnit = Literal["celsius", "fahrenheit"]
@@ -16,27 +20,103 @@ class CurrentWeatherData(TypedDict, total=False):
     wind_speed_10m: float
 
 
-# https://open-meteo.com/en/docs
-async def get_current_weather(
-    latitude: float,
-    longitude: float,
-) -> CurrentWeatherData:
-    """Get weather data for a given location."""
+# Variables to request for current and hourly weather
+_WEATHER_VARIABLES = [
+    "temperature_2m",
+    "apparent_temperature",
+    "is_day",
+    "precipitation",
+    "weather_code",
+    "wind_speed_10m",
+]
+# Number of days of hourly forecast to request
+FORECAST_DAYS = 2
+
+
+@dataclass(frozen=True)
+class HourlyForecast:
+    """Hourly weather forecast for a location.
+
+    Each field has one value per hour, at the Unix times in ``time``.
+    """
+
+    time: Sequence[int]
+    temperature_2m: Sequence[float]
+    apparent_temperature: Sequence[float]
+    is_day: Sequence[bool]
+    precipitation: Sequence[float]
+    weather_code: Sequence[int]
+    wind_speed_10m: Sequence[float]
+
+    @property
+    def expires_at(self) -> int:
+        """Unix time of the last forecast hour."""
+        return self.time[-1] if self.time else 0
+
+    def at(self, when: float) -> CurrentWeatherData | None:
+        """Weather at ``when`` (a Unix time), or None if it's outside of the
+        forecast.
+
+        Temperatures and wind speed are interpolated between the surrounding
+        hours. Other values are taken from the nearest hour.
+        """
+        if not self.time or not self.time[0] <= when <= self.time[-1]:
+            return None
+        index = min(bisect_right(self.time, when) - 1, len(self.time) - 2)
+        if index < 0:
+            # Single-hour forecast
+            return self._hour(0, 0)
+        start, end = self.time[index], self.time[index + 1]
+        return self._hour(index, (when - start) / (end - start))
+
+    def _hour(self, index: int, fraction: float) -> CurrentWeatherData:
+        def interpolate(values: Sequence[float]) -> float:
+            if fraction == 0:
+                return values[index]
+            return values[index] + (values[index + 1] - values[index]) * fraction
+
+        nearest = index + round(fraction)
+        return CurrentWeatherData(
+            temperature_2m=interpolate(self.temperature_2m),
+            apparent_temperature=interpolate(self.apparent_temperature),
+            is_day=bool(self.is_day[nearest]),
+            precipitation=self.precipitation[nearest],
+            weather_code=self.weather_code[nearest],
+            wind_speed_10m=interpolate(self.wind_speed_10m),
+        )
+
+
+hourly_forecast_flight: SingleFlight[tuple[float, float], HourlyForecast] = (
+    SingleFlight()
+)
+
+
+async def get_hourly_forecast(latitude: float, longitude: float) -> HourlyForecast:
+    """Get the hourly forecast for a given location, starting at midnight UTC
+    today and covering ``FORECAST_DAYS`` days.
+
+    Concurrent calls for the same location share one in-flight request.
+    """
+    return await hourly_forecast_flight.do(
+        (latitude, longitude), lambda: _fetch_hourly_forecast(latitude, longitude)
+    )
+
+
+async def _fetch_hourly_forecast(latitude: float, longitude: float) -> HourlyForecast:
     params: dict[str, Any] = {
         "latitude": latitude,
         "longitude": longitude,
-        "current": [
-            "temperature_2m",
-            "apparent_temperature",
-            "is_day",
-            "precipitation",
-            "weather_code",
-            "wind_speed_10m",
-        ],
+        "hourly": _WEATHER_VARIABLES,
+        "forecast_days": FORECAST_DAYS,
+        "timeformat": "unixtime",
     }
-    async with make_client() as client:
+    async with clients.client() as client:
         response = await client.get(
             "https://api.open-meteo.com/v1/forecast", params=params
         )
         response.raise_for_status()
-        return response.json()["current"]
+        hourly = response.json()["hourly"]
+    return HourlyForecast(
+        time=hourly["time"],
+        **{variable: hourly[variable] for variable in _WEATHER_VARIABLES},
+    )
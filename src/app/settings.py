@@ -1,34 +1,146 @@
+import datetime as dt
+import tempfile
 from typing import Literal, cast
 
-from environs import Env, validate
+from environs import Env, EnvError, validate
 
 from app.api.mocks import TransitDataMocks, WeatherResponseMocks
+from app.lib.mta import ROUTE_TO_FEED_MAP, StationConfig
+from app.lib.tidbyt import TidbytDevice
+from app.lib.triggers import CadenceProfile
 
 env = Env(eager=False)
 
+
+@env.parser_for("station_list")
+def _parse_station_list(value: str | None) -> list[StationConfig]:
+    """Parse a semicolon-separated list of STATION_ID:ROUTES, where ROUTES is
+    a comma-separated list of routes.
+    """
+    stations: list[StationConfig] = []
+    if not value:
+        return stations
+    for entry in filter(None, (part.strip() for part in value.split(";"))):
+        station_id, _, routes_value = entry.partition(":")
+        routes = frozenset(filter(None, (r.strip() for r in routes_value.split(","))))
+        if not station_id or not routes:
+            raise EnvError(f"Expected STATION_ID:ROUTES, got {entry!r}")
+        if unknown_routes := routes - ROUTE_TO_FEED_MAP.keys():
+            raise EnvError(f"Unknown routes: {', '.join(sorted(unknown_routes))}")
+        stations.append(StationConfig(station_id=station_id.strip(), routes=routes))
+    return stations
+
+
+@env.parser_for("device_list")
+def _parse_device_list(value: str | None) -> list[TidbytDevice]:
+    """Parse a semicolon-separated list of DEVICE_ID:API_KEY, optionally
+    followed by :STATION_IDS, where STATION_IDS is a comma-separated list of
+    the MTA stations to show on that device.
+    """
+    devices: list[TidbytDevice] = []
+    if not value:
+        return devices
+    for entry in filter(None, (part.strip() for part in value.split(";"))):
+        device_id, _, rest = entry.partition(":")
+        api_key, _, station_ids_value = rest.partition(":")
+        if not device_id or not api_key:
+            raise EnvError(f"Expected DEVICE_ID:API_KEY[:STATION_IDS], got {entry!r}")
+        station_ids = [s.strip() for s in station_ids_value.split(",") if s.strip()]
+        devices.append(
+            TidbytDevice(
+                device_id=device_id.strip(),
+                api_key=api_key.strip(),
+                config=(("stations", ",".join(station_ids)),) if station_ids else (),
+            )
+        )
+    return devices
+
+
+@env.parser_for("cadence_profiles")
+def _parse_cadence_profiles(value: str | None) -> list[CadenceProfile]:
+    """Parse a semicolon-separated list of START-END=SECONDS, where START and
+    END are HH:MM times.
+    """
+    profiles: list[CadenceProfile] = []
+    if not value:
+        return profiles
+    for entry in filter(None, (part.strip() for part in value.split(";"))):
+        times, _, seconds = entry.partition("=")
+        start, _, end = times.partition("-")
+        try:
+            profiles.append(
+                CadenceProfile(
+                    start=dt.time.fromisoformat(start.strip()),
+                    end=dt.time.fromisoformat(end.strip()),
+                    min_interval=float(seconds),
+                )
+            )
+        except ValueError as exc:
+            raise EnvError(f"Expected START-END=SECONDS, got {entry!r}") from exc
+    return profiles
+
+
 env.read_env()
 
 ### TidByt ###
 
-# Require Tidbyt API key and device ID
-TIDBYT_API_KEY = env.str("TIDBYT_API_KEY")
-TIDBYT_DEVICE_ID = env.str("TIDBYT_DEVICE_ID")
+# Devices to push to, as a semicolon-separated list of DEVICE_ID:API_KEY,
+# optionally followed by :STATION_IDS to show a subset of MTA_STATIONS
+# Example: device1:key1;device2:key2:A32S
+_TIDBYT_DEVICES: list[TidbytDevice] = env.device_list("TIDBYT_DEVICES", None)
+
+# Single-device configuration, used if TIDBYT_DEVICES isn't set
+TIDBYT_API_KEY = env.str("TIDBYT_API_KEY", None)
+TIDBYT_DEVICE_ID = env.str("TIDBYT_DEVICE_ID", None)
 
 TIDBYT_INSTALLATION_ID = env.str("TIDBYT_INSTALLATION_ID", "TrainsAndBikes")
 # Path to the pixlet binary
 PIXLET_PATH = env.str("PIXLET_PATH", "pixlet")
+# Set to 0 to run `pixlet render` for every frame instead of keeping
+# `pixlet serve` running in the background
+PIXLET_RENDER_WORKER = env.bool("PIXLET_RENDER_WORKER", True)
+# Set to "native" to draw the applet in-process instead of with pixlet. Data
+# that the native renderer can't draw exactly as pixlet would is still
+# rendered with pixlet.
+TIDBYT_RENDERER = env.str(
+    "TIDBYT_RENDERER", "pixlet", validate=validate.OneOf(["pixlet", "native"])
+)
 
 ### MTA ###
 
-MTA_STATION_ID1 = env.str("MTA_STATION_ID1")
-MTA_STATION_ROUTES1: set[str] = set(env.list("MTA_STATION_ROUTES1", delimiter=","))
+# Stations to display, as a semicolon-separated list of STATION_ID:ROUTES
+# Example: A32S:A,C,E;R20N:N,Q,R,W
+_MTA_STATIONS: list[StationConfig] = env.station_list("MTA_STATIONS", None)
+
+# Two-station configuration, used if MTA_STATIONS isn't set
+MTA_STATION_ID1 = env.str("MTA_STATION_ID1", None)
+MTA_STATION_ROUTES1: set[str] = set(env.list("MTA_STATION_ROUTES1", [], delimiter=","))
 
-MTA_STATION_ID2 = env.str("MTA_STATION_ID2")
-MTA_STATION_ROUTES2: set[str] = set(env.list("MTA_STATION_ROUTES2", delimiter=","))
+MTA_STATION_ID2 = env.str("MTA_STATION_ID2", None)
+MTA_STATION_ROUTES2: set[str] = set(env.list("MTA_STATION_ROUTES2", [], delimiter=","))
 
 ### Citibike ###
 
-CITIBIKE_STATION_ID = env.str("CITIBIKE_STATION_ID")
+# Comma-separated list of station IDs. The first station is shown unless it
+# has no bikes, in which case the first of the others that has bikes is shown
+_CITIBIKE_STATION_IDS: list[str] = env.list("CITIBIKE_STATION_IDS", [], delimiter=",")
+
+# Single-station configuration, used if CITIBIKE_STATION_IDS isn't set
+CITIBIKE_STATION_ID = env.str("CITIBIKE_STATION_ID", None)
+
+# Optional coordinate (latitude,longitude) to find the nearest stations with
+# bikes available to
+CITIBIKE_NEARBY_COORDINATES = env.list(
+    "CITIBIKE_NEARBY_COORDINATES",
+    delimiter=",",
+    subcast=float,
+    validate=validate.Length(equal=2),
+    default=None,
+)
+# Number of nearby stations to find
+CITIBIKE_NEARBY_LIMIT = env.int(
+    "CITIBIKE_NEARBY_LIMIT", 3, validate=validate.Range(min=1)
+)
 
 ### Weather ###
 
@@ -50,11 +162,74 @@ TEMPERATURE_UNIT = cast(
 
 # Set to 1 to enable render and push to the Tidbyt device at the interval specified below
 TIDBYT_ENABLE_PUSH = env.bool("TIDBYT_ENABLE_PUSH", False)
-# Push interval in seconds
+# When to render and push: "change" renders when ingested data or a displayed
+# wait time changes, "interval" renders every TIDBYT_PUSH_INTERVAL seconds
+TIDBYT_PUSH_TRIGGER = env.str(
+    "TIDBYT_PUSH_TRIGGER", "change", validate=validate.OneOf(["change", "interval"])
+)
+# Push interval in seconds, for the "interval" trigger
 TIDBYT_PUSH_INTERVAL = env.float("TIDBYT_PUSH_INTERVAL", 10)
+# Minimum and maximum number of seconds between renders, for the "change" trigger
+TIDBYT_PUSH_MIN_INTERVAL = env.float("TIDBYT_PUSH_MIN_INTERVAL", 5)
+TIDBYT_PUSH_MAX_INTERVAL = env.float("TIDBYT_PUSH_MAX_INTERVAL", 60)
+# Minimum number of seconds between renders at times of day (server local
+# time), as a semicolon-separated list of START-END=SECONDS
+# Example: 23:00-06:00=300
+TIDBYT_PUSH_PROFILES: list[CadenceProfile] = env.cadence_profiles(
+    "TIDBYT_PUSH_PROFILES", None
+)
+# Maximum number of devices to push to at once
+TIDBYT_PUSH_CONCURRENCY = env.int("TIDBYT_PUSH_CONCURRENCY", 4)
+# Maximum number of pushes per minute to each device, after an initial burst.
+# Newer images replace queued ones when pushes are limited.
+TIDBYT_PUSH_RATE_LIMIT = env.float("TIDBYT_PUSH_RATE_LIMIT", 4)
+TIDBYT_PUSH_BURST = env.int("TIDBYT_PUSH_BURST", 2)
+# Number of seconds after which rendering a frame is given up on. Fetching
+# data and pushing are limited by UPSTREAM_DEADLINE.
+TIDBYT_RENDER_DEADLINE = env.float("TIDBYT_RENDER_DEADLINE", 30)
+# Where to keep the digest of the last image pushed to each device, so that
+# restarts don't push unchanged images again. Either a directory, a Redis URL
+# (redis://HOST:PORT/DB), or "memory" to forget them on restart. The temp
+# directory default doesn't outlive a container, so compose.yaml sets this to
+# a volume.
+TIDBYT_PUSH_STORE = env.str("TIDBYT_PUSH_STORE", None) or tempfile.gettempdir()
+
+### Ingestion ###
+
+# Set to 0 to fetch upstream data when handling requests instead of in the background
+INGEST_ENABLE = env.bool("INGEST_ENABLE", True)
+# Number of seconds between polls of each upstream
+INGEST_MTA_INTERVAL = env.float("INGEST_MTA_INTERVAL", 30)
+INGEST_CITIBIKE_INTERVAL = env.float("INGEST_CITIBIKE_INTERVAL", 30)
+# Current weather is estimated from the hourly forecast between polls
+INGEST_WEATHER_INTERVAL = env.float("INGEST_WEATHER_INTERVAL", 6 * 60 * 60)
+
+### Multiple workers ###
+
+# Redis server shared by every worker process. When set, response caches are
+# shared, and only one worker (the leader) polls upstreams and pushes to
+# Tidbyt; the others serve the data the leader polled.
+REDIS_URL = env.str("REDIS_URL", None)
+# Number of seconds after which another worker takes over from a leader that
+# stopped responding
+LEADER_LEASE_TTL = env.float("LEADER_LEASE_TTL", 15)
 
 ### API ###
 
+# Maximum number of open connections and requests in flight to upstream APIs,
+# shared by all requests. Requests are limited too since HTTP/2 sends them
+# all over one connection.
+UPSTREAM_MAX_CONCURRENCY = env.int("UPSTREAM_MAX_CONCURRENCY", 6)
+# Maximum number of idle connections to keep open for reuse
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = env.int("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", 6)
+# Number of seconds to keep idle connections open. Keep this longer than the
+# ingestion intervals so that each poll reuses the previous poll's connection
+UPSTREAM_KEEPALIVE_EXPIRY = env.float("UPSTREAM_KEEPALIVE_EXPIRY", 330)
+# Set to 0 to disable HTTP/2 for upstreams that support it
+UPSTREAM_HTTP2 = env.bool("UPSTREAM_HTTP2", True)
+# Number of seconds to wait for upstream APIs before returning partial data
+UPSTREAM_DEADLINE = env.float("UPSTREAM_DEADLINE", 8)
+
 # Mock data source. Used for testing.
 TRANSIT_MOCK = env.str("TRANSIT_MOCK", None, validate=validate.OneOf(TransitDataMocks))
 
@@ -73,3 +248,36 @@ SENTRY_ENV = env.str("SENTRY_ENV", None)
 HEARTBEAT_URL = env.str("HEARTBEAT_URL", None, validate=validate.URL())
 
 env.seal()
+
+# The two-station configuration is validated the same way as MTA_STATIONS
+MTA_STATIONS: list[StationConfig] = _MTA_STATIONS or _parse_station_list(
+    ";".join(
+        f"{station_id}:{','.join(sorted(routes))}"
+        for station_id, routes in (
+            (MTA_STATION_ID1, MTA_STATION_ROUTES1),
+            (MTA_STATION_ID2, MTA_STATION_ROUTES2),
+        )
+        if station_id
+    )
+)
+if not MTA_STATIONS:
+    raise EnvError("Set MTA_STATIONS or MTA_STATION_ID1 and MTA_STATION_ID2")
+MTA_STATION_IDS = {station.station_id for station in MTA_STATIONS}
+
+TIDBYT_DEVICES: list[TidbytDevice] = _TIDBYT_DEVICES or (
+    [TidbytDevice(device_id=TIDBYT_DEVICE_ID, api_key=TIDBYT_API_KEY)]
+    if TIDBYT_DEVICE_ID and TIDBYT_API_KEY
+    else []
+)
+if not TIDBYT_DEVICES:
+    raise EnvError("Set TIDBYT_DEVICES or TIDBYT_API_KEY and TIDBYT_DEVICE_ID")
+for device in TIDBYT_DEVICES:
+    device_station_ids = set(dict(device.config).get("stations", "").split(","))
+    if unknown_stations := device_station_ids - {"", *MTA_STATION_IDS}:
+        raise EnvError(f"Unknown stations: {', '.join(sorted(unknown_stations))}")
+
+CITIBIKE_STATION_IDS: list[str] = _CITIBIKE_STATION_IDS or (
+    [CITIBIKE_STATION_ID] if CITIBIKE_STATION_ID else []
+)
+if not CITIBIKE_STATION_IDS:
+    raise EnvError("Set CITIBIKE_STATION_IDS or CITIBIKE_STATION_ID")
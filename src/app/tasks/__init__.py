@@ -1,70 +1,372 @@
 """Periodic tasks."""
 
-from collections.abc import AsyncGenerator
-from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import time
+from collections.abc import AsyncGenerator, Mapping
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Self
 
+import anyio
 import httpx
 import structlog
 from apscheduler import AsyncScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from litestar.stores.memory import MemoryStore
+from litestar.stores.base import Store
+from litestar.stores.redis import RedisStore
+from redis.asyncio import Redis
 
 from app import settings
-from app.lib.tidbyt import push_to_tidbyt, render_applet
+from app.lib.http import clients, make_client
+from app.lib.leader import LeaderElection
+from app.lib.native_render import NativeRenderer, UnsupportedDataError
+from app.lib.pipeline import Pipeline, Stage
+from app.lib.stores import store_from_url
+from app.lib.tidbyt import (
+    PushQueue,
+    RenderCache,
+    RenderError,
+    RenderWorker,
+    TidbytDevice,
+    push_to_tidbyt,
+    render_applet,
+)
+from app.lib.triggers import ChangeTrigger
+from app.tasks.ingestion import ingestor
 
 logger = structlog.get_logger()
 
 HERE = Path(__file__).parent.resolve()
 TIDBYT_APP_PATH = HERE / ".." / "tidbyt_app" / "trains_and_bikes.star"
+# Must match API_URL in the applet
+TIDBYT_APP_API_URL = "http://localhost:8000"
 
-# store = RedisStore.with_client(url=settings.REDIS_URL)
-store = MemoryStore()
+store = store_from_url(settings.TIDBYT_PUSH_STORE, namespace="tidbytpushes")
+
+# Shared by every worker process, if they share a Redis server
+redis: Redis | None = None
+shared_store: Store | None = None
+response_cache_store: Store | None = None
+leader_election: LeaderElection | None = None
+if settings.REDIS_URL:
+    redis = Redis.from_url(settings.REDIS_URL)
+    shared_store = RedisStore(redis, namespace="shared")
+    response_cache_store = RedisStore(redis, namespace="responsecache")
+    leader_election = LeaderElection(
+        redis, "trains-and-bikes:leader", ttl=settings.LEADER_LEASE_TTL
+    )
+# Number of seconds between writes and reads of the shared snapshot
+SHARED_SNAPSHOT_INTERVAL = 2
+
+render_worker = RenderWorker(str(TIDBYT_APP_PATH), pixlet_binary=settings.PIXLET_PATH)
+native_renderer = NativeRenderer(str(TIDBYT_APP_PATH))
+render_cache = RenderCache()
+render_trigger = ChangeTrigger(
+    min_interval=settings.TIDBYT_PUSH_MIN_INTERVAL,
+    max_interval=settings.TIDBYT_PUSH_MAX_INTERVAL,
+    profiles=settings.TIDBYT_PUSH_PROFILES,
+)
 
 
 async def maybe_send_heartbeat() -> None:
     """POST to the heartbeat URL to signal the periodic task is alive."""
     if not settings.HEARTBEAT_URL:
         return
-    async with httpx.AsyncClient() as client:
+    async with clients.client() as client:
         try:
             await client.post(settings.HEARTBEAT_URL)
         except httpx.HTTPError:
             logger.warning("failed to send heartbeat", url=settings.HEARTBEAT_URL)
 
 
+type DeviceConfig = tuple[tuple[str, str], ...]
+
+
 async def render_and_push_to_tidbyt() -> None:
-    """Render the Tidbyt applet and push to TidByt if the image has changed."""
-    cached_data = await store.get("image_data")
-    previous_data = cached_data.decode("utf-8") if cached_data else None
-    log = logger.bind(tidbyt_app=TIDBYT_APP_PATH.name)
+    """Render the Tidbyt applet and push to every device whose image has
+    changed, waiting for the render pipeline tick to complete.
+    """
+    await render_pipeline.tick()
+
+
+async def start_render_and_push_to_tidbyt() -> None:
+    """Start a render pipeline tick without waiting for it, so that its fetch
+    stage can overlap the previous tick's render.
+    """
+    render_pipeline.submit()
+
+
+@dataclass(frozen=True)
+class AppInputs:
+    """Data to render the applet with for a device config."""
+
+    # Passed to the applet as config, in addition to the device config. Empty
+    # if the data couldn't be fetched, in which case the applet fetches it.
+    data: dict[str, str]
+    # Digest of the applet source and the data, or None if there's no data
+    digest: str | None
+
+
+async def fetch_stage(_: None) -> dict[DeviceConfig, AppInputs]:
+    """Fetch the applet's data for each distinct device config."""
+    configs = list({device.config for device in settings.TIDBYT_DEVICES})
+    inputs = await asyncio.gather(
+        *(get_tidbyt_app_inputs(dict(config)) for config in configs)
+    )
+    return dict(zip(configs, inputs, strict=True))
+
+
+async def render_stage(
+    inputs: dict[DeviceConfig, AppInputs],
+) -> dict[DeviceConfig, str]:
+    """Render the applet once for each distinct device config."""
+    results = await asyncio.gather(
+        *(
+            render_tidbyt_app_for_config(
+                dict(config), app_inputs.digest, data=app_inputs.data
+            )
+            for config, app_inputs in inputs.items()
+        ),
+        return_exceptions=True,
+    )
+    images: dict[DeviceConfig, str] = {}
+    for config, result in zip(inputs, results, strict=True):
+        if isinstance(result, BaseException):
+            logger.error("failed to render tidbyt app", config=config, exc_info=result)
+        else:
+            images[config] = result
+    return images
+
+
+async def diff_stage(
+    images: dict[DeviceConfig, str],
+) -> tuple[list[tuple[TidbytDevice, str, str]], bool]:
+    """Return the (device, image, image digest) for each device whose image
+    differs from the last image pushed to it, and whether every device's
+    image rendered.
+    """
+    changed = []
+    rendered_all = True
+    for device in settings.TIDBYT_DEVICES:
+        if device.config not in images:
+            rendered_all = False
+            continue
+        image_data = images[device.config]
+        image_digest = hashlib.sha256(image_data.encode()).hexdigest()
+        # Only push to TidByt if the image has changed to prevent getting rate limited
+        record = PushRecord.from_bytes(await store.get(push_record_key(device)))
+        if record is not None and record.digest == image_digest:
+            logger.info(
+                "cache hit: no image change, skipping push",
+                device_id=device.device_id,
+                pushed_ago=round(time.time() - record.pushed_at),
+            )
+            continue
+        changed.append((device, image_data, image_digest))
+    return changed, rendered_all
+
+
+async def push_stage(
+    diff: tuple[list[tuple[TidbytDevice, str, str]], bool],
+) -> None:
+    """Queue changed images to push. Pushes are queued so that a slow,
+    failing or rate-limited device doesn't hold up the others.
+    """
+    changed, rendered_all = diff
+    for device, image_data, image_digest in changed:
+        submit_push(device, image_data, image_digest)
+    # Let the heartbeat monitor know if any device's image failed to render
+    if rendered_all:
+        await maybe_send_heartbeat()
+
+
+render_pipeline = Pipeline(
+    [
+        Stage("fetch", fetch_stage, deadline=settings.UPSTREAM_DEADLINE),
+        Stage("render", render_stage, deadline=settings.TIDBYT_RENDER_DEADLINE),
+        Stage("diff", diff_stage, deadline=settings.UPSTREAM_DEADLINE),
+        Stage("push", push_stage, deadline=settings.UPSTREAM_DEADLINE),
+    ]
+)
+
+
+async def render_tidbyt_app_for_config(
+    config: Mapping[str, str],
+    digest: str | None,
+    *,
+    data: Mapping[str, str] | None = None,
+) -> str:
+    """Render the Tidbyt applet with ``config`` and ``data``, unless the same
+    inputs (given by ``digest``) were rendered recently.
+    """
+    log = logger.bind(tidbyt_app=TIDBYT_APP_PATH.name, config=config)
+    image_data = render_cache.get(digest) if digest else None
+    if image_data is not None:
+        log.info(
+            "render cache hit: no input change, skipping render",
+            hit_ratio=render_cache.stats.hit_ratio,
+            seconds_saved=render_cache.stats.seconds_saved,
+        )
+        return image_data
     log.debug("rendering tidbyt app")
-    image_data = await render_applet(
-        str(TIDBYT_APP_PATH), pixlet_binary=settings.PIXLET_PATH
+    start = time.perf_counter()
+    image_data = await render_tidbyt_app({**config, **(data or {})})
+    if digest:
+        render_cache.set(digest, image_data, render_seconds=time.perf_counter() - start)
+    return image_data
+
+
+@dataclass(frozen=True)
+class PushRecord:
+    """The last image pushed to a device, kept as a digest so that the store
+    doesn't grow with the size of the image.
+    """
+
+    digest: str
+    pushed_at: float
+
+    def to_bytes(self) -> bytes:
+        return f"{self.digest} {self.pushed_at}".encode()
+
+    @classmethod
+    def from_bytes(cls, data: bytes | None) -> Self | None:
+        digest, _, pushed_at = (data or b"").decode().partition(" ")
+        try:
+            return cls(digest=digest, pushed_at=float(pushed_at))
+        except ValueError:
+            return None
+
+
+def push_record_key(device: TidbytDevice) -> str:
+    return f"pushed:{device.device_id}"
+
+
+def submit_push(device: TidbytDevice, image_data: str, image_digest: str) -> None:
+    """Queue an image to push to a device, recording its digest once pushed."""
+
+    async def on_pushed() -> None:
+        record = PushRecord(digest=image_digest, pushed_at=time.time())
+        await store.set(push_record_key(device), record.to_bytes())
+
+    logger.debug(
+        "queueing tidbyt app push",
+        device_id=device.device_id,
+        queue_depth=push_queue.depth,
     )
-    # Only push to TidByt if the image has changed to prevent getting rate limited
-    if image_data != previous_data:
-        log.debug("pushing tidbyt app")
-        await store.set("image_data", image_data)
-        response = await push_to_tidbyt(
+    push_queue.submit(device, image_data, on_pushed=on_pushed)
+
+
+async def send_push(device: TidbytDevice, image_data: str) -> None:
+    response = await asyncio.wait_for(
+        push_to_tidbyt(
             image_data=image_data,
-            api_key=settings.TIDBYT_API_KEY,
-            device_id=settings.TIDBYT_DEVICE_ID,
+            api_key=device.api_key,
+            device_id=device.device_id,
             installation_id=settings.TIDBYT_INSTALLATION_ID,
             background=True,
-        )
-        log.debug("push response", response=response)
-    else:
-        log.info("cache hit: no image change, skipping push")
-    await maybe_send_heartbeat()
+        ),
+        timeout=settings.UPSTREAM_DEADLINE,
+    )
+    logger.debug("push response", device_id=device.device_id, response=response)
+
+
+push_queue = PushQueue(
+    send_push,
+    rate=settings.TIDBYT_PUSH_RATE_LIMIT / 60,
+    burst=settings.TIDBYT_PUSH_BURST,
+    max_concurrency=settings.TIDBYT_PUSH_CONCURRENCY,
+)
+
+
+async def get_tidbyt_app_inputs(config: Mapping[str, str]) -> AppInputs:
+    """Fetch the API responses the applet renders with ``config``.
+
+    The responses are passed to the applet as config rather than fetched
+    again by it, so that the render shows exactly the data that the digest
+    (the render cache key) covers. If the API can't be reached, the applet
+    is left to fetch the data itself, without a digest.
+    """
+    digest = hashlib.sha256(await anyio.Path(TIDBYT_APP_PATH).read_bytes())
+    # Same requests as the applet makes. Transit data bypasses the response
+    # cache, so that a render woken by a wait time changing doesn't get the
+    # previous minute's response.
+    transit_params = {"stations": config["stations"]} if "stations" in config else {}
+    requests = [
+        ("transit_data", "/transit", transit_params, {"Cache-Control": "no-cache"}),
+        ("weather_data", "/weather", {}, {}),
+    ]
+    data: dict[str, str] = {}
+    # A client of its own rather than the shared upstream client, so that
+    # requests to this app don't take upstream connections or count towards
+    # their stats
+    async with make_client(base_url=TIDBYT_APP_API_URL) as client:
+        for key, route, params, headers in requests:
+            try:
+                response = await client.get(route, params=params, headers=headers)
+            except httpx.HTTPError:
+                logger.warning("failed to fetch applet data", route=route)
+                return AppInputs(data={}, digest=None)
+            if response.is_success:
+                data[key] = response.text
+            elif key == "transit_data":
+                # The applet fails without transit data; let it fetch again
+                logger.warning(
+                    "failed to fetch applet data",
+                    route=route,
+                    status_code=response.status_code,
+                )
+                return AppInputs(data={}, digest=None)
+            else:
+                # The applet renders without weather
+                data[key] = "null"
+            digest.update(b"\0%s\0" % key.encode())
+            digest.update(data[key].encode())
+    return AppInputs(data=data, digest=digest.hexdigest())
+
+
+async def render_tidbyt_app(config: Mapping[str, str]) -> str:
+    """Render the Tidbyt applet with the native renderer if it's enabled and
+    can draw the data, or else with the render worker, falling back to
+    running pixlet once if the worker isn't available.
+    """
+    if settings.TIDBYT_RENDERER == "native":
+        try:
+            return await native_renderer.render(config=config)
+        except UnsupportedDataError as exc:
+            logger.info("native renderer can't draw the data, using pixlet: %s", exc)
+    if settings.PIXLET_RENDER_WORKER:
+        try:
+            return await render_worker.render(config=config)
+        except RenderError as exc:
+            logger.warning("render worker failed, running pixlet: %s", exc)
+    return await render_applet(
+        str(TIDBYT_APP_PATH), pixlet_binary=settings.PIXLET_PATH, config=config
+    )
 
 
 @asynccontextmanager
 async def scheduler() -> AsyncGenerator[AsyncScheduler]:
-    async with AsyncScheduler() as async_scheduler:
-        if settings.TIDBYT_ENABLE_PUSH:
+    async with AsyncExitStack() as stack:
+        # Closed last, after pending pushes are recorded
+        await stack.enter_async_context(store)
+        if settings.TIDBYT_ENABLE_PUSH and settings.PIXLET_RENDER_WORKER:
+            # Started first so that it's stopped after the scheduler
+            await stack.enter_async_context(render_worker.run())
+        stack.push_async_callback(push_queue.aclose)
+        stack.push_async_callback(render_pipeline.aclose)
+        async_scheduler = await stack.enter_async_context(AsyncScheduler())
+        if settings.TIDBYT_ENABLE_PUSH and settings.TIDBYT_PUSH_TRIGGER == "interval":
             await async_scheduler.add_schedule(
-                render_and_push_to_tidbyt,
+                start_render_and_push_to_tidbyt,
                 IntervalTrigger(seconds=settings.TIDBYT_PUSH_INTERVAL),
             )
+        elif settings.TIDBYT_ENABLE_PUSH:
+            trigger_task = asyncio.create_task(
+                render_trigger.run(start_render_and_push_to_tidbyt, ingestor)
+            )
+            # Exit callbacks run in reverse order: cancel, then wait
+            stack.push_async_callback(asyncio.wait, [trigger_task])
+            stack.callback(trigger_task.cancel)
         yield async_scheduler
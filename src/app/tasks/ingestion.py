@@ -0,0 +1,398 @@
+"""Background ingestion of upstream data.
+
+Each upstream (MTA, Citi Bike, Open-Meteo) is polled on its own interval and
+the results are published as an immutable Snapshot, so that API requests
+never wait on upstream round trips.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import time
+from collections.abc import Mapping  # noqa: TC003
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field, replace
+from typing import TYPE_CHECKING
+
+import httpx
+import msgspec
+import structlog
+
+from app import settings
+from app.api.models import (
+    BikeStationData,
+    NearbyBikeStationData,
+    TrainStationData,
+    TransitData,
+    WeatherData,
+)
+from app.lib import mta
+from app.lib.citibike import get_nearest_stations, get_station_status
+from app.lib.http import run_until
+from app.lib.mta import get_stations_data
+from app.lib.weather import HourlyForecast, get_hourly_forecast
+
+if TYPE_CHECKING:
+    from collections.abc import (
+        AsyncGenerator,
+        Awaitable,
+        Callable,
+        Collection,
+    )
+
+    from litestar.stores.base import Store
+
+logger = structlog.get_logger()
+
+# Minimum number of seconds between attempts to revalidate the weather forecast
+WEATHER_RETRY_DELAY = 60
+# Key of the snapshot shared with other processes
+SHARED_SNAPSHOT_KEY = "snapshot"
+
+
+@dataclass(frozen=True)
+class SourceFreshness:
+    # Unix time of the last successful refresh
+    updated_at: float | None = None
+    # Unix time of the last refresh attempt, successful or not
+    attempted_at: float | None = None
+    # Error from the last refresh attempt, if it failed
+    error: str | None = None
+
+    @property
+    def age(self) -> float | None:
+        """Number of seconds since the last successful refresh."""
+        return None if self.updated_at is None else time.time() - self.updated_at
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    """Most recently ingested data from every upstream.
+
+    Snapshots are never mutated; the ingestor publishes a new one after
+    each refresh. They're shared between processes as JSON, so field types
+    are imported at runtime for msgspec to resolve.
+    """
+
+    created_at: float = field(default_factory=time.time)
+    # Departures are stored as absolute times so that wait times can be
+    # computed when the snapshot is served
+    trains: tuple[mta.TrainStationData, ...] | None = None
+    citibike: BikeStationData | None = None
+    citibike_stations: tuple[BikeStationData, ...] = ()
+    citibike_nearby: tuple[NearbyBikeStationData, ...] = ()
+    # Current weather is estimated from the forecast when the snapshot
+    # is served
+    weather_forecast: HourlyForecast | None = None
+    sources: Mapping[str, SourceFreshness] = field(default_factory=dict)
+
+    @property
+    def age(self) -> float:
+        """Number of seconds since the snapshot was published."""
+        return time.time() - self.created_at
+
+    @property
+    def has_transit(self) -> bool:
+        return self.trains is not None and self.citibike is not None
+
+    def transit(
+        self, *, now: float, station_ids: Collection[str] | None = None
+    ) -> TransitData | None:
+        """Transit data with wait times as of ``now`` (a Unix time), or None
+        if trains or bikes haven't been ingested yet.
+
+        If ``station_ids`` is given, only trains for those stations are included.
+        """
+        if self.trains is None or self.citibike is None:
+            return None
+        return TransitData(
+            trains=[
+                TrainStationData.from_station_data(station_data, now=now)
+                for station_data in self.trains
+                if station_ids is None or station_data.station_id in station_ids
+            ],
+            citibike=self.citibike,
+            citibike_stations=list(self.citibike_stations),
+            citibike_nearby=list(self.citibike_nearby),
+        )
+
+    def next_transit_change(
+        self, *, now: float, departures_per_station: int = 2
+    ) -> float | None:
+        """Unix time at which a displayed wait time next changes, as of
+        ``now``, or None if no departures are displayed.
+
+        Only the first ``departures_per_station`` departures that are served
+        for each station are considered.
+        """
+        transit = self.transit(now=now)
+        if transit is None:
+            return None
+        change_times = [
+            # Wait times are rounded down to whole minutes, so they change
+            # when a whole number of minutes is left
+            departure.time - 60 * departure.wait_time_minutes
+            for station in transit.trains
+            for departure in station.departures[:departures_per_station]
+        ]
+        return min(change_times, default=None)
+
+    def weather(self, *, now: float) -> WeatherData | None:
+        """Weather as of ``now`` (a Unix time), or None if no forecast
+        covering ``now`` has been ingested.
+        """
+        if self.weather_forecast is None:
+            return None
+        return WeatherData.from_forecast(self.weather_forecast, now=now)
+
+
+class Ingestor:
+    """Poll upstreams in the background and publish the results as a Snapshot."""
+
+    def __init__(self) -> None:
+        self.snapshot = Snapshot()
+        # Incremented whenever newly ingested data differs from the snapshot
+        self.version = 0
+        self._changed = asyncio.Event()
+        self._weather_task: asyncio.Task[None] | None = None
+        # Whether the snapshot is read from another process instead of being
+        # ingested from upstreams
+        self.following = False
+
+    async def wait_for_change(self, version: int) -> None:
+        """Wait until data that differs from ``version`` has been ingested."""
+        while self.version == version:
+            await self._changed.wait()
+
+    def next_change_at(self, now: float) -> float | None:
+        """Unix time at which the served data next changes without new data
+        being ingested, or None if it doesn't.
+        """
+        return self.snapshot.next_transit_change(now=now)
+
+    async def refresh_trains(self) -> None:
+        stations = settings.MTA_STATIONS
+        deadline = asyncio.get_running_loop().time() + settings.UPSTREAM_DEADLINE
+        # The deadline applies to each feed, so a slow feed only fails the
+        # stations that use it
+        results = await get_stations_data(stations, deadline=deadline)
+        previous = {
+            station_data.station_id: station_data
+            for station_data in self.snapshot.trains or ()
+        }
+        trains: list[mta.TrainStationData] = []
+        failed: list[str] = []
+        for station, station_data in zip(stations, results, strict=True):
+            if station_data is not None:
+                trains.append(station_data)
+                continue
+            failed.append(station.station_id)
+            trains.append(
+                # Keep serving the last good data for this station
+                previous.get(station.station_id)
+                or mta.TrainStationData(
+                    station_id=station.station_id, routes=sorted(station.routes)
+                )
+            )
+        self._publish(
+            "mta",
+            error=f"failed to fetch stations {', '.join(failed)}" if failed else None,
+            trains=tuple(trains),
+        )
+
+    async def refresh_citibike(self) -> None:
+        station_ids = settings.CITIBIKE_STATION_IDS
+        deadline = asyncio.get_running_loop().time() + settings.UPSTREAM_DEADLINE
+        station_status = await run_until(
+            get_station_status(station_ids), deadline=deadline
+        )
+        error = None if station_status is not None else "failed to fetch bike counts"
+        if station_status is None and self.snapshot.citibike is not None:
+            # Keep serving the last good counts
+            self._publish("citibike", error=error)
+            return
+        stations = BikeStationData.from_snapshot(station_status, station_ids)
+        self._publish(
+            "citibike",
+            error=error,
+            # Fall back to the first other station with bikes if the
+            # first station is empty
+            citibike=next(
+                (station for station in stations if station.has_bikes), stations[0]
+            ),
+            citibike_stations=tuple(stations),
+        )
+
+    async def refresh_citibike_nearby(self) -> None:
+        if not settings.CITIBIKE_NEARBY_COORDINATES:
+            return
+        latitude, longitude = settings.CITIBIKE_NEARBY_COORDINATES
+        deadline = asyncio.get_running_loop().time() + settings.UPSTREAM_DEADLINE
+        nearby = await run_until(
+            get_nearest_stations(
+                latitude, longitude, limit=settings.CITIBIKE_NEARBY_LIMIT
+            ),
+            deadline=deadline,
+        )
+        if nearby is None:
+            # Keep serving the last good stations
+            self._publish("citibike_nearby", error="failed to fetch nearby stations")
+            return
+        self._publish(
+            "citibike_nearby",
+            citibike_nearby=tuple(
+                NearbyBikeStationData.from_nearby_station(station) for station in nearby
+            ),
+        )
+
+    async def refresh_weather(self) -> None:
+        if not settings.WEATHER_COORDINATES:
+            return
+        latitude, longitude = settings.WEATHER_COORDINATES
+        try:
+            async with asyncio.timeout(settings.UPSTREAM_DEADLINE):
+                forecast = await get_hourly_forecast(latitude, longitude)
+        except (httpx.HTTPError, TimeoutError) as exc:
+            # Keep serving the last good forecast
+            self._publish("weather", error=str(exc) or type(exc).__name__)
+            return
+        self._publish("weather", weather_forecast=forecast)
+
+    def revalidate_weather(self) -> asyncio.Task[None] | None:
+        """Refresh the weather forecast in the background if it's stale.
+
+        Callers keep serving the current snapshot, stale or not, instead of
+        waiting for the refresh. Returns the refresh task, if one is running.
+        Followers don't refresh; the leader's snapshot brings new forecasts.
+        """
+        if not settings.WEATHER_COORDINATES or self.following:
+            return None
+        if self._weather_task is not None and not self._weather_task.done():
+            return self._weather_task
+        now = time.time()
+        freshness = self.snapshot.sources.get("weather", SourceFreshness())
+        if (
+            freshness.attempted_at is not None
+            and now - freshness.attempted_at < WEATHER_RETRY_DELAY
+        ):
+            return None
+        if (
+            freshness.updated_at is not None
+            and now - freshness.updated_at < settings.INGEST_WEATHER_INTERVAL
+            and self.snapshot.weather(now=now) is not None
+        ):
+            return None
+        self._weather_task = asyncio.create_task(self._refresh(self.refresh_weather))
+        return self._weather_task
+
+    @asynccontextmanager
+    async def run_in_background(self) -> AsyncGenerator[None]:
+        """Poll every upstream on its own interval until the context exits."""
+        pollers = [
+            self._poll(self.refresh_trains, settings.INGEST_MTA_INTERVAL),
+            self._poll(self.refresh_citibike, settings.INGEST_CITIBIKE_INTERVAL),
+            self._poll(self.refresh_citibike_nearby, settings.INGEST_CITIBIKE_INTERVAL),
+            self._poll(self.refresh_weather, settings.INGEST_WEATHER_INTERVAL),
+        ]
+        tasks = [asyncio.create_task(poller) for poller in pollers]
+        try:
+            yield
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    @asynccontextmanager
+    async def share(self, store: Store, *, interval: float) -> AsyncGenerator[None]:
+        """Write the snapshot to ``store`` whenever it changes, and at least
+        every ``interval`` seconds, until the context exits.
+        """
+        task = asyncio.create_task(self._share(store, interval))
+        try:
+            yield
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    @asynccontextmanager
+    async def follow(self, store: Store, *, interval: float) -> AsyncGenerator[None]:
+        """Serve the snapshot shared in ``store`` by another process instead
+        of polling upstreams, reading it every ``interval`` seconds until the
+        context exits.
+        """
+        task = asyncio.create_task(self._follow(store, interval))
+        self.following = True
+        try:
+            yield
+        finally:
+            self.following = False
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _share(self, store: Store, interval: float) -> None:
+        while True:
+            version = self.version
+            try:
+                await store.set(SHARED_SNAPSHOT_KEY, msgspec.json.encode(self.snapshot))
+            except Exception:
+                logger.exception("failed to share snapshot")
+            with contextlib.suppress(TimeoutError):
+                async with asyncio.timeout(interval):
+                    await self.wait_for_change(version)
+
+    async def _follow(self, store: Store, interval: float) -> None:
+        shared = None
+        while True:
+            try:
+                data = await store.get(SHARED_SNAPSHOT_KEY)
+                if data is not None and data != shared:
+                    shared = data
+                    self.snapshot = msgspec.json.decode(data, type=Snapshot)
+                    self._signal_change()
+            except Exception:
+                logger.exception("failed to read shared snapshot")
+            await asyncio.sleep(interval)
+
+    async def _poll(
+        self, refresh: Callable[[], Awaitable[None]], interval: float
+    ) -> None:
+        while True:
+            await self._refresh(refresh)
+            await asyncio.sleep(interval)
+
+    async def _refresh(self, refresh: Callable[[], Awaitable[None]]) -> None:
+        try:
+            await refresh()
+        except Exception:
+            logger.exception("failed to refresh upstream data")
+
+    def _publish(self, source: str, *, error: str | None = None, **data) -> None:
+        now = time.time()
+        previous = self.snapshot.sources.get(source, SourceFreshness())
+        freshness = SourceFreshness(
+            updated_at=previous.updated_at if error else now,
+            attempted_at=now,
+            error=error,
+        )
+        if error:
+            logger.warning("failed to refresh %s: %s", source, error)
+        changed = any(
+            getattr(self.snapshot, name) != value for name, value in data.items()
+        )
+        self.snapshot = replace(
+            self.snapshot,
+            created_at=now,
+            sources={**self.snapshot.sources, source: freshness},
+            **data,
+        )
+        if changed:
+            self._signal_change()
+
+    def _signal_change(self) -> None:
+        self.version += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+ingestor = Ingestor()
@@ -21,9 +21,12 @@ def anyio_backend() -> str:
 def _patch_settings(monkeypatch: pytest.MonkeyPatch) -> None:
     monkeypatch.setattr(settings, "TIDBYT_API_KEY", "fake")
     monkeypatch.setattr(settings, "TIDBYT_DEVICE_ID", "fake")
+    monkeypatch.setattr(settings, "INGEST_ENABLE", False)
 
 
 @pytest.fixture
 async def client() -> AsyncIterator[AsyncTestClient[Litestar]]:
+    # Responses cached by earlier tests would be served instead
+    await app.stores.get("response_cache").delete_all()
     async with AsyncTestClient(app) as client:
         yield client
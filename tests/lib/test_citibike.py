@@ -0,0 +1,173 @@
+import json
+import time
+
+import httpx
+import pytest
+
+from app.lib import citibike
+
+pytestmark = pytest.mark.anyio
+
+
+def make_station_status(
+    last_updated: int, ttl: int = 5, **bikes: tuple[int, int]
+) -> bytes:
+    """Build a GBFS station_status document from station_id=(bikes, ebikes) pairs."""
+    return json.dumps(
+        {
+            "last_updated": last_updated,
+            "ttl": ttl,
+            "data": {
+                "stations": [
+                    {
+                        "station_id": station_id,
+                        "num_bikes_available": num_bikes,
+                        "num_ebikes_available": num_ebikes,
+                    }
+                    for station_id, (num_bikes, num_ebikes) in bikes.items()
+                ]
+            },
+        }
+    ).encode()
+
+
+async def test_get_bike_counts(monkeypatch):
+    content = make_station_status(100, s1=(7, 2), s2=(0, 0))
+    transport = httpx.MockTransport(lambda _: httpx.Response(200, content=content))
+    monkeypatch.setattr(citibike, "station_status_cache", citibike.StationStatusCache())
+
+    async with httpx.AsyncClient(transport=transport) as client:
+        counts = await citibike.get_bike_counts("s1", client=client)
+        missing = await citibike.get_bike_counts("s3", client=client)
+
+    assert counts == citibike.CitibikeStationData(regular=5, ebikes=2)
+    assert missing is None
+
+
+async def test_unchanged_station_status_is_not_reparsed():
+    responses = [
+        httpx.Response(
+            200,
+            content=make_station_status(100, s1=(7, 2)),
+            headers={"Last-Modified": "Wed, 21 Oct 2026 07:28:00 GMT"},
+        ),
+        # Same last_updated, so parsing is skipped
+        httpx.Response(200, content=make_station_status(100, s1=(7, 2))),
+        httpx.Response(304),
+        httpx.Response(200, content=make_station_status(200, s1=(3, 3))),
+    ]
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return responses[len(requests) - 1]
+
+    cache = citibike.StationStatusCache()
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        results = [await cache.get(client, "s1") for _ in responses]
+
+    assert requests[1].headers["If-Modified-Since"] == "Wed, 21 Oct 2026 07:28:00 GMT"
+    assert results[0] == results[1] == results[2]
+    assert results[3] == citibike.CitibikeStationData(regular=0, ebikes=3)
+    assert cache.stats.not_modified == 1
+    assert cache.stats.parses_skipped == 2
+
+
+async def test_station_status_snapshot_is_reused_within_ttl():
+    content = make_station_status(int(time.time()), ttl=60, s1=(7, 2), s2=(1, 0))
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, content=content)
+
+    cache = citibike.StationStatusCache()
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        snapshot = await cache.snapshot(client, {"s1", "s2"})
+        again = await cache.snapshot(client, {"s1"})
+        # s3 wasn't searched for, so the document is fetched again
+        other = await cache.snapshot(client, {"s3"})
+
+    assert snapshot is not None
+    assert snapshot.get("s1") == citibike.CitibikeStationData(regular=5, ebikes=2)
+    assert snapshot.get("s2") == citibike.CitibikeStationData(regular=1, ebikes=0)
+    assert again is snapshot
+    assert other is not None
+    assert other.get("s3") is None
+    assert len(requests) == 2
+    assert cache.stats.fresh_hits == 1
+
+
+async def test_get_nearest_stations(monkeypatch):
+    information = {
+        "data": {
+            "stations": [
+                {"station_id": "near", "name": "Near", "lat": 40.7001, "lon": -74.0},
+                {"station_id": "empty", "name": "Empty", "lat": 40.7, "lon": -74.0},
+                {"station_id": "far", "name": "Far", "lat": 40.71, "lon": -74.0},
+                {"station_id": "farther", "name": "", "lat": 40.8, "lon": -74.0},
+            ]
+        }
+    }
+    status = make_station_status(100, near=(1, 0), empty=(0, 0), far=(2, 2))
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url == citibike.STATION_INFORMATION_URL:
+            return httpx.Response(200, json=information)
+        return httpx.Response(200, content=status)
+
+    information_cache = citibike.StationInformationCache(max_age=0)
+    monkeypatch.setattr(citibike, "station_information_cache", information_cache)
+    monkeypatch.setattr(citibike, "station_status_cache", citibike.StationStatusCache())
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        nearby = await citibike.get_nearest_stations(
+            40.7, -74.0, limit=2, client=client
+        )
+        await citibike.get_nearest_stations(40.7, -74.0, limit=2, client=client)
+
+    assert nearby is not None
+    # The nearest station has no bikes
+    assert [station.location.station_id for station in nearby] == ["near", "far"]
+    assert nearby[1].distance_meters == pytest.approx(1112, abs=1)
+    # The station list didn't change, so the index wasn't rebuilt
+    assert information_cache.stats.builds == 1
+    assert information_cache.stats.rebuilds_skipped == 1
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_station_status_parser_reads_chunks(chunk_size):
+    # Citi Bike puts last_updated after the stations
+    content = json.dumps(
+        {
+            "data": {
+                "stations": [
+                    {"station_id": "s1", "num_bikes_available": 1},
+                    {"station_id": "sé", "num_bikes_available": 4},
+                    {"station_id": "s3", "num_bikes_available": 9},
+                ]
+            },
+            "last_updated": 100,
+        },
+        ensure_ascii=False,
+    ).encode()
+    chunks = [content[i : i + chunk_size] for i in range(0, len(content), chunk_size)]
+
+    parser = citibike._StationStatusParser({"sé"})
+    assert any(parser.feed(chunk) for chunk in chunks)
+    assert parser.stations == {"sé": citibike.CitibikeStationData(4, 0)}
+    # Parsing stopped before last_updated
+    assert parser.last_updated is None
+
+    parser = citibike._StationStatusParser({"missing"})
+    assert not any(parser.feed(chunk) for chunk in chunks)
+    parser.close()
+    assert parser.stations == {}
+    assert parser.last_updated == 100
+
+
+def test_station_status_parser_rejects_truncated_document():
+    parser = citibike._StationStatusParser({"s1"})
+    parser.feed(make_station_status(100, s2=(1, 0))[:-10])
+    with pytest.raises(ValueError, match="truncated"):
+        parser.close()
@@ -0,0 +1,41 @@
+import math
+import random
+
+import pytest
+
+from app.lib.geo import METERS_PER_DEGREE, GridIndex
+
+
+def test_grid_index_matches_brute_force():
+    rng = random.Random(0)
+    points = [
+        (40.65 + rng.random() * 0.2, -74.05 + rng.random() * 0.15, i)
+        for i in range(500)
+    ]
+    index = GridIndex(points)
+    scale = math.cos(math.radians(sum(lat for lat, _, _ in points) / len(points)))
+
+    # Include queries outside of the indexed area
+    for _ in range(50):
+        latitude = 40.6 + rng.random() * 0.3
+        longitude = -74.1 + rng.random() * 0.25
+        expected = sorted(
+            (
+                math.hypot(
+                    (lon - longitude) * scale * METERS_PER_DEGREE,
+                    (lat - latitude) * METERS_PER_DEGREE,
+                ),
+                i,
+            )
+            for lat, lon, i in points
+        )[:5]
+        nearest = index.nearest(latitude, longitude, limit=5)
+        assert [i for _, i in nearest] == [i for _, i in expected]
+        assert [d for d, _ in nearest] == pytest.approx([d for d, _ in expected])
+
+
+def test_grid_index_returns_nothing_for_zero_limit():
+    index = GridIndex([(40.7, -74.0, "a"), (40.71, -74.01, "b")])
+
+    assert index.nearest(40.705, -74.005, limit=0) == []
+    assert index.nearest(41.0, -75.0, limit=0) == []
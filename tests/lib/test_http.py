@@ -0,0 +1,99 @@
+import asyncio
+from collections.abc import AsyncIterator
+
+import httpx
+import pytest
+
+from app.lib.http import ClientRegistry, _LimitedTransport
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def server_url() -> AsyncIterator[str]:
+    """Serve empty keep-alive HTTP/1.1 responses on a local port."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while await reader.readuntil(b"\r\n\r\n"):
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            # Client closed the connection
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    host, port = server.sockets[0].getsockname()
+    async with server:
+        yield f"http://{host}:{port}/"
+
+
+async def test_shared_client_reuses_connections(server_url):
+    registry = ClientRegistry()
+    async with registry.open():
+        for _ in range(3):
+            async with registry.client() as client:
+                response = await client.get(server_url)
+                assert response.status_code == 200
+
+    assert registry.stats.requests == 3
+    assert registry.stats.tcp_handshakes == 1
+    assert registry.stats.reused == 2
+
+
+async def test_client_outside_lifespan_is_short_lived(server_url):
+    registry = ClientRegistry()
+    for _ in range(2):
+        async with registry.client() as client:
+            await client.get(server_url)
+
+    assert registry.stats.tcp_handshakes == 2
+    assert registry.stats.reused == 0
+
+
+async def test_callers_event_hooks_run_alongside_tracing(server_url):
+    registry = ClientRegistry()
+    requested: list[str] = []
+    responded: list[int] = []
+
+    async def on_request(request):
+        requested.append(str(request.url))
+
+    async def on_response(response):
+        responded.append(response.status_code)
+
+    hooks = {"request": [on_request], "response": [on_response]}
+    async with registry.open(event_hooks=hooks):
+        async with registry.client() as client:
+            await client.get(server_url)
+
+    assert requested == [server_url]
+    assert responded == [200]
+    assert registry.stats.requests == 1
+
+
+class Body(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        yield b"ok"
+
+
+async def test_limited_transport_bounds_requests_in_flight():
+    in_flight = peak = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        # Streamed, like responses from a real connection
+        return httpx.Response(200, stream=Body())
+
+    transport = _LimitedTransport(httpx.MockTransport(handler), max_requests=2)
+    async with httpx.AsyncClient(transport=transport) as client:
+        responses = await asyncio.gather(
+            *(client.get("https://example.com") for _ in range(6))
+        )
+
+    assert [response.text for response in responses] == ["ok"] * 6
+    assert peak == 2
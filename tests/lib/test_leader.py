@@ -0,0 +1,76 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+from fakeredis import FakeAsyncRedis, FakeServer
+
+from app.lib.leader import LeaderElection
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def server() -> FakeServer:
+    return FakeServer()
+
+
+def track_roles(roles: dict[str, str], name: str) -> dict:
+    @asynccontextmanager
+    async def lead():
+        roles[name] = "leader"
+        yield
+
+    @asynccontextmanager
+    async def follow():
+        roles[name] = "follower"
+        yield
+
+    return {"lead": lead, "follow": follow}
+
+
+async def wait_for(condition) -> None:
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    pytest.fail("timed out")
+
+
+async def test_only_one_process_leads_and_another_takes_over(server):
+    roles: dict[str, str] = {}
+    first = LeaderElection(FakeAsyncRedis(server=server), "leader", ttl=0.3)
+    second = LeaderElection(FakeAsyncRedis(server=server), "leader", ttl=0.3)
+    first_task = asyncio.create_task(first.run(**track_roles(roles, "first")))
+    await wait_for(lambda: first.is_leader)
+    second_task = asyncio.create_task(second.run(**track_roles(roles, "second")))
+    # Longer than the TTL, so the leader has to renew its lease
+    await asyncio.sleep(0.5)
+    assert roles == {"first": "leader", "second": "follower"}
+    assert not second.is_leader
+
+    # Releasing the lease on the way out lets another process take over
+    first_task.cancel()
+    await asyncio.gather(first_task, return_exceptions=True)
+    await wait_for(lambda: second.is_leader)
+    assert roles["second"] == "leader"
+    assert second.stats.elected == 1
+
+    second_task.cancel()
+    await asyncio.gather(second_task, return_exceptions=True)
+
+
+async def test_leader_steps_down_when_its_lease_is_taken(server):
+    roles: dict[str, str] = {}
+    redis = FakeAsyncRedis(server=server)
+    election = LeaderElection(redis, "leader", ttl=0.3)
+    task = asyncio.create_task(election.run(**track_roles(roles, "one")))
+    await wait_for(lambda: election.is_leader)
+
+    # Another process took the lease, e.g. after this one stalled
+    await redis.set("leader", "someone else")
+    await wait_for(lambda: roles["one"] == "follower")
+    assert election.stats.lost == 1
+    assert not election.is_leader
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,234 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from google.transit import gtfs_realtime_pb2
+
+from app.lib import mta
+from app.lib.http import ClientRegistry
+
+pytestmark = pytest.mark.anyio
+
+
+def make_feed(*trips: tuple[str, str, int]) -> bytes:
+    """Build a serialized GTFS-realtime feed from (route_id, stop_id, time) tuples."""
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = int(time.time())
+    for i, (route_id, stop_id, departure_time) in enumerate(trips):
+        entity = feed.entity.add(id=str(i))
+        entity.trip_update.trip.route_id = route_id
+        stop_time_update = entity.trip_update.stop_time_update.add(stop_id=stop_id)
+        stop_time_update.departure.time = departure_time
+    return feed.SerializeToString()
+
+
+@pytest.fixture
+def requested_urls(monkeypatch) -> list[str]:
+    """Serve fake MTA feeds and record the URLs that were fetched."""
+    urls: list[str] = []
+    now = int(time.time())
+    feeds = {
+        mta.MTA_SUBWAY_ALERTS_URL: make_feed(),
+        mta.get_feed_url("Q"): make_feed(
+            ("Q", "A01", now + 600), ("N", "A02", now + 300), ("Q", "A01", now + 300)
+        ),
+        mta.get_feed_url("2"): make_feed(("2", "A02", now + 400)),
+    }
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        urls.append(str(request.url))
+        if str(request.url) not in feeds:
+            return httpx.Response(500)
+        return httpx.Response(200, content=feeds[str(request.url)])
+
+    monkeypatch.setattr(
+        mta, "clients", ClientRegistry(transport=httpx.MockTransport(handler))
+    )
+    monkeypatch.setattr(mta, "feed_cache", mta.FeedCache())
+    return urls
+
+
+def test_parsed_feed_looks_up_departures_by_stop_and_route():
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(
+        make_feed(("Q", "A01", 300), ("N", "A01", 200), ("Q", "A01", 100))
+    )
+    feed = mta.ParsedFeed.from_message(message)
+    assert list(feed.departure_times("A01", "Q")) == [100, 300]
+    assert list(feed.departure_times("A01", "N")) == [200]
+    assert list(feed.departure_times("A02", "Q")) == []
+    assert feed.next_departures("A01", ["Q", "N"], limit=2) == [(100, "Q"), (200, "N")]
+
+
+def test_alerts_without_header_text_are_skipped():
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.ParseFromString(make_feed(("Q", "A01", 300)))
+    untitled = message.entity.add(id="untitled").alert
+    untitled.informed_entity.add(route_id="7")
+    alert = message.entity.add(id="delays").alert
+    alert.informed_entity.add(route_id="Q")
+    alert.header_text.translation.add(text="Q trains are delayed")
+
+    feed = mta.ParsedFeed.from_message(message)
+    assert list(feed.alerts) == ["Q"]
+    assert feed.alerts["Q"][0].alert_text == "Q trains are delayed"
+    assert list(feed.departure_times("A01", "Q")) == [300]
+
+
+async def test_get_station_data_filters_by_station_and_route(requested_urls):
+    station_data = await mta.get_station_data("A01", routes={"Q"})
+    assert station_data is not None
+    assert [departure.route for departure in station_data.departures] == ["Q", "Q"]
+    times = [departure.time for departure in station_data.departures]
+    assert times == sorted(times)
+
+
+async def test_feeds_are_shared_between_stations(requested_urls):
+    await mta.get_station_data("A01", routes={"Q"})
+    await mta.get_station_data("A02", routes={"N", "2"})
+
+    assert sorted(requested_urls) == sorted(
+        {mta.MTA_SUBWAY_ALERTS_URL, mta.get_feed_url("Q"), mta.get_feed_url("2")}
+    )
+    assert mta.feed_cache.stats.misses == 3
+    # Alerts feed and the N/Q feed are reused for the second station
+    assert mta.feed_cache.stats.hits == 2
+
+
+async def test_concurrent_lookups_share_in_flight_fetches(requested_urls):
+    await asyncio.gather(
+        mta.get_station_data("A01", routes={"Q"}),
+        mta.get_station_data("A02", routes={"N"}),
+    )
+    assert sorted(requested_urls) == sorted(
+        {mta.MTA_SUBWAY_ALERTS_URL, mta.get_feed_url("Q")}
+    )
+
+
+async def test_failed_feed_returns_partial_data(requested_urls):
+    station_data = await mta.get_station_data("A02", routes={"2", "A"})
+    assert station_data is not None
+    assert [departure.route for departure in station_data.departures] == ["2"]
+    # Failures aren't cached
+    await mta.get_station_data("A02", routes={"A"})
+    assert requested_urls.count(mta.get_feed_url("A")) == 2
+
+
+async def test_feed_that_cant_be_parsed_returns_partial_data(monkeypatch):
+    now = int(time.time())
+    feeds = {
+        mta.MTA_SUBWAY_ALERTS_URL: make_feed(),
+        mta.get_feed_url("Q"): make_feed(("N", "A02", now + 300)),
+        mta.get_feed_url("2"): b"not a protobuf message",
+    }
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=feeds[str(request.url)])
+
+    monkeypatch.setattr(
+        mta, "clients", ClientRegistry(transport=httpx.MockTransport(handler))
+    )
+    monkeypatch.setattr(mta, "feed_cache", mta.FeedCache())
+
+    station_data = await mta.get_station_data("A02", routes={"2", "N"})
+    assert station_data is not None
+    assert [departure.route for departure in station_data.departures] == ["N"]
+
+
+async def test_slow_feeds_only_fail_the_stations_that_use_them(monkeypatch):
+    now = int(time.time())
+    slow_urls = {mta.MTA_SUBWAY_ALERTS_URL, mta.get_feed_url("2")}
+    feeds = {
+        mta.MTA_SUBWAY_ALERTS_URL: make_feed(),
+        mta.get_feed_url("Q"): make_feed(("Q", "A01", now + 300)),
+        mta.get_feed_url("2"): make_feed(("2", "A02", now + 400)),
+    }
+    release = asyncio.Event()
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if str(request.url) in slow_urls:
+            await release.wait()
+        return httpx.Response(200, content=feeds[str(request.url)])
+
+    monkeypatch.setattr(
+        mta, "clients", ClientRegistry(transport=httpx.MockTransport(handler))
+    )
+    monkeypatch.setattr(mta, "feed_cache", mta.FeedCache())
+    stations = [
+        mta.StationConfig(station_id="A01", routes=frozenset({"Q"})),
+        mta.StationConfig(station_id="A02", routes=frozenset({"2"})),
+    ]
+
+    deadline = asyncio.get_running_loop().time() + 0.1
+    try:
+        a01, a02 = await mta.get_stations_data(stations, deadline=deadline)
+    finally:
+        release.set()
+
+    # The slow alerts feed only drops alerts, and the slow route feed only
+    # fails the station that uses it
+    assert a01 is not None
+    assert [departure.route for departure in a01.departures] == ["Q"]
+    assert a01.alerts == []
+    assert a02 is None
+
+
+async def test_all_feeds_failing_returns_none(requested_urls):
+    assert await mta.get_station_data("A02", routes={"A"}) is None
+
+
+async def test_unchanged_feeds_are_not_reparsed():
+    now = int(time.time())
+    content = make_feed(("Q", "A01", now + 300))
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.headers.get("If-None-Match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, content=content, headers={"ETag": '"v1"'})
+
+    cache = mta.FeedCache(ttl=0)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        first = await cache.get(client, mta.get_feed_url("Q"))
+        second = await cache.get(client, mta.get_feed_url("Q"))
+
+    assert first is not None
+    assert second is first
+    assert cache.stats.not_modified == 1
+    assert cache.stats.bytes_saved == len(content)
+    assert cache.stats.parses_skipped == 1
+
+
+async def test_feeds_with_same_header_timestamp_are_not_reparsed():
+    now = int(time.time())
+    content = make_feed(("Q", "A01", now + 300))
+
+    cache = mta.FeedCache(ttl=0)
+    transport = httpx.MockTransport(lambda _: httpx.Response(200, content=content))
+    async with httpx.AsyncClient(transport=transport) as client:
+        first = await cache.get(client, mta.get_feed_url("Q"))
+        second = await cache.get(client, mta.get_feed_url("Q"))
+
+    assert first is not None
+    assert second is first
+    assert cache.stats.not_modified == 0
+    assert cache.stats.parses_skipped == 1
+
+
+async def test_feeds_are_fetched_once_for_many_stations(requested_urls):
+    stations = [
+        mta.StationConfig(station_id="A01", routes=frozenset({"Q"})),
+        mta.StationConfig(station_id="A02", routes=frozenset({"N", "2"})),
+        mta.StationConfig(station_id="A03", routes=frozenset({"R", "W"})),
+    ]
+    results = await mta.get_stations_data(stations)
+
+    assert [station_data.station_id for station_data in results if station_data] == [
+        "A01",
+        "A02",
+        "A03",
+    ]
+    assert sorted(requested_urls) == sorted(
+        {mta.MTA_SUBWAY_ALERTS_URL, mta.get_feed_url("Q"), mta.get_feed_url("2")}
+    )
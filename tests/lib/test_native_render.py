@@ -0,0 +1,107 @@
+import base64
+import io
+import pathlib
+
+import msgspec
+import numpy as np
+import pytest
+from PIL import Image, ImageSequence
+
+from app import settings, tasks
+from app.api.mocks import TransitDataMocks, WeatherResponseMocks
+from app.lib.native_render import NUM_FRAMES, NativeRenderer, UnsupportedDataError
+
+pytestmark = pytest.mark.anyio
+
+SNAPSHOTS_DIR = (
+    pathlib.Path(__file__).parent.parent / "__snapshots__" / "test_app_rendering"
+)
+
+# (transit mock, weather mock, snapshot) for each of pixlet's snapshots
+SNAPSHOTS = [
+    *(
+        (name, "no_weather", f"test_rendered_output_matches_snapshots[{name}]")
+        for name in TransitDataMocks
+    ),
+    *(
+        ("basic", name, f"test_rendered_output_with_weather_matches_snapshots[{name}]")
+        for name in WeatherResponseMocks
+    ),
+]
+
+
+@pytest.fixture(scope="module")
+def renderer() -> NativeRenderer:
+    return NativeRenderer(str(tasks.TIDBYT_APP_PATH))
+
+
+def make_config(transit_data, weather_data) -> dict[str, str]:
+    return {
+        "transit_data": msgspec.json.encode(transit_data).decode(),
+        "weather_data": msgspec.json.encode(weather_data).decode(),
+    }
+
+
+def decode_frames(data: bytes) -> np.ndarray:
+    """Decode an animated webp into one RGBA array per 50ms frame."""
+    frames = []
+    with Image.open(io.BytesIO(data)) as image:
+        for frame in ImageSequence.Iterator(image):
+            pixels = np.asarray(frame.convert("RGBA"))
+            frames.extend([pixels] * (frame.info["duration"] // 50))
+    return np.array(frames)
+
+
+@pytest.mark.parametrize(("transit_mock", "weather_mock", "snapshot"), SNAPSHOTS)
+async def test_frames_match_pixlet_snapshots(
+    renderer, transit_mock, weather_mock, snapshot
+):
+    config = make_config(
+        TransitDataMocks[transit_mock], WeatherResponseMocks[weather_mock]
+    )
+    result = await renderer.render(config=config, as_bytes=True)
+    expected = decode_frames((SNAPSHOTS_DIR / f"{snapshot}.webp").read_bytes())
+    frames = decode_frames(result)
+    assert frames.shape == expected.shape == (NUM_FRAMES, 32, 64, 4)
+    assert np.array_equal(frames, expected)
+
+
+async def test_unknown_glyphs_are_unsupported(renderer):
+    transit_data = msgspec.to_builtins(TransitDataMocks["basic"])
+    transit_data["trains"][0]["departures"][0]["route"] = "7"
+    with pytest.raises(UnsupportedDataError, match="route '7'"):
+        await renderer.render(config=make_config(transit_data, None))
+
+
+async def test_overflowing_data_is_unsupported(renderer):
+    transit_data = msgspec.to_builtins(TransitDataMocks["long_wait_times"])
+    for station in transit_data["trains"]:
+        station["departures"][0]["wait_time_minutes"] = 1234
+    with pytest.raises(UnsupportedDataError, match="doesn't fit"):
+        await renderer.render(config=make_config(transit_data, None))
+
+
+async def test_data_is_required(renderer):
+    with pytest.raises(UnsupportedDataError):
+        await renderer.render(config={"stations": "A"})
+
+
+async def test_unsupported_data_is_rendered_with_pixlet(monkeypatch):
+    rendered = []
+
+    async def render_applet(path, *, config, **kwargs):
+        rendered.append(dict(config))
+        return "pixlet image"
+
+    monkeypatch.setattr(settings, "TIDBYT_RENDERER", "native")
+    monkeypatch.setattr(settings, "PIXLET_RENDER_WORKER", False)
+    monkeypatch.setattr(tasks, "render_applet", render_applet)
+
+    config = make_config(TransitDataMocks["basic"], WeatherResponseMocks["sunny"])
+    image_data = await tasks.render_tidbyt_app(config)
+    assert decode_frames(base64.b64decode(image_data)).shape[0] == NUM_FRAMES
+    assert rendered == []
+
+    # Without data, the applet has to fetch it
+    assert await tasks.render_tidbyt_app({}) == "pixlet image"
+    assert rendered == [{}]
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from app.lib.pipeline import Pipeline, Stage
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_next_tick_starts_while_previous_tick_is_in_later_stage():
+    render_started = asyncio.Event()
+    release_render = asyncio.Event()
+    events = []
+
+    async def fetch(_):
+        events.append("fetch")
+        return len(events)
+
+    async def render(value):
+        events.append(f"render {value}")
+        render_started.set()
+        await release_render.wait()
+
+    pipeline = Pipeline(
+        [Stage("fetch", fetch, deadline=1), Stage("render", render, deadline=1)]
+    )
+    first = asyncio.create_task(pipeline.tick())
+    await render_started.wait()
+    second = asyncio.create_task(pipeline.tick())
+    # Waits for the first tick to leave the render stage
+    await asyncio.sleep(0.01)
+    assert events == ["fetch", "render 1", "fetch"]
+    # The second tick holds the fetch stage, so a third is coalesced into
+    # one more tick after it
+    assert not await pipeline.tick()
+    assert not await pipeline.tick()
+
+    release_render.set()
+    assert await first
+    assert await second
+    await pipeline.aclose()
+    assert events[:4] == ["fetch", "render 1", "fetch", "render 3"]
+    assert pipeline.stats.coalesced == 2
+
+
+async def test_tick_during_slow_render_runs_once_fetch_stage_is_free():
+    release_render = asyncio.Event()
+    fetched = []
+    rendered = []
+
+    async def fetch(_):
+        fetched.append(len(fetched))
+        return fetched[-1]
+
+    async def render(value):
+        await release_render.wait()
+        rendered.append(value)
+
+    pipeline = Pipeline(
+        [Stage("fetch", fetch, deadline=1), Stage("render", render, deadline=1)]
+    )
+    # One tick renders while the next waits for it in the fetch stage, and
+    # a change arrives in the meantime
+    pipeline.submit()
+    pipeline.submit()
+    await asyncio.sleep(0.01)
+    pipeline.submit()
+    await asyncio.sleep(0.01)
+    assert fetched == [0, 1]
+
+    release_render.set()
+    for _ in range(100):
+        if len(rendered) == 3:
+            break
+        await asyncio.sleep(0.01)
+
+    # The change is fetched and rendered after the ticks ahead of it
+    assert fetched == [0, 1, 2]
+    assert rendered == [0, 1, 2]
+    assert pipeline.stats.coalesced == 1
+    assert pipeline.stats.completed == 3
+    await pipeline.aclose()
+
+
+async def test_stage_that_overruns_its_deadline_is_cancelled():
+    pushed = []
+
+    async def render(_):
+        await asyncio.sleep(1)
+
+    async def push(value):
+        pushed.append(value)
+
+    pipeline = Pipeline(
+        [Stage("render", render, deadline=0.01), Stage("push", push, deadline=1)]
+    )
+
+    assert not await pipeline.tick()
+    assert pushed == []
+    assert pipeline.stats.overruns == {"render": 1}
+    assert pipeline.stats.failed == 1
+
+    # A failed tick doesn't block the next one
+    assert not await pipeline.tick()
+    assert pipeline.stats.overruns == {"render": 2}
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from app.lib.singleflight import SingleFlight
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_concurrent_calls_share_one_call():
+    flight: SingleFlight[str, int] = SingleFlight()
+    calls = 0
+
+    async def fetch() -> int:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    results = await asyncio.gather(*(flight.do("a", fetch) for _ in range(5)))
+    other = await flight.do("b", fetch)
+
+    assert results == [1] * 5
+    assert other == 2
+    assert flight.stats.calls == 6
+    assert flight.stats.coalesced == 4
+
+
+async def test_exceptions_are_shared_and_not_cached():
+    flight: SingleFlight[str, int] = SingleFlight()
+
+    async def fail() -> int:
+        await asyncio.sleep(0.01)
+        raise ValueError
+
+    results = await asyncio.gather(
+        flight.do("a", fail), flight.do("a", fail), return_exceptions=True
+    )
+    assert all(isinstance(result, ValueError) for result in results)
+
+    async def succeed() -> int:
+        return 1
+
+    assert await flight.do("a", succeed) == 1
+
+
+async def test_cancelled_caller_does_not_cancel_others():
+    flight: SingleFlight[str, int] = SingleFlight()
+
+    async def fetch() -> int:
+        await asyncio.sleep(0.01)
+        return 1
+
+    first = asyncio.create_task(flight.do("a", fetch))
+    second = asyncio.create_task(flight.do("a", fetch))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    assert await second == 1
@@ -0,0 +1,15 @@
+from litestar.stores.file import FileStore
+from litestar.stores.memory import MemoryStore
+from litestar.stores.redis import RedisStore
+
+from app.lib.stores import store_from_url
+
+
+def test_store_from_url(tmp_path):
+    assert isinstance(store_from_url("memory", namespace="test"), MemoryStore)
+    assert isinstance(
+        store_from_url("redis://localhost:6379/0", namespace="test"), RedisStore
+    )
+    file_store = store_from_url(str(tmp_path), namespace="test")
+    assert isinstance(file_store, FileStore)
+    assert file_store.path == tmp_path / "test"
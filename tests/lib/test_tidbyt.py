@@ -0,0 +1,238 @@
+import asyncio
+import os
+import sys
+import textwrap
+import time
+
+import anyio
+import httpx
+import pytest
+
+from app.lib.tidbyt import (
+    PreparedApplets,
+    PushQueue,
+    RenderCache,
+    RenderError,
+    RenderWorker,
+    TidbytDevice,
+)
+
+pytestmark = pytest.mark.anyio
+
+# Stands in for `pixlet serve PATH --host HOST --port PORT`, serving the
+# applet file's contents as the rendered image
+FAKE_PIXLET = """\
+import http.server, sys
+
+_, _, path, _, host, _, port = sys.argv
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        with open(path, "rb") as f:
+            body = f.read() if self.path == "/api/v1/preview.webp" else b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+http.server.HTTPServer((host, int(port)), Handler).serve_forever()
+"""
+
+
+@pytest.fixture
+def pixlet_binary(tmp_path) -> str:
+    path = tmp_path / "pixlet"
+    path.write_text(f"#!{sys.executable}\n{textwrap.dedent(FAKE_PIXLET)}")
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture
+def applet_path(tmp_path) -> str:
+    path = tmp_path / "app.star"
+    path.write_bytes(b"RIFF")
+    return str(path)
+
+
+async def test_renders_with_one_process(pixlet_binary, applet_path):
+    worker = RenderWorker(applet_path, pixlet_binary=pixlet_binary)
+    async with worker.run():
+        assert worker.is_running
+        process = worker._process
+        assert await worker.render(as_bytes=True) == b"RIFF"
+        assert await worker.render() == "UklGRg=="
+        assert worker._process is process
+    assert not worker.is_running
+    assert worker.stats.renders == 2
+
+
+async def test_restarts_after_process_exits(pixlet_binary, applet_path):
+    worker = RenderWorker(applet_path, pixlet_binary=pixlet_binary)
+    async with worker.run():
+        assert worker._process is not None
+        worker._process.kill()
+        await worker._process.wait()
+
+        assert await worker.render(as_bytes=True) == b"RIFF"
+        assert worker.stats.restarts == 1
+
+
+async def test_missing_binary_raises_render_error(applet_path):
+    worker = RenderWorker(applet_path, pixlet_binary=os.devnull + "/pixlet")
+    async with worker.run():
+        assert not worker.is_running
+        with pytest.raises(RenderError):
+            await asyncio.wait_for(worker.render(), timeout=5)
+
+
+async def test_prepared_applet_is_reused_until_source_changes(tmp_path):
+    source = tmp_path / "app.star"
+    source.write_text('API_URL = "http://localhost:8000"\n')
+    applets = PreparedApplets(str(tmp_path / "prepared"))
+    replacements = {"API_URL": "http://localhost:9000"}
+
+    path = await applets.prepare(str(source), replacements)
+    assert (await anyio.Path(path).read_text()) == 'API_URL = "http://localhost:9000"\n'
+    assert await applets.prepare(str(source), dict(replacements)) == path
+    # Other replacements are prepared separately
+    other_path = await applets.prepare(str(source), {"API_URL": "http://other"})
+    assert other_path != path
+
+    source.write_text('API_URL = "http://localhost:8000"\nFOO = 1\n')
+    os.utime(source, ns=(0, 0))
+    changed_path = await applets.prepare(str(source), replacements)
+    assert changed_path != path
+    assert (await anyio.Path(changed_path).read_text()).endswith("FOO = 1\n")
+
+
+async def test_prepared_applets_are_deleted_when_evicted_or_cleared(tmp_path):
+    source = tmp_path / "app.star"
+    source.write_text('API_URL = "http://localhost:8000"\n')
+    directory = anyio.Path(tmp_path / "prepared")
+    applets = PreparedApplets(str(directory), max_size=2)
+
+    # Concurrent writes of the same applet don't get in each other's way
+    paths = await asyncio.gather(
+        *(applets.prepare(str(source), {"API_URL": "http://one"}) for _ in range(5))
+    )
+    assert len(set(paths)) == 1
+    await applets.prepare(str(source), {"API_URL": "http://two"})
+    await applets.prepare(str(source), {"API_URL": "http://three"})
+    # The least recently used applet is deleted
+    assert not await anyio.Path(paths[0]).exists()
+    assert len([path async for path in directory.iterdir()]) == 2
+
+    await applets.clear()
+    assert [path async for path in directory.iterdir()] == []
+
+
+def test_render_cache_reports_time_saved():
+    cache = RenderCache(max_size=2)
+    assert cache.get("a") is None
+    cache.set("a", "image-a", render_seconds=0.5)
+    assert cache.get("b") is None
+    cache.set("b", "image-b", render_seconds=1.5)
+
+    assert cache.get("a") == "image-a"
+    assert cache.stats.seconds_saved == pytest.approx(1.0)
+    assert cache.stats.hit_ratio == pytest.approx(1 / 3)
+
+    # The least recently used image is evicted
+    assert cache.get("c") is None
+    cache.set("c", "image-c", render_seconds=1)
+    assert cache.get("b") is None
+    assert cache.get("a") == "image-a"
+
+
+async def test_push_queue_only_pushes_newest_image():
+    pushed: list[str] = []
+
+    async def push(device, image_data):
+        pushed.append(image_data)
+
+    queue = PushQueue(push, rate=100)
+    device = TidbytDevice(device_id="device", api_key="key")
+    for image_data in ("old", "older", "newest"):
+        queue.submit(device, image_data)
+    await queue.join()
+
+    assert pushed == ["newest"]
+    assert queue.stats.dropped == 2
+    assert queue.depth == 0
+
+
+async def test_push_queue_retries_after_rate_limit():
+    attempts: list[float] = []
+
+    async def push(device, image_data):
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            request = httpx.Request("POST", "https://api.tidbyt.com")
+            response = httpx.Response(
+                429, headers={"Retry-After": "0.2"}, request=request
+            )
+            raise httpx.HTTPStatusError(
+                "rate limited", request=request, response=response
+            )
+
+    pushed = asyncio.Event()
+
+    async def on_pushed():
+        pushed.set()
+
+    queue = PushQueue(push, rate=100, burst=2)
+    queue.submit(
+        TidbytDevice(device_id="device", api_key="key"), "image", on_pushed=on_pushed
+    )
+    await queue.join()
+
+    assert pushed.is_set()
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 0.2
+    assert queue.stats.rate_limited == 1
+    assert queue.stats.pushed == 1
+
+
+async def test_push_queue_keeps_pushing_after_unexpected_errors():
+    device = TidbytDevice(device_id="device", api_key="key")
+    pushed: list[str] = []
+
+    async def push(device, image_data):
+        if image_data == "bad":
+            # A newer image arrives while the bad one is being pushed
+            queue.submit(device, "good", on_pushed=on_pushed)
+            msg = "unexpected"
+            raise ValueError(msg)
+        pushed.append(image_data)
+
+    async def on_pushed():
+        msg = "unexpected"
+        raise ValueError(msg)
+
+    queue = PushQueue(push, rate=100, burst=2)
+    queue.submit(device, "bad")
+    await queue.join()
+
+    assert pushed == ["good"]
+    assert queue.stats.failed == 1
+    assert queue.stats.pushed == 1
+
+
+async def test_push_queue_limits_rate_per_device():
+    pushes: list[float] = []
+
+    async def push(device, image_data):
+        pushes.append(time.monotonic())
+
+    queue = PushQueue(push, rate=10, burst=1)
+    device = TidbytDevice(device_id="device", api_key="key")
+    queue.submit(device, "first")
+    await queue.join()
+    queue.submit(device, "second")
+    await queue.join()
+
+    assert pushes[1] - pushes[0] >= 0.09
+    assert queue.stats.max_wait_seconds >= 0.09
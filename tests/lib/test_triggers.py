@@ -0,0 +1,88 @@
+import asyncio
+import datetime as dt
+import time
+
+import pytest
+
+from app.lib.triggers import CadenceProfile, ChangeTrigger
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeSource:
+    def __init__(self) -> None:
+        self.version = 0
+        self.change_at: float | None = None
+        self._changed = asyncio.Event()
+
+    def change(self) -> None:
+        self.version += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for_change(self, version: int) -> None:
+        while self.version == version:
+            await self._changed.wait()
+
+    def next_change_at(self, now: float) -> float | None:
+        return self.change_at
+
+
+async def run_trigger(trigger, source, *, until_runs: int) -> list[float]:
+    runs: list[float] = []
+    done = asyncio.Event()
+
+    async def func():
+        runs.append(time.monotonic())
+        if len(runs) == until_runs:
+            done.set()
+
+    task = asyncio.create_task(trigger.run(func, source))
+    try:
+        async with asyncio.timeout(5):
+            await done.wait()
+    finally:
+        task.cancel()
+    return runs
+
+
+async def test_runs_on_change_no_more_often_than_min_interval():
+    source = FakeSource()
+    trigger = ChangeTrigger(min_interval=0.2, max_interval=60)
+    asyncio.get_running_loop().call_later(0.01, source.change)
+
+    runs = await run_trigger(trigger, source, until_runs=2)
+
+    assert runs[1] - runs[0] >= 0.19
+    assert trigger.stats.changes == 1
+    assert trigger.stats.delayed == 1
+
+
+async def test_runs_at_scheduled_change_and_max_interval():
+    source = FakeSource()
+    source.change_at = time.time() + 0.1
+    trigger = ChangeTrigger(min_interval=0, max_interval=0.3)
+
+    runs = await run_trigger(trigger, source, until_runs=2)
+    assert runs[1] - runs[0] < 0.25
+    assert trigger.stats.scheduled == 1
+
+    source.change_at = None
+    await run_trigger(trigger, source, until_runs=2)
+    assert trigger.stats.scheduled == 1
+    assert trigger.stats.timeouts == 3
+
+
+def test_profiles_raise_min_interval_overnight():
+    trigger = ChangeTrigger(
+        min_interval=5,
+        max_interval=60,
+        profiles=[CadenceProfile(start=dt.time(23), end=dt.time(6), min_interval=300)],
+    )
+
+    def at(hour: int) -> float:
+        return dt.datetime(2026, 1, 1, hour).timestamp()  # noqa: DTZ001
+
+    assert trigger.intervals(at(2)) == (300, 300)
+    assert trigger.intervals(at(23)) == (300, 300)
+    assert trigger.intervals(at(12)) == (5, 60)
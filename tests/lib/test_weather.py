@@ -0,0 +1,62 @@
+import pytest
+
+from app.lib.weather import HourlyForecast
+
+HOUR = 60 * 60
+
+
+@pytest.fixture
+def forecast() -> HourlyForecast:
+    start = 1_800_000_000
+    return HourlyForecast(
+        time=[start, start + HOUR, start + 2 * HOUR],
+        temperature_2m=[10.0, 12.0, 11.0],
+        apparent_temperature=[8.0, 10.0, 9.0],
+        is_day=[False, True, True],
+        precipitation=[0.0, 0.0, 1.5],
+        weather_code=[0, 2, 61],
+        wind_speed_10m=[5.0, 10.0, 10.0],
+    )
+
+
+def test_values_are_interpolated_between_hours(forecast):
+    start = forecast.time[0]
+
+    weather = forecast.at(start + HOUR // 4)
+
+    assert weather is not None
+    assert weather["temperature_2m"] == pytest.approx(10.5)
+    assert weather["apparent_temperature"] == pytest.approx(8.5)
+    assert weather["wind_speed_10m"] == pytest.approx(6.25)
+    # Codes are taken from the nearest hour
+    assert weather["weather_code"] == 0
+    assert weather["is_day"] is False
+
+
+def test_nearest_hour_is_used_for_codes(forecast):
+    weather = forecast.at(forecast.time[1] + HOUR * 3 // 4)
+
+    assert weather is not None
+    assert weather["temperature_2m"] == pytest.approx(11.25)
+    assert weather["weather_code"] == 61
+    assert weather["precipitation"] == 1.5
+
+
+def test_forecast_hours_are_returned_as_is(forecast):
+    assert forecast.at(forecast.time[0]) == {
+        "temperature_2m": 10.0,
+        "apparent_temperature": 8.0,
+        "is_day": False,
+        "precipitation": 0.0,
+        "weather_code": 0,
+        "wind_speed_10m": 5.0,
+    }
+    last = forecast.at(forecast.time[-1])
+    assert last is not None
+    assert last["temperature_2m"] == 11.0
+
+
+def test_times_outside_of_forecast(forecast):
+    assert forecast.at(forecast.time[0] - 1) is None
+    assert forecast.at(forecast.time[-1] + 1) is None
+    assert forecast.expires_at == forecast.time[-1]
@@ -0,0 +1,314 @@
+import asyncio
+import time
+from dataclasses import replace
+
+import httpx
+import pytest
+from litestar.stores.memory import MemoryStore
+
+from app import settings
+from app.lib import mta
+from app.lib.citibike import CitibikeStationData, StationStatusSnapshot
+from app.lib.weather import HourlyForecast
+from app.tasks import ingestion
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def ingestor(monkeypatch) -> ingestion.Ingestor:
+    ingestor = ingestion.Ingestor()
+    monkeypatch.setattr(ingestion, "ingestor", ingestor)
+    monkeypatch.setattr("app.api.app.ingestor", ingestor)
+    return ingestor
+
+
+@pytest.fixture
+def upstream(monkeypatch) -> dict:
+    """Fake upstream data, keyed by station ID. Set a value to None to simulate
+    a failed fetch.
+    """
+    data: dict = {
+        "AB1": mta.TrainStationData(station_id="AB1"),
+        "CD2": mta.TrainStationData(station_id="CD2"),
+        "123": CitibikeStationData(regular=3, ebikes=4),
+    }
+
+    async def get_stations_data(stations, *, client=None, deadline=None):
+        return [data[station.station_id] for station in stations]
+
+    async def get_station_status(station_ids, *, client=None):
+        if any(data[station_id] is None for station_id in station_ids):
+            return None
+        return StationStatusSnapshot(
+            station_ids=frozenset(station_ids),
+            stations={station_id: data[station_id] for station_id in station_ids},
+        )
+
+    monkeypatch.setattr(ingestion, "get_stations_data", get_stations_data)
+    monkeypatch.setattr(ingestion, "get_station_status", get_station_status)
+    return data
+
+
+async def test_transit_is_served_from_snapshot(ingestor, upstream, client, monkeypatch):
+    monkeypatch.setattr(settings, "INGEST_ENABLE", True)
+    assert not ingestor.snapshot.has_transit
+
+    await ingestor.refresh_trains()
+    await ingestor.refresh_citibike()
+
+    assert ingestor.snapshot.sources["mta"].error is None
+    assert ingestor.snapshot.sources["citibike"].updated_at is not None
+    # Upstreams are no longer consulted
+    upstream.clear()
+    response = await client.get("/transit")
+    assert response.status_code == 200
+    data = response.json()
+    assert [station["station_id"] for station in data["trains"]] == ["AB1", "CD2"]
+    assert data["citibike"] == {"regular": 3, "ebike": 4, "station_id": "123"}
+
+
+async def test_transit_response_cache_can_be_bypassed(
+    ingestor, upstream, client, monkeypatch
+):
+    monkeypatch.setattr(settings, "INGEST_ENABLE", True)
+    await ingestor.refresh_trains()
+    await ingestor.refresh_citibike()
+    response = await client.get("/transit")
+    assert response.json()["trains"][0]["departures"] == []
+
+    upstream["AB1"].departures = [
+        mta.TrainDeparture(route="A", time=int(time.time()) + 5 * 60 + 30)
+    ]
+    await ingestor.refresh_trains()
+
+    # The cached response is served until it expires...
+    response = await client.get("/transit")
+    assert response.json()["trains"][0]["departures"] == []
+    # ...unless the request asks for a fresh one, which isn't cached either
+    for _ in range(2):
+        response = await client.get("/transit", headers={"Cache-Control": "no-cache"})
+        assert len(response.json()["trains"][0]["departures"]) == 1
+    response = await client.get("/transit")
+    assert response.json()["trains"][0]["departures"] == []
+
+
+async def test_failed_refresh_keeps_last_good_data(ingestor, upstream):
+    await ingestor.refresh_citibike()
+    updated_at = ingestor.snapshot.sources["citibike"].updated_at
+
+    upstream["123"] = None
+    await ingestor.refresh_citibike()
+
+    assert ingestor.snapshot.citibike is not None
+    assert ingestor.snapshot.citibike.regular == 3
+    freshness = ingestor.snapshot.sources["citibike"]
+    assert freshness.error is not None
+    assert freshness.updated_at == updated_at
+
+
+async def test_fallback_station_is_shown_when_first_is_empty(
+    ingestor, upstream, monkeypatch
+):
+    monkeypatch.setattr(settings, "CITIBIKE_STATION_IDS", ["123", "456", "789"])
+    upstream["123"] = CitibikeStationData(regular=0, ebikes=0)
+    upstream["456"] = CitibikeStationData(regular=0, ebikes=2)
+    upstream["789"] = CitibikeStationData(regular=5, ebikes=0)
+
+    await ingestor.refresh_citibike()
+
+    assert ingestor.snapshot.citibike is not None
+    assert ingestor.snapshot.citibike.station_id == "456"
+    assert [station.station_id for station in ingestor.snapshot.citibike_stations] == [
+        "123",
+        "456",
+        "789",
+    ]
+
+
+async def test_wait_times_are_computed_when_served(ingestor, upstream):
+    now = 1_800_000_000
+    upstream["AB1"].departures = [
+        mta.TrainDeparture(route="A", time=now + 90),
+        mta.TrainDeparture(route="A", time=now + 5 * 60 + 30),
+    ]
+    await ingestor.refresh_trains()
+    await ingestor.refresh_citibike()
+
+    transit = ingestor.snapshot.transit(now=now)
+    assert transit is not None
+    # The first train leaves too soon to catch
+    assert [d.wait_time_minutes for d in transit.trains[0].departures] == [5]
+
+    later = ingestor.snapshot.transit(now=now + 2 * 60)
+    assert later is not None
+    assert [d.wait_time_minutes for d in later.trains[0].departures] == [3]
+
+
+async def test_weather_is_revalidated_in_background(ingestor, client, monkeypatch):
+    monkeypatch.setattr(settings, "WEATHER_COORDINATES", [40.7, -74.0])
+    monkeypatch.setattr(settings, "WEATHER_MOCK", None)
+    now = int(time.time())
+    forecast = HourlyForecast(
+        time=[now - 60 * 60, now + 60 * 60],
+        temperature_2m=[10.0, 20.0],
+        apparent_temperature=[10.0, 20.0],
+        is_day=[True, True],
+        precipitation=[0.0, 0.0],
+        weather_code=[0, 0],
+        wind_speed_10m=[0.0, 0.0],
+    )
+    released = asyncio.Event()
+    calls = 0
+
+    async def get_hourly_forecast(latitude, longitude):
+        nonlocal calls
+        calls += 1
+        await released.wait()
+        return forecast
+
+    monkeypatch.setattr(ingestion, "get_hourly_forecast", get_hourly_forecast)
+
+    # Callers don't wait on the upstream
+    ingestor.revalidate_weather()
+    assert ingestor.snapshot.weather(now=time.time()) is None
+
+    released.set()
+    assert ingestor._weather_task is not None
+    await ingestor._weather_task
+    weather = ingestor.snapshot.weather(now=time.time())
+    assert weather is not None
+    assert weather.temperature_celsius == pytest.approx(15, abs=1)
+
+    # The fresh forecast is served without fetching it again
+    response = await client.get("/weather")
+    assert response.status_code == 200
+    assert response.json()["data"]["temperature_celsius"] == pytest.approx(15, abs=1)
+    assert calls == 1
+
+
+async def test_weather_waits_for_first_forecast_and_doesnt_cache_none(
+    ingestor, client, monkeypatch
+):
+    monkeypatch.setattr(settings, "WEATHER_COORDINATES", [40.7, -74.0])
+    monkeypatch.setattr(settings, "WEATHER_MOCK", None)
+    monkeypatch.setattr(ingestion, "WEATHER_RETRY_DELAY", 0)
+    now = int(time.time())
+    forecasts: list[HourlyForecast | None] = [
+        None,
+        HourlyForecast(
+            time=[now - 60 * 60, now + 60 * 60],
+            temperature_2m=[10.0, 20.0],
+            apparent_temperature=[10.0, 20.0],
+            is_day=[True, True],
+            precipitation=[0.0, 0.0],
+            weather_code=[0, 0],
+            wind_speed_10m=[0.0, 0.0],
+        ),
+    ]
+
+    async def get_hourly_forecast(latitude, longitude):
+        forecast = forecasts.pop(0)
+        if forecast is None:
+            request = httpx.Request("GET", "https://api.open-meteo.com")
+            raise httpx.ConnectError("unreachable", request=request)
+        return forecast
+
+    monkeypatch.setattr(ingestion, "get_hourly_forecast", get_hourly_forecast)
+
+    # The first forecast fails, so there's no weather to serve...
+    response = await client.get("/weather")
+    assert response.json()["data"] is None
+    # ...but that isn't cached, so the next request gets the forecast
+    response = await client.get("/weather")
+    assert response.json()["data"]["temperature_celsius"] == pytest.approx(15, abs=1)
+
+
+async def test_changes_are_signalled(ingestor, upstream):
+    now = 1_800_000_000
+    upstream["AB1"].departures = [
+        mta.TrainDeparture(route="A", time=now + 5 * 60 + 30),
+    ]
+    await ingestor.refresh_trains()
+    await ingestor.refresh_citibike()
+    version = ingestor.version
+
+    # The wait time goes from 5 to 4 minutes 30 seconds from now
+    assert ingestor.next_change_at(now) == now + 30
+
+    # Ingesting the same data again isn't a change
+    await ingestor.refresh_citibike()
+    assert ingestor.version == version
+
+    upstream["123"] = CitibikeStationData(regular=0, ebikes=1)
+    waiter = asyncio.create_task(ingestor.wait_for_change(version))
+    await ingestor.refresh_citibike()
+    await asyncio.wait_for(waiter, timeout=1)
+    assert ingestor.version == version + 1
+
+
+async def test_followers_serve_the_shared_snapshot(ingestor, upstream):
+    store = MemoryStore()
+    follower = ingestion.Ingestor()
+    upstream["AB1"].departures = [
+        mta.TrainDeparture(route="A", time=1_800_000_000, has_delays=True)
+    ]
+    upstream["AB1"].alerts = [
+        mta.ServiceAlert(
+            route="A", alert_text="Delays", cause="UNKNOWN_CAUSE", effect="DETOUR"
+        )
+    ]
+    await ingestor.refresh_trains()
+    await ingestor.refresh_citibike()
+    ingestor.snapshot = replace(
+        ingestor.snapshot,
+        weather_forecast=HourlyForecast(
+            time=[1_800_000_000],
+            temperature_2m=[10.0],
+            apparent_temperature=[9.5],
+            is_day=[True],
+            precipitation=[0.0],
+            weather_code=[3],
+            wind_speed_10m=[4.0],
+        ),
+    )
+
+    async with (
+        ingestor.share(store, interval=0.01),
+        follower.follow(store, interval=0.01),
+    ):
+        await asyncio.wait_for(follower.wait_for_change(0), timeout=1)
+        assert follower.snapshot == ingestor.snapshot
+        assert follower.snapshot.trains is not None
+        assert follower.snapshot.trains[0].departures[0].has_delays
+
+        upstream["123"] = CitibikeStationData(regular=0, ebikes=1)
+        version = follower.version
+        await ingestor.refresh_citibike()
+        await asyncio.wait_for(follower.wait_for_change(version), timeout=1)
+        assert follower.snapshot.citibike is not None
+        assert follower.snapshot.citibike.ebike == 1
+
+
+async def test_followers_dont_revalidate_weather(monkeypatch):
+    monkeypatch.setattr(settings, "WEATHER_COORDINATES", [40.7, -74.0])
+    calls = 0
+
+    async def get_hourly_forecast(latitude, longitude):
+        nonlocal calls
+        calls += 1
+
+    monkeypatch.setattr(ingestion, "get_hourly_forecast", get_hourly_forecast)
+    follower = ingestion.Ingestor()
+
+    async with follower.follow(MemoryStore(), interval=0.01):
+        # No forecast has been shared yet, but only the leader fetches one
+        assert follower.revalidate_weather() is None
+        await asyncio.sleep(0.02)
+
+    assert calls == 0
+    # Once it stops following, it fetches its own
+    refresh = follower.revalidate_weather()
+    assert refresh is not None
+    await refresh
+    assert calls == 1
@@ -0,0 +1,167 @@
+import httpx
+import pytest
+from litestar.stores.memory import MemoryStore
+
+from app import settings, tasks
+from app.lib.stores import store_from_url
+from app.lib.tidbyt import PushQueue, TidbytDevice
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def renders() -> list[dict[str, str]]:
+    return []
+
+
+@pytest.fixture
+def pushed(monkeypatch, renders) -> dict[str, str]:
+    """Record rendered configs and images pushed by device ID. Pushes to
+    "broken" fail.
+    """
+    images: dict[str, str] = {}
+
+    async def get_tidbyt_app_inputs(config):
+        return tasks.AppInputs(data={}, digest=None)
+
+    async def render_tidbyt_app(config):
+        renders.append(dict(config))
+        return f"image for {config.get('stations', 'all stations')}"
+
+    async def push_to_tidbyt(*, image_data, device_id, **kwargs):
+        if device_id == "broken":
+            request = httpx.Request("POST", "https://api.tidbyt.com")
+            raise httpx.HTTPStatusError(
+                "forbidden", request=request, response=httpx.Response(403)
+            )
+        images[device_id] = image_data
+        return {}
+
+    monkeypatch.setattr(tasks, "get_tidbyt_app_inputs", get_tidbyt_app_inputs)
+    monkeypatch.setattr(tasks, "render_tidbyt_app", render_tidbyt_app)
+    monkeypatch.setattr(tasks, "push_to_tidbyt", push_to_tidbyt)
+    monkeypatch.setattr(tasks, "store", MemoryStore())
+    monkeypatch.setattr(tasks, "push_queue", PushQueue(tasks.send_push, rate=100))
+    monkeypatch.setattr(settings, "HEARTBEAT_URL", None)
+    monkeypatch.setattr(
+        settings,
+        "TIDBYT_DEVICES",
+        [
+            TidbytDevice(device_id="one", api_key="key"),
+            TidbytDevice(device_id="broken", api_key="key"),
+            TidbytDevice(device_id="two", api_key="key"),
+            TidbytDevice(device_id="three", api_key="key", config=(("stations", "A"),)),
+        ],
+    )
+    return images
+
+
+async def test_each_config_is_rendered_once_and_pushed_to_every_device(pushed, renders):
+    await tasks.render_and_push_to_tidbyt()
+    await tasks.push_queue.join()
+
+    # One render for the default config and one for the subset of stations
+    assert sorted(renders, key=len) == [{}, {"stations": "A"}]
+    # The failing device doesn't hold up the others
+    assert pushed == {
+        "one": "image for all stations",
+        "two": "image for all stations",
+        "three": "image for A",
+    }
+    assert tasks.push_queue.stats.failed == 1
+
+
+async def test_unchanged_images_are_not_pushed_again(pushed):
+    await tasks.render_and_push_to_tidbyt()
+    await tasks.push_queue.join()
+    pushed.clear()
+
+    await tasks.render_and_push_to_tidbyt()
+    await tasks.push_queue.join()
+
+    assert pushed == {}
+
+
+async def test_unchanged_images_are_not_pushed_after_restart(
+    pushed, monkeypatch, tmp_path
+):
+    monkeypatch.setattr(tasks, "store", store_from_url(str(tmp_path), namespace="a"))
+    await tasks.render_and_push_to_tidbyt()
+    await tasks.push_queue.join()
+    pushed.clear()
+
+    # A new store reads what the previous process wrote
+    monkeypatch.setattr(tasks, "store", store_from_url(str(tmp_path), namespace="a"))
+    await tasks.render_and_push_to_tidbyt()
+    await tasks.push_queue.join()
+
+    assert pushed == {}
+    record = tasks.PushRecord.from_bytes(await tasks.store.get("pushed:one"))
+    assert record is not None
+    assert len(record.digest) == 64
+
+
+async def test_heartbeat_is_only_sent_when_every_image_renders(pushed, monkeypatch):
+    heartbeats = []
+    render_tidbyt_app = tasks.render_tidbyt_app
+
+    async def maybe_send_heartbeat():
+        heartbeats.append(True)
+
+    async def render_subset_fails(config):
+        if config.get("stations") == "A":
+            msg = "pixlet failed"
+            raise RuntimeError(msg)
+        return await render_tidbyt_app(config)
+
+    monkeypatch.setattr(tasks, "maybe_send_heartbeat", maybe_send_heartbeat)
+    await tasks.render_and_push_to_tidbyt()
+    assert heartbeats == [True]
+
+    monkeypatch.setattr(tasks, "render_tidbyt_app", render_subset_fails)
+    await tasks.render_and_push_to_tidbyt()
+    await tasks.push_queue.join()
+
+    # The other devices are still pushed to, but without a heartbeat
+    assert heartbeats == [True]
+    assert "one" in pushed
+
+
+async def test_applet_renders_the_data_its_digest_covers(monkeypatch):
+    bodies = {"/transit": '{"trains": []}', "/weather": '{"data": null}'}
+    rendered = []
+
+    def handler(request):
+        if request.url.path not in bodies:
+            return httpx.Response(500)
+        return httpx.Response(200, text=bodies[request.url.path])
+
+    def make_client(**kwargs):
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler), **kwargs)
+
+    async def render_tidbyt_app(config):
+        rendered.append(dict(config))
+        return "image"
+
+    monkeypatch.setattr(tasks, "make_client", make_client)
+    monkeypatch.setattr(tasks, "render_tidbyt_app", render_tidbyt_app)
+    monkeypatch.setattr(tasks, "render_cache", tasks.RenderCache())
+
+    first = await tasks.get_tidbyt_app_inputs({"stations": "A"})
+    await tasks.render_tidbyt_app_for_config(
+        {"stations": "A"}, first.digest, data=first.data
+    )
+    # The applet is given the fetched data instead of fetching it again
+    assert rendered == [
+        {
+            "stations": "A",
+            "transit_data": '{"trains": []}',
+            "weather_data": '{"data": null}',
+        }
+    ]
+
+    bodies["/transit"] = '{"trains": [{"station_id": "A"}]}'
+    del bodies["/weather"]
+    second = await tasks.get_tidbyt_app_inputs({"stations": "A"})
+    assert second.digest != first.digest
+    assert second.data["weather_data"] == "null"
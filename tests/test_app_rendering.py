@@ -9,7 +9,7 @@ from app.api.mocks import (
     WeatherResponseMockName,
     WeatherResponseMocks,
 )
-from app.lib.tidbyt import render_applet_with_replacements
+from app.lib.tidbyt import prepared_applets, render_applet_with_replacements
 from app.tasks import TIDBYT_APP_PATH
 from tests.syrupy_extensions import WebPImageSnapshotExtension
 
@@ -49,7 +49,9 @@ async def render_with_mock_data(monkeypatch):
                 as_bytes=True,
             )
 
-    return _render_with_mock_data
+    yield _render_with_mock_data
+    # Each server runs on a different port, so its applet is never reused
+    await prepared_applets.clear()
 
 
 @pytest.mark.parametrize(